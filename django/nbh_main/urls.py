@@ -93,12 +93,19 @@ urlpatterns = [
                         name="course-update"),
     re_path(rf'^staff/course/{COURSE}/?$',
                         nbhosting.courses.views_staff.staff_show_course),
+    # before the course patterns, as 'platform' would match COURSE
+    re_path(r'^staff/stats/platform_usage/?$',
+                        nbhosting.stats.views.send_platform_usage),
+    re_path(r'^staff/stats/platform/?$',
+                        nbhosting.stats.views.show_platform_stats),
     re_path(rf'^staff/stats/daily_metrics/{COURSE}/?$',
                         nbhosting.stats.views.send_daily_metrics),
     re_path(rf'^staff/stats/monitor_counts/{COURSE}/?$',
                         nbhosting.stats.views.send_monitor_counts),
     re_path(rf'^staff/stats/material_usage/{COURSE}/?$',
                         nbhosting.stats.views.send_material_usage),
+    re_path(rf'^staff/stats/open_latencies/{COURSE}/?$',
+                        nbhosting.stats.views.send_open_latencies),
     re_path(rf'^staff/stats/{COURSE}/?$',
                         nbhosting.stats.views.show_stats),
     re_path(rf'^staff.*',
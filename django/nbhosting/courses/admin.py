@@ -10,6 +10,7 @@ from django.contrib import admin
 
 #from django.contrib.auth.models import User, Group
 from .model_course import CourseDir
+from .model_session import ClassroomSession
 
 
 @admin.register(CourseDir)
@@ -18,6 +19,14 @@ class CourseDirAdmin(admin.ModelAdmin):
         (None, {'fields': ['giturl', 'image']}),
         ('boolean flags',
          {'fields': [ 'autopull', 'autobuild', 'archived']}),
+        ('containers', {'fields': ['pool_size']}),
         ('staff', {'fields': ['staff_usernames']}),
         ('groups', {'fields': ['registered_groups']}),
     ]
+
+
+@admin.register(ClassroomSession)
+class ClassroomSessionAdmin(admin.ModelAdmin):
+    list_display = ['coursedir', 'group', 'start', 'prespawned']
+    list_filter = ['coursedir']
+    ordering = ['-start']
@@ -30,6 +30,16 @@ class UpdateCourseForm(forms.Form):
         required=False,
         help_text=("archived courses do not show up in the default courses list"),
         )
+    pool_size = forms.IntegerField(
+        label='pool size',
+        required=False,
+        min_value=0,
+        help_text=("the number of containers kept warm for this course, "
+                   "so that students who open their first notebook do not "
+                   "wait for a container to be created; more may get created "
+                   "when there is more demand, up to twice that number; "
+                   "each one uses the memory of an idle jupyter"),
+        )
     image = forms.CharField(
         label='image',
         required=False,
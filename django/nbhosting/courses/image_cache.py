@@ -0,0 +1,167 @@
+"""
+a cache of the podman image hashes, keyed by image name
+
+asking podman for an image hash means a roundtrip on the podman socket,
+and images rarely change; so the answers are kept for a while (TTL),
+and can be dropped earlier when we know better, e.g. after a build,
+or when the monitor sees image events on the podman events stream
+
+the cache is kept in redis, so that it is shared by the web workers,
+the monitor, and the short-lived processes like course-build-image
+that invalidate it; without redis - typically in devel mode - or when
+redis does not answer, each process has its own cache
+
+typical usage is
+
+    from nbhosting.courses.image_cache import image_hash_cache
+    hash = image_hash_cache.get(image_name)
+"""
+
+# pylint: disable=c0111, w0703
+
+import os
+import time
+import threading
+
+import podman
+
+from nbh_main.settings import logger
+
+from .registry import REDIS_TIMEOUT
+
+PODMAN_URL = "unix:///run/podman/podman.sock"
+
+# in seconds
+DEFAULT_TTL = 600
+
+REDIS_PREFIX = "nbhosting:image-hash:"
+
+
+class ImageHashCache:
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        # the monitor uses this from 2 threads
+        self._lock = threading.Lock()
+        # image name -> (hash, expiration time), when redis is not available
+        self._hashes = {}
+        self.hits = 0
+        self.misses = 0
+        # created upon first use, False if redis is not installed
+        self._redis = None
+
+    def _reset_after_fork(self):
+        self._redis = None
+
+    def _redis_client(self):
+        if self._redis is None:
+            try:
+                import redis
+                from redis.retry import Retry
+                from redis.backoff import NoBackoff
+                self._redis = redis.Redis(
+                    retry=Retry(NoBackoff(), 0),
+                    socket_connect_timeout=REDIS_TIMEOUT, socket_timeout=REDIS_TIMEOUT)
+            except ModuleNotFoundError:
+                self._redis = False
+        return self._redis or None
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, image):
+        """
+        the hash of that image, or None if something goes wrong
+        failures are not cached
+        """
+        client = self._redis_client()
+        if client is not None:
+            try:
+                cached = client.get(REDIS_PREFIX + image)
+            except Exception as exc:
+                logger.error(f"image hash cache: cannot read redis - {exc}")
+            else:
+                self._count(cached is not None)
+                if cached is not None:
+                    return cached.decode()
+                hash_ = self._fetch(image)
+                if hash_ is not None:
+                    try:
+                        client.set(REDIS_PREFIX + image, hash_, ex=self.ttl)
+                    except Exception as exc:
+                        logger.error(f"image hash cache: cannot write redis - {exc}")
+                return hash_
+        # no redis: a cache in this process
+        now = time.time()
+        with self._lock:
+            cached = self._hashes.get(image)
+        self._count(bool(cached and cached[1] > now))
+        if cached and cached[1] > now:
+            return cached[0]
+        hash_ = self._fetch(image)
+        if hash_ is not None:
+            with self._lock:
+                self._hashes[image] = (hash_, now + self.ttl)
+        return hash_
+
+    @staticmethod
+    def _fetch(image):
+        with podman.PodmanClient(base_url=PODMAN_URL) as podman_api:
+            try:
+                return podman_api.images.get(image).attrs['Id']
+            except podman.errors.ImageNotFound:
+                logger.error(f"unknown podman image {image}")
+            except Exception:
+                logger.exception(f"Can't figure hash for image {image}")
+        return None
+
+    def invalidate(self, image=None):
+        """
+        forget about one image, or about all images if not specified
+        """
+        with self._lock:
+            if image is None:
+                self._hashes.clear()
+            else:
+                self._hashes.pop(image, None)
+        client = self._redis_client()
+        if client is None:
+            return
+        try:
+            if image is None:
+                keys = list(client.scan_iter(match=REDIS_PREFIX + "*"))
+            else:
+                keys = [REDIS_PREFIX + image]
+            if keys:
+                client.delete(*keys)
+        except Exception as exc:
+            logger.error(f"image hash cache: cannot invalidate in redis - {exc}")
+
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+    def report(self, reset=False):
+        """
+        with reset=True the counters start over, so that
+        the next report is about what happened in the meantime
+        """
+        with self._lock:
+            ratio = self.hit_ratio()
+            hits, misses = self.hits, self.misses
+            if reset:
+                self.hits = self.misses = 0
+        if ratio is None:
+            return "image hash cache unused"
+        return (f"image hash cache: {hits} hits / {misses} misses"
+                f" ({100*ratio:.0f}% hit ratio)")
+
+
+# the one instance in this process
+image_hash_cache = ImageHashCache()
+
+os.register_at_fork(after_in_child=image_hash_cache._reset_after_fork)   # pylint: disable=w0212
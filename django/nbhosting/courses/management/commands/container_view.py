@@ -0,0 +1,75 @@
+# pylint: disable=c0111, w0703
+
+import sys
+
+from django.core.management.base import BaseCommand
+
+from nbhosting.courses.model_course import CourseDir
+from nbhosting.courses.spawn import SpawnError
+from nbhosting.stats.latencies import PHASES
+
+from nbh_main.settings import logger
+
+
+class Command(BaseCommand):
+
+    help = """
+    make sure a student container is up and answers http, like edxfront does
+
+    this is what the nbh container-view-* subcommands run; the output is
+    the one of nbh, i.e. a single line on stdout with 4 tokens
+      action container port token
+    where action is 'created' or 'existing', or a failed-* keyword
+    in which case the exit code is 1; the time spent in each phase
+    is reported on stderr, for information, in a line starting with nbh-timings
+    """
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='mode', required=True)
+        notebook = subparsers.add_parser(
+            'notebook', help="copy a notebook (or clone the course) and run the container")
+        notebook.add_argument(
+            "-f", "--forcecopy", default=False, action='store_true',
+            help="overwrite the student copy of the notebook")
+        notebook.add_argument(
+            "-g", "--init-student-git", default=False, action='store_true',
+            help="initialize the student space as a git repo")
+        for mode in (notebook,
+                     subparsers.add_parser(
+                         'jupyterdir', help="for an existing student only")):
+            mode.add_argument("student")
+            mode.add_argument("course")
+        notebook.add_argument("notebook")
+        # for compatibility with nbh; the course settings are used otherwise
+        for mode in subparsers.choices.values():
+            mode.add_argument("image", nargs='?', default=None)
+        notebook.add_argument("giturl", nargs='?', default=None)
+
+    def handle(self, *args, **kwargs):
+        # we need a clean stdout
+        for handler in logger.handlers:
+            handler.setStream(sys.stderr)
+        student, coursename = kwargs['student'], kwargs['course']
+        try:
+            coursedir = CourseDir.objects.get(coursename=coursename)
+        except CourseDir.DoesNotExist:
+            print(f"failed-unknown-course {coursename}-x-{student} none none")
+            sys.exit(1)
+        spawner = coursedir.spawner(
+            student, image=kwargs['image'], giturl=kwargs.get('giturl'))
+        try:
+            if kwargs['mode'] == 'notebook':
+                spawned = spawner.open_notebook(
+                    kwargs['notebook'], forcecopy=kwargs['forcecopy'],
+                    init_student_git=kwargs['init_student_git'])
+            else:
+                spawned = spawner.open_jupyterdir()
+        except SpawnError as exc:
+            print(f"{exc.action} {spawner.container} {exc.port or 'none'} none")
+            print(exc.message, file=sys.stderr)
+            sys.exit(1)
+        print(spawned.line())
+        timings = " ".join(
+            f"{phase}={'-' if spawned.timings.get(phase) is None else spawned.timings[phase]}"
+            for phase in PHASES)
+        print(f"nbh-timings {timings}", file=sys.stderr)
@@ -0,0 +1,172 @@
+# pylint: disable=c0111, w0703
+
+import sys
+import time
+import threading
+from datetime import timedelta
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import Group
+from django.utils import timezone
+
+from nbhosting.courses.model_course import CourseDir
+from nbhosting.courses.model_session import ClassroomSession
+from nbhosting.courses.spawn import SpawnError
+from nbhosting.courses.spawnlock import SpawnLock
+
+from nbh_main.settings import logger
+
+# in minutes
+DEFAULT_LEAD = 15
+# spawns started per second
+DEFAULT_RATE = 2.
+# spawns in flight
+DEFAULT_WORKERS = 4
+# in seconds
+PROGRESS_PERIOD = 5
+
+
+class RateLimiter:
+    """
+    lets at most rate callers per second through wait()
+    """
+    def __init__(self, rate):
+        self.period = 1 / rate
+        self.lock = threading.Lock()
+        self.next = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            due = max(now, self.next)
+            self.next = due + self.period
+        time.sleep(due - now)
+
+
+class Progress:
+
+    def __init__(self, title, total):
+        self.title = title
+        self.total = total
+        self.lock = threading.Lock()
+        self.outcomes = Counter()
+        self.beg = self.last = time.monotonic()
+
+    def count(self, outcome):
+        with self.lock:
+            self.outcomes[outcome] += 1
+            now = time.monotonic()
+            if now - self.last >= PROGRESS_PERIOD:
+                self.last = now
+                self.report()
+
+    def report(self):
+        done = sum(self.outcomes.values())
+        details = " ".join(f"{outcome}={number}"
+                           for outcome, number in sorted(self.outcomes.items()))
+        print(f"{self.title}: {done}/{self.total} ({details}) "
+              f"in {time.monotonic()-self.beg:.0f}s", flush=True)
+
+
+class Command(BaseCommand):
+
+    help = """
+    spawn ahead of time the containers of the students in a group,
+    so that they are running when a classroom session starts
+
+    without arguments - typically from the nbh-prespawn timer - this deals
+    with the sessions declared in the admin pages that start within
+    the next --lead minutes, and that have not been prespawned yet
+
+    with a course and a group, this is done right away,
+    and the containers are kept for at least --lead minutes
+
+    either way the monitor does not reap these containers as idle
+    until the session starts
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-l", "--lead", type=int, default=DEFAULT_LEAD,
+            help="how many minutes before the session start")
+        parser.add_argument(
+            "-r", "--rate", type=float, default=DEFAULT_RATE,
+            help="how many spawns get started per second, at most")
+        parser.add_argument(
+            "-w", "--workers", type=int, default=DEFAULT_WORKERS,
+            help="how many spawns can be in flight, at most")
+        parser.add_argument(
+            "-n", "--dry-run", default=False, action='store_true',
+            help="only show the students")
+        parser.add_argument("coursename", nargs='?')
+        parser.add_argument("groupname", nargs='?')
+
+    def handle(self, *args, **kwargs):
+        lead = timedelta(minutes=kwargs['lead'])
+        coursename, groupname = kwargs['coursename'], kwargs['groupname']
+        options = dict(rate=kwargs['rate'], workers=kwargs['workers'],
+                       dry_run=kwargs['dry_run'])
+        if coursename:
+            if not groupname:
+                print("must provide a group with a course")
+                sys.exit(1)
+            try:
+                coursedir = CourseDir.objects.get(coursename=coursename)
+                group = Group.objects.get(name=groupname)
+            except (CourseDir.DoesNotExist, Group.DoesNotExist) as exc:
+                logger.error(f"{exc}")
+                sys.exit(1)
+            self.prespawn(coursedir, group, timezone.now() + lead, **options)
+            return
+        now = timezone.now()
+        sessions = ClassroomSession.objects.filter(
+            prespawned__isnull=True, start__gt=now, start__lte=now + lead,
+        ).order_by('start')
+        for session in sessions:
+            self.prespawn(session.coursedir, session.group, session.start, **options)
+            if not options['dry_run']:
+                session.prespawned = timezone.now()
+                session.save()
+
+    def prespawn(self, coursedir, group, fresh_until, *, rate, workers, dry_run):
+        students = sorted(user.username for user in group.user_set.all())
+        title = f"{coursedir.coursename}/{group.name}"
+        print(f"{title}: {len(students)} students, "
+              f"fresh until {fresh_until:%Y-%m-%d %H:%M %Z}", flush=True)
+        if dry_run:
+            print(" ".join(students))
+            return
+        limiter = RateLimiter(rate)
+        progress = Progress(title, len(students))
+        def one(student):
+            limiter.wait()
+            progress.count(
+                self.prespawn_student(coursedir, student, fresh_until.timestamp()))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(one, students))
+        progress.report()
+
+    @staticmethod
+    def prespawn_student(coursedir, student, fresh_until):
+        """
+        returns 'created', 'existing' or 'failed'
+        """
+        spawner = coursedir.spawner(student)
+        # the student may be opening a notebook right now
+        lock = SpawnLock(spawner.container)
+        spawned = None
+        try:
+            if lock.acquire() is not None:
+                return 'existing'
+            spawned = spawner.prespawn(fresh_until)
+            return spawned.action
+        except SpawnError as exc:
+            logger.error(f"{spawner}: {exc}")
+            return 'failed'
+        except Exception:
+            logger.exception(f"{spawner} failed")
+            return 'failed'
+        finally:
+            lock.release(spawned)
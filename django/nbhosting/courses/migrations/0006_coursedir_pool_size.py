@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 20:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('courses', '0005_alter_coursedir_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coursedir',
+            name='pool_size',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
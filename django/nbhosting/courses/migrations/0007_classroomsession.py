@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:34
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('courses', '0006_coursedir_pool_size'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClassroomSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField()),
+                ('prespawned', models.DateTimeField(blank=True, null=True)),
+                ('coursedir', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sessions', to='courses.coursedir')),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='auth.group')),
+            ],
+        ),
+    ]
@@ -33,6 +33,8 @@ from .model_track import (
     CourseTracks, write_tracks, read_tracks, sanitize_tracks)
 from .model_mapping import StaticMapping
 from .model_build import Build
+from .image_cache import image_hash_cache
+from .registry import container_registry
 
 from ..matching import matching_policy
 
@@ -53,6 +55,8 @@ class CourseDir(models.Model):                  # pylint: disable=too-many-publi
     autopull = models.BooleanField(default=False)
     archived = models.BooleanField(default=False)
     autobuild = models.BooleanField(default=False)
+    # how many warm containers to keep ready, see pool.py
+    pool_size = models.PositiveIntegerField(default=0)
 
     # staff users refer to hashes created remotely
     # so they do not match locally registered users
@@ -181,6 +185,14 @@ class CourseDir(models.Model):                  # pylint: disable=too-many-publi
         return NBHROOT / "builds" / self.coursename
     build_dir = property(_build_dir)
 
+    def _modules_dir(self):
+        return NBHROOT / "modules" / self.coursename
+    modules_dir = property(_modules_dir)
+
+    def _jupyter_dir(self):
+        return NBHROOT / "jupyter" / self.coursename
+    jupyter_dir = property(_jupyter_dir)
+
     def drop_dir(self):
         return NBHROOT / "droparea" / self.coursename
 
@@ -286,8 +298,23 @@ class CourseDir(models.Model):                  # pylint: disable=too-many-publi
         )
 
 
+    @staticmethod
+    def student_home(student):
+        return NBHROOT / "students" / student
+
     def student_dir(self, student):
-        return NBHROOT / "students" / student / self.coursename
+        return self.student_home(student) / self.coursename
+
+    def container_name(self, student):
+        return f"{self.coursename}-x-{student}"
+
+    def spawner(self, student, **kwds):
+        """
+        the object that opens notebooks for that student
+        see nbhosting.courses.spawn
+        """
+        from .spawn import Spawner
+        return Spawner(self, student, **kwds)
 
     def probe_student_notebooks(self, student):
         root = self.student_dir(student)
@@ -300,7 +327,8 @@ class CourseDir(models.Model):                  # pylint: disable=too-many-publi
 
         returns True if container was killed, False otherwise
         """
-        container_name = f"{self.coursename}-x-{student}"
+        container_name = self.container_name(student)
+        container_registry().forget(container_name)
         try:
             with podman.PodmanClient(base_url=PODMAN_URL) as podman_api:
                 podman_api.containers.get(container_name).kill()
@@ -644,16 +672,14 @@ class CourseDir(models.Model):                  # pylint: disable=too-many-publi
         the hash of the image that should be used for containers
         in this course
         or None if something goes wrong
+
+        answers are cached, see image_cache.py
         """
-        with podman.PodmanClient(base_url=PODMAN_URL) as podman_api:
-            try:
-                return podman_api.images.get(self.image).attrs['Id']
-            except podman.errors.ImageNotFound:
-                logger.error(f"Course {self.coursename} "
-                            f"uses unknown podman image {self.image}")
-            except Exception:
-                logger.exception("Can't figure image hash")
-        return None
+        hash_ = image_hash_cache.get(self.image)
+        if hash_ is None:
+            logger.error(f"Course {self.coursename} "
+                         f"could not get hash for image {self.image}")
+        return hash_
 
 
     def build_image(self, force=False, dry_run=False):
@@ -687,6 +713,7 @@ class CourseDir(models.Model):                  # pylint: disable=too-many-publi
         show_and_run(f"cd {image_dir}; "
                      f"podman build {force_tag} -f Dockerfile -t {image} .",
                      dry_run=dry_run)
+        image_hash_cache.invalidate(image)
 
     def run_image_details(self):
         """
@@ -0,0 +1,26 @@
+# pylint: disable=c0111
+
+"""
+a ClassroomSession is a group of students attending a course at a given time
+
+their containers get spawned a few minutes before the session starts,
+see the course_prespawn management command
+"""
+
+from django.db import models
+from django.contrib.auth.models import Group
+
+from .model_course import CourseDir
+
+
+class ClassroomSession(models.Model):
+
+    coursedir = models.ForeignKey(
+        CourseDir, on_delete=models.CASCADE, related_name='sessions')
+    group = models.ForeignKey(Group, on_delete=models.CASCADE)
+    start = models.DateTimeField()
+    # set once the containers have been spawned
+    prespawned = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.coursedir.coursename}/{self.group.name} at {self.start:%Y-%m-%d %H:%M}"
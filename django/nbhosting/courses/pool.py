@@ -0,0 +1,308 @@
+"""
+a pool of warm containers per course - NBHROOT/pool/<course>
+
+a cold start pays for podman creating and starting the container, and
+that is what takes tens of seconds when 200 students click at the start
+of a lecture; so for the courses that have a pool_size, the monitor keeps
+that many containers started ahead of time from the course image, and
+the spawner binds one of them to the student instead of creating one
+
+a warm container is created with
+* the name <course>-pool-<port>, and the labels nbhosting.pool=<course>
+  and nbhosting.port=<port>; the port is chosen upfront, because
+  jupyter's base url depends on it
+* the same settings as a student container, except for the workdir
+  mount that comes from a slot NBHROOT/pool/<course>/<port>; the slot
+  is a shared mount point on the host, and is mounted rslave in the
+  container, so what gets mounted on the slot later on shows up in there
+* a placeholder command instead of jupyter, that cannot change its uid
+  once started; the placeholder runs jupyter once, so its files are in
+  the page cache when it runs for real
+
+binding a warm container to a student - see bind() - means
+* claiming it, by removing its free/<port> marker - only one process can
+* bind-mounting the student workdir on the slot
+* renaming the container <course>-x-<student>
+* starting jupyter in there with podman exec, as the student uid
+
+the monitor tops up the pools at each cycle - see prune() and resize() -
+and unmounts the slots of the containers that have gone
+"""
+
+# pylint: disable=c0111, w0703
+
+import os
+import time
+import random
+import threading
+from datetime import datetime
+
+import podman
+
+from nbh_main.settings import NBHROOT, logger
+
+from .spawn import (
+    PODMAN_URL, ENTRYPOINT, free_port, container_options, update_jupyter, _run)
+
+POOL_LABEL = "nbhosting.pool"
+PORT_LABEL = "nbhosting.port"
+
+# what the warm containers run until they are bound
+PLACEHOLDER = "jupyter lab --version > /dev/null; exec sleep infinity"
+
+# how many containers get created per course and per monitor cycle
+POOL_BURST = 16
+
+# a bound container keeps the creation time of the warm one, and the
+# monitor reaps containers older than its lingering window; so warm
+# containers get recycled once older than that fraction of the window
+POOL_MAX_AGE_RATIO = 0.25
+
+
+def _creation_time(container):
+    # same formats as in MonitoredJupyter.creation_time()
+    created = container.attrs.get('Created')
+    if isinstance(created, (int, float)):
+        return created
+    return datetime.strptime(created[:-4], '%Y-%m-%dT%H:%M:%S.%f').timestamp()
+
+
+def _mounts_on(path):
+    """
+    how many mounts are stacked on path; os.path.ismount
+    can't see a bind mount from the same filesystem
+    """
+    mountpoint = str(path).replace(' ', '\\040')
+    with open("/proc/self/mounts") as feed:
+        return sum(1 for line in feed if line.split()[1] == mountpoint)
+
+
+class WarmPool:
+
+    def __init__(self, coursedir):
+        self.coursedir = coursedir
+        self.root = NBHROOT / "pool" / coursedir.coursename
+        self.free = self.root / "free"
+        self.prefix = f"{coursedir.coursename}-pool-"
+
+    def __repr__(self):
+        return f"WarmPool({self.coursedir.coursename})"
+
+    def slot(self, port):
+        return self.root / str(port)
+
+    def warm_name(self, port):
+        return f"{self.prefix}{port}"
+
+    ####################
+    def bind(self, spawner, podman_api):
+        """
+        binds a warm container to the student of spawner, whose account
+        and workdir are expected to be ready
+
+        returns (container, port), or None if the pool is empty
+        """
+        try:
+            candidates = os.listdir(self.free)
+        except FileNotFoundError:
+            return None
+        # spread the concurrent requests over the pool
+        random.shuffle(candidates)
+        for candidate in candidates:
+            try:
+                (self.free / candidate).unlink()
+            except FileNotFoundError:
+                # someone else was faster
+                continue
+            port = int(candidate)
+            try:
+                container = podman_api.containers.get(self.warm_name(port))
+            except podman.errors.NotFound:
+                continue
+            try:
+                self._bind(container, port, spawner)
+                logger.info(f"{self}: bound {self.warm_name(port)} to {spawner.container}")
+                return container, port
+            except Exception:
+                logger.exception(f"{self}: could not bind {self.warm_name(port)} "
+                                 f"to {spawner.container}")
+                self._discard(container)
+        return None
+
+    def _bind(self, container, port, spawner):
+        if container.status != 'running':
+            raise ValueError(f"warm container is {container.status}")
+        slot = self.slot(port)
+        if not _run(["mount", "--bind", str(spawner.workdir), str(slot)]):
+            raise OSError(f"cannot mount {spawner.workdir} on {slot}")
+        container.rename(spawner.container)
+        (spawner.workdir / ".port").write_text(f"{port}\n")
+        container.exec_run([ENTRYPOINT] + spawner.jupyter_command(port),
+                           user='root', detach=True)
+
+    @staticmethod
+    def _discard(container):
+        # this is on the spawn path, so don't wait for podman
+        threading.Thread(target=container.kill, daemon=True).start()
+
+    ####################
+    def prune(self, podman_api, max_age=None):
+        """
+        removes the warm containers that can't be used - not running,
+        from an outdated image, or older than max_age seconds - and
+        releases the slots of the containers that have gone
+
+        returns a tuple
+        * the list of the remaining warm containers
+        * the number of warm containers that were removed
+        """
+        containers = podman_api.containers.list(
+            all=True, filters={'label': f"{POOL_LABEL}={self.coursedir.coursename}"})
+        image_hash = self.coursedir.image_hash()
+        now = time.time()
+        warm = []
+        recycled = 0
+        # the slots in use are the ones of all the containers,
+        # including the ones that have been bound
+        in_use = set()
+        for container in containers:
+            in_use.add(container.labels.get(PORT_LABEL))
+            if not container.name.startswith(self.prefix):
+                # bound already
+                continue
+            outdated = image_hash and container.attrs.get('ImageID') != image_hash
+            old = max_age is not None and now - _creation_time(container) > max_age
+            if container.status == 'running' and not outdated and not old:
+                warm.append(container)
+                continue
+            reason = 'outdated' if outdated else 'old' if old else container.status
+            logger.info(f"{self}: recycling {container.name} ({reason})")
+            if self._claim_and_remove(container):
+                in_use.discard(container.labels.get(PORT_LABEL))
+                recycled += 1
+        try:
+            slots = [entry for entry in os.listdir(self.root) if entry.isdigit()]
+        except FileNotFoundError:
+            slots = []
+        for slot in slots:
+            if slot not in in_use:
+                self._release_slot(int(slot))
+        return warm, recycled
+
+    def resize(self, podman_api, warm, target, *, grow=True):
+        """
+        warm is the list of containers returned by prune()
+        creates or removes warm containers so there are target of them;
+        no creation if grow is false, typically under memory pressure
+
+        returns the number of warm containers
+        """
+        count = len(warm)
+        for container in warm[target:]:
+            if self._claim_and_remove(container):
+                count -= 1
+        if count >= target or not grow:
+            return count
+        update_jupyter(self.coursedir)
+        for _ in range(min(target - count, POOL_BURST)):
+            if not self._create(podman_api):
+                break
+            count += 1
+        return count
+
+    def _create(self, podman_api):
+        port = free_port()
+        slot = self.slot(port)
+        slot.mkdir(parents=True, exist_ok=True)
+        # make the slot a shared mount point
+        if not (_run(["mount", "--bind", str(slot), str(slot)])
+                and _run(["mount", "--make-shared", str(slot)])):
+            self._release_slot(port)
+            return False
+        options = container_options(
+            self.coursedir, self.warm_name(port), port, slot, propagation='rslave')
+        options.update(
+            entrypoint=["/bin/sh", "-c"],
+            labels={POOL_LABEL: self.coursedir.coursename, PORT_LABEL: str(port)})
+        try:
+            container = podman_api.containers.create(
+                self.coursedir.image, [PLACEHOLDER], **options)
+            container.start()
+        except Exception:
+            logger.exception(f"{self}: could not create {self.warm_name(port)}")
+            self._release_slot(port)
+            return False
+        self.free.mkdir(parents=True, exist_ok=True)
+        (self.free / str(port)).touch()
+        return True
+
+    def _claim_and_remove(self, container):
+        """
+        returns False if the container was bound in the meantime
+        """
+        try:
+            (self.free / container.labels[PORT_LABEL]).unlink()
+        except FileNotFoundError:
+            # not yet marked free if it has never started
+            if container.status == 'running':
+                return False
+        except KeyError:
+            pass
+        try:
+            container.remove(force=True)
+        except podman.errors.NotFound:
+            pass
+        except Exception:
+            logger.exception(f"{self}: could not remove {container.name}")
+            return True
+        if PORT_LABEL in container.labels:
+            self._release_slot(int(container.labels[PORT_LABEL]))
+        return True
+
+    def _release_slot(self, port):
+        slot = self.slot(port)
+        try:
+            (self.free / str(port)).unlink()
+        except FileNotFoundError:
+            pass
+        # the slot itself, and the student workdir if it was bound
+        for _ in range(_mounts_on(slot)):
+            if not _run(["umount", "--lazy", str(slot)]):
+                logger.error(f"{self}: could not unmount {slot}")
+                return
+        try:
+            slot.rmdir()
+        except OSError as exc:
+            logger.error(f"{self}: could not remove slot {slot} - {exc}")
+
+
+def top_up_pools(coursedirs, levels, *, grow=True, lingering=None):
+    """
+    the monitor part: for each course, the target size is its pool_size,
+    or the number of warm containers bound since the last cycle - i.e.
+    the observed demand - if larger, but no more than twice the pool_size;
+    the ones removed by prune(), e.g. after an image rebuild, are not demand
+
+    levels is a dict coursename -> number of warm containers after the
+    previous cycle, it gets updated
+
+    lingering is the monitor's, see POOL_MAX_AGE_RATIO
+    """
+    max_age = lingering * POOL_MAX_AGE_RATIO if lingering else None
+    with podman.PodmanClient(base_url=PODMAN_URL) as podman_api:
+        for coursedir in coursedirs:
+            pool = WarmPool(coursedir)
+            size = coursedir.pool_size
+            if not size and not pool.root.exists():
+                continue
+            try:
+                warm, recycled = pool.prune(podman_api, max_age)
+                bound = max(0, levels.get(coursedir.coursename, 0)
+                            - len(warm) - recycled)
+                target = min(2 * size, max(size, bound))
+                levels[coursedir.coursename] = pool.resize(
+                    podman_api, warm, target, grow=grow)
+                logger.info(f"{pool}: {levels[coursedir.coursename]}/{target} warm "
+                            f"({bound} bound and {recycled} recycled since last cycle)")
+            except Exception:
+                logger.exception(f"{pool}: could not top up")
@@ -0,0 +1,172 @@
+"""
+a registry of the running student containers: container name -> port, token
+
+this is what allows edxfront to open a notebook in a container
+that is already running, without going through the whole spawn;
+see Spawner.fast_open
+
+depending on sitesettings.container_registry, the registry is
+* 'redis': two redis hashes (the default)
+* 'local': a directory NBHROOT/registry, with one file per container
+  and one symlink per port
+* None: no registry, every open goes through the whole spawn
+in both cases it is shared by all the workers and the monitor
+
+entries are added by the spawner, and removed when a container gets
+killed, either by the monitor or from the staff pages; the reverse
+mapping port -> container is how an entry is found stale when its port
+has been given to another container; a container that crashed goes
+unnoticed though, so the users of the registry are expected to check
+that the container still answers
+"""
+
+# pylint: disable=c0111, w0703
+
+import os
+import threading
+
+from nbh_main.settings import NBHROOT, sitesettings, logger
+
+REDIS_KEY = "nbhosting:containers"
+REDIS_PORTS_KEY = "nbhosting:ports"
+# in seconds
+REDIS_TIMEOUT = 0.5
+
+
+# the format of the registry entries, also used by spawnlock.py
+def encode_port_token(port, token):
+    return f"{port} {token}"
+
+def decode_port_token(value):
+    port, token = value.split()
+    return int(port), token
+
+
+class LocalRegistry:
+
+    def __init__(self, root=None):
+        self.root = root or NBHROOT / "registry"
+        self.ports = self.root / "ports"
+
+    def get(self, container):
+        try:
+            port, token = decode_port_token((self.root / container).read_text())
+            if os.readlink(self.ports / str(port)) != container:
+                return None
+            return port, token
+        except (OSError, ValueError):
+            return None
+
+    def put(self, container, port, token):
+        try:
+            self.ports.mkdir(parents=True, exist_ok=True)
+            # the same name in all threads and processes would not do
+            temporary = f".{os.getpid()}.{threading.get_ident()}"
+            (self.root / temporary).write_text(encode_port_token(port, token))
+            os.replace(self.root / temporary, self.root / container)
+            os.symlink(container, self.ports / temporary)
+            os.replace(self.ports / temporary, self.ports / str(port))
+        except OSError as exc:
+            logger.error(f"cannot write container registry in {self.root} - {exc}")
+
+    def forget(self, container):
+        known = self.get(container)
+        try:
+            (self.root / container).unlink()
+            if known:
+                (self.ports / str(known[0])).unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as exc:
+            logger.error(f"cannot write container registry in {self.root} - {exc}")
+
+
+class RedisRegistry:
+    """
+    a failure to talk to redis is logged and means a cache miss
+    """
+
+    def __init__(self):
+        import redis
+        from redis.retry import Retry
+        from redis.backoff import NoBackoff
+        # a registry that does not answer right away is useless
+        self.redis = redis.Redis(
+            retry=Retry(NoBackoff(), 0),
+            socket_connect_timeout=REDIS_TIMEOUT, socket_timeout=REDIS_TIMEOUT)
+
+    def get(self, container):
+        try:
+            value = self.redis.hget(REDIS_KEY, container)
+            if value is None:
+                return None
+            port, token = decode_port_token(value.decode())
+            owner = self.redis.hget(REDIS_PORTS_KEY, port)
+            if owner is None or owner.decode() != container:
+                return None
+            return port, token
+        except Exception as exc:
+            logger.error(f"cannot read container registry in redis - {exc}")
+            return None
+
+    def put(self, container, port, token):
+        try:
+            with self.redis.pipeline() as pipe:
+                pipe.hset(REDIS_KEY, container, encode_port_token(port, token))
+                pipe.hset(REDIS_PORTS_KEY, port, container)
+                pipe.execute()
+        except Exception as exc:
+            logger.error(f"cannot write container registry in redis - {exc}")
+
+    def forget(self, container):
+        known = self.get(container)
+        try:
+            with self.redis.pipeline() as pipe:
+                pipe.hdel(REDIS_KEY, container)
+                if known:
+                    pipe.hdel(REDIS_PORTS_KEY, known[0])
+                pipe.execute()
+        except Exception as exc:
+            logger.error(f"cannot write container registry in redis - {exc}")
+
+
+class NoRegistry:
+
+    def get(self, container):
+        return None
+
+    def put(self, container, port, token):
+        pass
+
+    def forget(self, container):
+        pass
+
+
+# one per process, created upon first use
+_registry = None
+
+def _reset_after_fork():
+    global _registry                                        # pylint: disable=w0603
+    _registry = None
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def container_registry():
+    """
+    the registry to use, depending on sitesettings
+    """
+    global _registry                                        # pylint: disable=w0603
+    if _registry is None:
+        kind = getattr(sitesettings, 'container_registry', 'redis')
+        if kind == 'redis':
+            try:
+                _registry = RedisRegistry()
+            except ModuleNotFoundError:
+                logger.error("container_registry is 'redis' but redis is not installed")
+                _registry = LocalRegistry()
+        elif kind == 'local':
+            _registry = LocalRegistry()
+        else:
+            _registry = NoRegistry()
+    return _registry
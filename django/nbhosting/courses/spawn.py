@@ -0,0 +1,664 @@
+"""
+opening a notebook for a student, in-process
+
+this does what `nbh container-view-student-course-notebook` used to do
+from a bash subprocess, that in turn forked getent, useradd, id, podman,
+find, python3 and curl; here instead
+* the unix account is looked up with pwd, and only created when missing
+* the notebook copy and the static symlinks are done with os/shutil
+* the container is inspected and run through the podman API
+* readiness is checked with plain http requests on the container port
+
+so that a warm open - the container is already running - only costs
+a few system calls, one podman API call and one http request; and when
+the container is in the registry (see registry.py) the podman call,
+the account and jupyter config checks are skipped altogether
+
+a cold start binds a warm container from the course pool
+when there is one, see pool.py
+
+typical usage is
+
+    spawned = coursedir.spawner(student).open_notebook(notebook)
+    # spawned.action is 'existing' or 'created'
+    url = f".../{spawned.port}/...?token={spawned.token}"
+
+the nbh subcommands are kept as thin wrappers around
+the container_view_* management commands
+"""
+
+# pylint: disable=c0111, w0703
+
+import os
+import re
+import pwd
+import grp
+import time
+import shutil
+import socket
+import threading
+import subprocess
+import http.client
+from pathlib import Path
+
+import podman
+
+from nbh_main.settings import sitesettings, logger, DEBUG
+
+from .registry import container_registry
+
+# how long should we wait for the container to answer http
+# trying to create 6 containers at the exact same time : 10s is not long enough
+HTTP_TIMEOUT = 30
+# and how often we try; nbh used .4 as each attempt was a curl process
+HTTP_PERIOD = 0.1
+# how long one attempt may take; a jupyter that is starting along with
+# a whole class can take well over HTTP_PERIOD to answer
+HTTP_REQUEST_TIMEOUT = 3
+
+PODMAN_URL = "unix:///run/podman/podman.sock"
+
+# the part of the static mappings that the shell scripts can see
+STATIC_MAPPINGS = ".static-mappings"
+
+# the container layout
+JOVYAN = Path("/home/jovyan")
+# in the images, see images/start-in-dir-as-uid.sh
+ENTRYPOINT = "start-in-dir-as-uid.sh"
+
+# the epoch until which the monitor must not reap a pre-spawned container
+FRESH_LABEL = "nbhosting.fresh-until"
+
+
+class SpawnError(Exception):
+    """
+    action is one of the failed-* keywords that nbh used to print;
+    see failed_command_header in edxfront
+    """
+    def __init__(self, action, message, port=None):
+        self.action = action
+        self.message = message
+        self.port = port
+        super().__init__(f"{action}: {message}")
+
+
+class SpawnResult:
+    """
+    action is 'existing' or 'created'
+    timings is a dict phase -> ms, see stats.latencies.PHASES
+    """
+    def __init__(self, action, container, port, token, timings):
+        self.action = action
+        self.container = container
+        self.port = port
+        self.token = token
+        self.timings = timings
+
+    def line(self):
+        # what nbh used to print on stdout
+        return f"{self.action} {self.container} {self.port} {self.token}"
+
+
+def _now_ms():
+    return round(1000 * time.time())
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('', 0))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        return sock.getsockname()[1]
+
+
+def sync_tree(source, target):
+    """
+    a minimal rsync -rltp: copy the files from source whose size
+    or modification time differ in target; symlinks are copied as such
+    """
+    for dirpath, _, filenames in os.walk(source):
+        relative = Path(dirpath).relative_to(source)
+        (target / relative).mkdir(parents=True, exist_ok=True)
+        for filename in filenames:
+            sync_file(Path(dirpath) / filename, target / relative / filename)
+
+
+def sync_file(source, target):
+    """
+    returns True if the file was copied
+    """
+    if source.is_symlink():
+        link = os.readlink(source)
+        if target.is_symlink() and os.readlink(target) == link:
+            return False
+        if target.exists() or target.is_symlink():
+            target.unlink()
+        os.symlink(link, target)
+        return True
+    stat = source.stat()
+    try:
+        current = target.stat()
+        if (current.st_size == stat.st_size
+                and int(current.st_mtime) == int(stat.st_mtime)):
+            return False
+    except FileNotFoundError:
+        pass
+    shutil.copy2(source, target)
+    return True
+
+
+def chown_tree(top, uid, gid):
+    os.lchown(top, uid, gid)
+    for dirpath, dirnames, filenames in os.walk(top):
+        for name in dirnames + filenames:
+            os.lchown(os.path.join(dirpath, name), uid, gid)
+
+
+def _origin_url(repo):
+    """
+    the url of the 'origin' remote, read in .git/config
+    """
+    try:
+        config = (repo / ".git" / "config").read_text()
+    except OSError:
+        return None
+    match = re.search(r'^\s*\[remote "origin"\][^\[]*?^\s*url\s*=\s*(\S+)',
+                      config, re.MULTILINE)
+    return match.group(1) if match else None
+
+
+def _run(command, **kwds):
+    """
+    for the few things that still need a subprocess,
+    typically the first time around for a student
+    """
+    completed = subprocess.run(
+        command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True, check=False, **kwds)
+    if completed.stdout:
+        logger.info(f"{' '.join(command)}: {completed.stdout.strip()}")
+    return completed.returncode == 0
+
+
+def update_jupyter(coursedir):
+    """
+    the jupyter config area for the course is made of 3 layers
+    see --course-update-jupyter in nbh for details
+    """
+    course_jupyter = coursedir.jupyter_dir
+    template = coursedir.jupyter_dir.parent / ".template"
+    course_nbhosting = coursedir.git_dir / ".nbhosting"
+    course_jupyter.mkdir(parents=True, exist_ok=True)
+    # temporary: start with the old names
+    # the new names will take precedence
+    for path in ("nbconfig/notebook.json", "labconfig/default_setting_overrides.json"):
+        if (course_nbhosting / path).is_file():
+            (course_jupyter / path).parent.mkdir(parents=True, exist_ok=True)
+            sync_file(course_nbhosting / path, course_jupyter / path)
+    # apply the 3 layers
+    sync_tree(template, course_jupyter)
+    if (course_nbhosting / "jupyter").is_dir():
+        sync_tree(course_nbhosting / "jupyter", course_jupyter)
+    sync_file(template / "jupyter_notebook_config.py",
+              course_jupyter / "jupyter_notebook_config.py")
+
+
+def container_options(coursedir, name, port, workdir, *, propagation=None):
+    """
+    the podman settings, see run-container-for-student-in-course in nbh
+    for the rationale behind each of them; propagation applies to the
+    workdir mount, see pool.py
+    """
+    def bind(source, target, read_only=False):
+        return dict(type='bind', source=str(source), target=str(target),
+                    read_only=read_only)
+    # mount the files under the course jupyter area individually as ro
+    # this way the container can create other files in this area
+    mounts = [bind(config, JOVYAN / ".jupyter" / config.relative_to(coursedir.jupyter_dir),
+                   read_only=True)
+              for config in sorted(coursedir.jupyter_dir.rglob("*"))
+              if config.is_file()]
+    work = bind(workdir, JOVYAN / "work")
+    if propagation:
+        work['propagation'] = propagation
+    mounts += [
+        work,
+        bind(coursedir.modules_dir, JOVYAN / "modules", read_only=True),
+        bind(coursedir.static_dir, JOVYAN / "static", read_only=True),
+    ]
+    # for using jlab/git from inside a student container
+    # student repos have their remote set to the normalized path
+    # but NBHROOT as seen from the shell might be a symlink
+    git_dirs = {Path(sitesettings.nbhroot) / "courses-git" / coursedir.coursename,
+                coursedir.norm_git_dir}
+    mounts += [bind(git_dir, git_dir, read_only=True) for git_dir in sorted(git_dirs)]
+    options = dict(
+        name=name,
+        ports={'8888/tcp': port},
+        user='root',
+        # conservative; allows to remove error messages
+        cap_add=['CAP_AUDIT_WRITE'],
+        # the jupyter images have had a default entrypoint that was not
+        # compatible with our start-in-dir-as-uid.sh; podman-py drops
+        # an empty entrypoint, so the script is the entrypoint
+        entrypoint=[ENTRYPOINT],
+        remove=True,
+        environment=dict(
+            NBAUTOEVAL_LOG=str(JOVYAN / "work" / ".nbautoeval"),
+            PYTHONPATH=str(JOVYAN / "modules"),
+        ),
+        mounts=mounts,
+    )
+    max_memory = str(getattr(sitesettings, 'container_max_memory', 0) or 0)
+    if max_memory != "0":
+        options['mem_limit'] = max_memory
+    return options
+
+
+class Spawner:
+
+    def __init__(self, coursedir, student, *, image=None, giturl=None):
+        self.coursedir = coursedir
+        self.student = student
+        self.image = image or coursedir.image
+        # only used for a git repo in the student space
+        # which is cloned from the local course git for lower delays
+        self.giturl = giturl or str(coursedir.git_dir)
+        self.container = coursedir.container_name(student)
+        self.home = coursedir.student_home(student)
+        self.workdir = coursedir.student_dir(student)
+        # the unix account
+        self.uid, self.gid = None, None
+
+    def __repr__(self):
+        return f"Spawner({self.container})"
+
+    ####################
+    def open_notebook(self, notebook, *, forcecopy=False, init_student_git=False):
+        """
+        makes sure the student has a copy of notebook, or a git repo
+        if init_student_git is set, and a running container
+
+        returns a SpawnResult, raises SpawnError
+        """
+        spawned = self.fast_open(notebook, forcecopy=forcecopy,
+                                 init_student_git=init_student_git)
+        if spawned:
+            return spawned
+        self._check_course()
+        beg = _now_ms()
+        self.add_student()
+        added = _now_ms()
+        if not init_student_git:
+            self.copy_notebook(notebook, forcecopy=forcecopy)
+        else:
+            self.git_repo()
+        copied = _now_ms()
+        self._make_workdir()
+        timings = dict(account=added-beg, copy=copied-added)
+        return self.run_container(timings)
+
+    def open_jupyterdir(self):
+        """
+        same, for a student who is expected to exist already
+        """
+        self._check_course()
+        try:
+            pwd.getpwnam(self.student)
+        except KeyError:
+            raise SpawnError(
+                'failed-unknown-student',
+                f"refusing to open jupyterdir session for unknown student {self.student}")
+        self.add_student()
+        self._make_workdir()
+        return self.run_container({})
+
+    def prespawn(self, fresh_until):
+        """
+        for classroom sessions: prepares the student space as a git repo,
+        like in classroom mode, and runs the container ahead of time;
+        fresh_until is an epoch, see FRESH_LABEL
+        """
+        self._check_course()
+        beg = _now_ms()
+        self.add_student()
+        added = _now_ms()
+        self.git_repo()
+        copied = _now_ms()
+        self._make_workdir()
+        timings = dict(account=added-beg, copy=copied-added)
+        return self.run_container(timings, fresh_until=fresh_until)
+
+    def fast_open(self, notebook, *, forcecopy=False, init_student_git=False,
+                  known=None):
+        """
+        when the container is known in the registry to be running,
+        only copy the notebook if needed and check that it answers;
+        known is an optional (port, token) to use instead of the registry,
+        typically obtained from a concurrent spawn, see spawnlock.py
+
+        returns a SpawnResult, or None if the whole spawn is needed
+        """
+        registry = container_registry()
+        known = known or registry.get(self.container)
+        if known is None:
+            return None
+        port, token = known
+        beg = _now_ms()
+        # the student space has been set up already
+        if init_student_git and not (self.workdir / ".git").is_dir():
+            return None
+        # the registry does not know about containers that have crashed,
+        # or that were re-created from another worker
+        try:
+            stale = int((self.workdir / ".port").read_text()) != port
+        except (OSError, ValueError):
+            stale = True
+        if stale:
+            logger.info(f"{self}: stale registry entry on port {port}")
+            registry.forget(self.container)
+            return None
+        if not init_student_git:
+            account = pwd.getpwnam(self.student)
+            self.uid, self.gid = account.pw_uid, account.pw_gid
+            self.copy_notebook(notebook, forcecopy=forcecopy)
+        copied = _now_ms()
+        # one attempt, but give a busy jupyter some time to answer
+        if not self.wait_for_http(port, token, timeout=0, request_timeout=1):
+            logger.info(f"{self}: registered on port {port} but not answering")
+            registry.forget(self.container)
+            return None
+        timings = dict(account=None, copy=copied-beg,
+                       run=None, http=_now_ms()-copied)
+        return SpawnResult('existing', self.container, port, token, timings)
+
+    ####################
+    def _check_course(self):
+        if not self.coursedir.notebooks_dir.is_dir():
+            raise SpawnError('failed-unknown-course',
+                             f"No such course {self.coursedir.coursename}")
+
+    def add_student(self):
+        """
+        creates the unix account (disabled) if needed
+        """
+        self.home.parent.mkdir(parents=True, exist_ok=True)
+        # when swapping back and forth between dev and prod
+        # we may have a home dir already created  - by rsyncing data
+        # during the swap - while the user in question is not yet known
+        # in /etc/passwd; this is why we manage homedir creation explicitly
+        self.home.mkdir(exist_ok=True)
+        try:
+            account = pwd.getpwnam(self.student)
+        except KeyError:
+            account = self._create_account()
+        self.uid, self.gid = account.pw_uid, account.pw_gid
+        # nbh used to chown -R the home dir each time; do it
+        # only when the home dir does not belong to the student
+        stat = self.home.stat()
+        if (stat.st_uid, stat.st_gid) != (self.uid, self.gid):
+            chown_tree(self.home, self.uid, self.gid)
+
+    def _create_account(self):
+        # default strategy is to create corresponding group
+        # in some rare conditions that group may already exist, use it then
+        try:
+            grp.getgrnam(self.student)
+            group_options = ["-g", self.student]
+        except KeyError:
+            group_options = ["--user-group"]
+        logger.info(f"Creating disabled login {self.student}")
+        if not (_run(["useradd", *group_options, "--no-create-home",
+                      "--home-dir", str(self.home), self.student])
+                # disable login
+                and _run(["usermod", "-L", self.student])):
+            # something wrong happened, typically /etc/login.defs misconfigured
+            raise SpawnError('failed-cannot-add-student-in-course',
+                             f"Failed to create login {self.student}")
+        return pwd.getpwnam(self.student)
+
+    def _make_workdir(self):
+        if not self.workdir.exists():
+            self.workdir.mkdir(parents=True)
+            os.chown(self.workdir, self.uid, self.gid)
+
+    def _mkdir_as_student(self, directory):
+        if directory.is_dir():
+            return
+        self._mkdir_as_student(directory.parent)
+        directory.mkdir()
+        os.chown(directory, self.uid, self.gid)
+
+    def copy_notebook(self, notebook, *, forcecopy=False):
+        course_notebook = self.coursedir.notebooks_dir / notebook
+        student_notebook = self.workdir / notebook
+        # copy if student notebook is missing, or if force is requested
+        if not student_notebook.is_file() or forcecopy:
+            self._mkdir_as_student(student_notebook.parent)
+            logger.info(f"Cloning {student_notebook} from {course_notebook} "
+                        f"({forcecopy=})")
+            # preserve modification time and mode like rsync -tp
+            shutil.copy2(course_notebook, student_notebook)
+            os.chown(student_notebook, self.uid, self.gid)
+        # do this no matter what for easier deployment
+        self._static_symlinks(student_notebook.parent)
+
+    def _static_symlinks(self, directory):
+        """
+        create symlinks right where the notebook is, not only at the top
+        """
+        try:
+            mappings = (self.coursedir.notebooks_dir / STATIC_MAPPINGS).read_text().split()
+        except FileNotFoundError:
+            return
+        for mapping in mappings:
+            # expose() uses :: to separate
+            from_top, _, local = mapping.partition('::')
+            destination = str(JOVYAN / "static" / from_top)
+            symlink = directory / local
+            try:
+                if os.readlink(symlink) == destination:
+                    continue
+                symlink.unlink()
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # not a symlink
+                symlink.unlink()
+            logger.info(f"creating static symlink {symlink}")
+            os.symlink(destination, symlink)
+
+    def git_repo(self):
+        toplevel = self.workdir
+        # not existing at all, the easy case
+        if not toplevel.is_dir():
+            self._git_clone(toplevel)
+        elif not (toplevel / ".git").is_dir():
+            logger.info(f"found student dir {toplevel} without a .git needs rescue")
+            self._git_clone(toplevel)
+        # else we should be good; however because of the change introduced in 0.21
+        # when needed, we overwrite the 'origin' remote url
+        # to point at the local directory under courses-git
+        elif _origin_url(toplevel) != self.giturl:
+            logger.info(f"fixing remote.origin.url for 0.21 in {toplevel}")
+            _run(["git", "-C", str(toplevel), "config", "remote.origin.url", self.giturl],
+                 user=self.uid, group=self.gid)
+
+    def _git_clone(self, dest):
+        """
+        git clone into a directory that might be non empty
+        instead of doing n times sudo, do all as root and chown the result once completed
+        """
+        dest.mkdir(parents=True, exist_ok=True)
+        def git(*args):
+            return _run(["git", "-C", str(dest), *args])
+        ok = (git("init") and git("remote", "add", "origin", self.giturl)
+              and git("fetch")
+              # this command will create origin/HEAD
+              and git("remote", "set-head", "origin", "-a"))
+        if ok:
+            completed = subprocess.run(
+                ["git", "-C", str(dest), "symbolic-ref", "refs/remotes/origin/HEAD", "--short"],
+                stdout=subprocess.PIPE, universal_newlines=True, check=False)
+            branch = completed.stdout.strip().split('/', 1)[-1]
+            # this is to preserve the local files that were possibly
+            # already present before the git init
+            ok = git("switch", branch)
+        chown_tree(dest, self.uid, self.gid)
+        if not ok:
+            logger.error(f"could not clone {self.giturl} into {dest}")
+
+    ####################
+    def update_jupyter(self):
+        update_jupyter(self.coursedir)
+
+    def run_container(self, timings, *, fresh_until=None):
+        """
+        reuse the container if it is running, create it otherwise;
+        timings gets the 'run' and 'http' phases
+        a container created with fresh_until is not taken from the pool,
+        that is meant for the students who show up unannounced
+        """
+        run_beg = _now_ms()
+        timings.update(run=None, http=None)
+        self.update_jupyter()
+        token = self.container
+        with podman.PodmanClient(base_url=PODMAN_URL) as podman_api:
+            try:
+                container = podman_api.containers.get(self.container)
+            except podman.errors.NotFound:
+                container = None
+
+            if container is not None:
+                action = 'existing'
+                port = self._existing_port(container)
+            else:
+                action = 'created'
+                # a warm container from the course pool if possible
+                bound = None if fresh_until else self._from_pool(podman_api)
+                if bound:
+                    container, port = bound
+                else:
+                    labels = {FRESH_LABEL: str(int(fresh_until))} if fresh_until else None
+                    container, port = self._create_container(podman_api, labels)
+
+            # still need to wait for it; in classroom mode in particular
+            # it is frequent that students quickly click on another notebook
+            timings['run'] = _now_ms() - run_beg
+            if not self.wait_for_http(port, token):
+                self._show_logs(container)
+                raise SpawnError('failed-timeout',
+                                 f"{self.container} not answering on port {port}",
+                                 port=port)
+            timings['http'] = _now_ms() - run_beg - timings['run']
+        container_registry().put(self.container, port, token)
+        return SpawnResult(action, self.container, port, token, timings)
+
+    def _from_pool(self, podman_api):
+        # the pool runs the course image
+        if not self.coursedir.pool_size or self.image != self.coursedir.image:
+            return None
+        from .pool import WarmPool
+        return WarmPool(self.coursedir).bind(self, podman_api)
+
+    def _create_container(self, podman_api, labels=None):
+        if not podman_api.images.exists(self.image):
+            raise SpawnError('failed-unknown-image',
+                             f"image {self.image} not known to podman")
+        port = free_port()
+        # store it
+        (self.workdir / ".port").write_text(f"{port}\n")
+        logger.info(f"Creating podman container {self.container}")
+        options = self._options(port)
+        if labels:
+            options['labels'] = labels
+        container = podman_api.containers.create(
+            self.image, self.jupyter_command(port), **options)
+        container.start()
+        return container, port
+
+    def _existing_port(self, container):
+        status = container.status
+        if status == 'removing':
+            # out of luck here, we're trying to open a notebook
+            # while monitor has just killed the container
+            # tell the user to try again later
+            raise SpawnError('failed-garbage-collecting',
+                             f"{self.container} is being removed")
+        # the 'created' status has been observed only on transient
+        # containers while troubleshooting podman runs hanging
+        if status not in ('running', 'created'):
+            # a sequel of nbhosting <= 0.23 - since 0.24 we run the containers
+            # with --rm, so remove it so next time it will no longer be in the way
+            logger.info(f"removing container {self.container} for compatibility")
+            threading.Thread(target=container.remove, kwargs=dict(force=True),
+                             daemon=True).start()
+            raise SpawnError('failed-stopped-container',
+                             f"{self.container} is {status}")
+        try:
+            return int((self.workdir / ".port").read_text())
+        except (OSError, ValueError):
+            raise SpawnError('failed-cannot-retrieve-port',
+                             f"no port for {self.container}")
+
+    def jupyter_command(self, port):
+        # see start-in-dir-as-uid.sh for a note on setting the directories below
+        # SECURITY notice: as of 2020 03 27, the token, password and
+        # disable_check_xsrf settings replace --NotebookApp.token=<token>
+        # so that recent chrome browsers with the new SameSite policy
+        # can still open a notebook; see nbh for details
+        command = [
+            str(JOVYAN), str(self.uid),
+            "jupyter", "lab",
+            "--ip=0.0.0.0",
+            "--no-browser",
+            f"--NotebookApp.notebook_dir={JOVYAN / 'work'}",
+            f"--NotebookApp.base_url=/{port}/",
+            "--NotebookApp.token=",
+            "--NotebookApp.password=",
+            "--NotebookApp.disable_check_xsrf=True",
+        ]
+        if DEBUG:
+            command.append("--log-level=DEBUG")
+        return command
+
+    def _options(self, port):
+        return container_options(self.coursedir, self.container, port, self.workdir)
+
+    @staticmethod
+    def wait_for_http(port, token, timeout=HTTP_TIMEOUT, period=HTTP_PERIOD,
+                      request_timeout=HTTP_REQUEST_TIMEOUT):
+        """
+        returns True as soon as something answers http on that port
+
+        each attempt gets request_timeout, but no more than what is left
+        of timeout; the first attempt always gets request_timeout, so
+        timeout=0 means exactly one attempt
+        period is how long we sleep between attempts
+        """
+        beg = time.time()
+        deadline = beg + timeout
+        while True:
+            remaining = deadline - time.time()
+            attempt = min(request_timeout, remaining) if remaining > 0 else request_timeout
+            connection = http.client.HTTPConnection("localhost", port, timeout=attempt)
+            try:
+                connection.request("GET", f"/tree?token={token}")
+                connection.getresponse().read()
+                logger.info(f"HTTP/{port} up after {time.time()-beg:.2f}s")
+                return True
+            except (OSError, http.client.HTTPException) as exc:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logger.error(f"giving up on HTTP/{port} - last attempt said {exc}")
+                    return False
+                time.sleep(min(period, remaining))
+            finally:
+                connection.close()
+
+    def _show_logs(self, container):
+        try:
+            logs = b"".join(container.logs(timestamps=True, since=int(time.time()) - 60))
+            logger.error(f"{20*'='} podman logs on {self.container} over the last minute\n"
+                         f"{logs.decode(errors='replace')}")
+        except Exception:
+            logger.exception(f"could not get logs for {self.container}")
@@ -0,0 +1,178 @@
+"""
+serializing the concurrent opens of the same container
+
+a student who clicks on several notebooks in a row, or a course page
+that embeds several notebooks, results in several workers trying to
+spawn the same container at the same time; only one of them - the owner -
+actually spawns it, the other ones - the waiters - block until it is done,
+and then reuse the port and token that the owner has obtained
+
+this relies on redis
+* the lock is a key set with SET NX PX, whose value is a random token
+  that identifies the owner; it is released with a Lua script, so that
+  an owner whose lock has expired cannot release someone else's
+* upon release the owner publishes the port and token on a channel
+  that the waiters are subscribed to; the same goes in a short-lived key,
+  for the waiters that subscribe after the release
+* a failed spawn publishes an empty message, and the waiters
+  compete for the lock again
+
+without redis - typically in devel mode - there is no lock at all
+"""
+
+# pylint: disable=c0111, w0703
+
+import os
+import time
+import secrets
+
+from nbh_main.settings import logger, DEBUG
+
+from .registry import REDIS_TIMEOUT, encode_port_token, decode_port_token
+
+LOCK_KEY = "nbhosting:spawning:{container}"
+RESULT_KEY = "nbhosting:spawned:{container}"
+# channels do not share the keys namespace
+CHANNEL = "nbhosting:spawned:{container}"
+
+# how long a spawn can take - see spawn.HTTP_TIMEOUT - with some margin;
+# this is also how long a waiter waits at most
+LOCK_TTL = 60
+# the result is only needed by the waiters that subscribe late
+RESULT_TTL = 10
+
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('del', KEYS[1])
+if ARGV[2] ~= '' then
+    redis.call('set', KEYS[2], ARGV[2], 'px', ARGV[3])
+else
+    redis.call('del', KEYS[2])
+end
+redis.call('publish', ARGV[4], ARGV[2])
+return 1
+"""
+
+
+# one per process, created upon first use
+_redis = None
+_release = None
+
+def _reset_after_fork():
+    global _redis, _release                                 # pylint: disable=w0603
+    _redis = _release = None
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _redis_client():
+    """
+    None if redis is not installed, which is only acceptable in devel mode
+    """
+    global _redis, _release                                 # pylint: disable=w0603
+    if _redis is None:
+        try:
+            import redis
+            from redis.retry import Retry
+            from redis.backoff import NoBackoff
+        except ModuleNotFoundError:
+            # make sure this error does not go unnoticed in production
+            if not DEBUG:
+                raise
+            return None
+        _redis = redis.Redis(
+            retry=Retry(NoBackoff(), 0),
+            socket_connect_timeout=REDIS_TIMEOUT, socket_timeout=REDIS_TIMEOUT)
+        _release = _redis.register_script(RELEASE_SCRIPT)
+    return _redis
+
+
+class SpawnLock:
+    """
+    typical usage is
+
+        lock = SpawnLock(container)
+        shared = lock.acquire()
+        try:
+            if shared is None:
+                # spawn the container
+            else:
+                port, token = shared
+        finally:
+            lock.release(spawned)
+
+    a failure to talk to redis is logged, and the caller goes ahead
+    as if it owned the lock
+    """
+
+    def __init__(self, container):
+        self.container = container
+        self.owner = secrets.token_hex(8)
+        self.owned = False
+        self.lock_key = LOCK_KEY.format(container=container)
+        self.result_key = RESULT_KEY.format(container=container)
+        self.channel = CHANNEL.format(container=container)
+
+    def __repr__(self):
+        return f"SpawnLock({self.container})"
+
+    def acquire(self, timeout=LOCK_TTL):
+        """
+        returns None when the caller is to spawn the container,
+        normally because it now owns the lock;
+        or (port, token) as obtained by a concurrent spawn
+        """
+        client = _redis_client()
+        if client is None:
+            return None
+        deadline = time.monotonic() + timeout
+        try:
+            with client.pubsub(ignore_subscribe_messages=True) as pubsub:
+                subscribed = False
+                while True:
+                    if client.set(self.lock_key, self.owner,
+                                  nx=True, px=1000 * LOCK_TTL):
+                        self.owned = True
+                        return None
+                    if not subscribed:
+                        pubsub.subscribe(self.channel)
+                        subscribed = True
+                        # the owner may have released in the meantime
+                        if not client.exists(self.lock_key):
+                            shared = client.get(self.result_key)
+                            if shared:
+                                return decode_port_token(shared.decode())
+                            continue
+                        logger.info(f"{self}: waiting for a concurrent spawn")
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        logger.warning(f"{self}: giving up waiting after {timeout}s")
+                        return None
+                    message = pubsub.get_message(timeout=remaining)
+                    if message is None:
+                        continue
+                    if message['data']:
+                        return decode_port_token(message['data'].decode())
+                    # the concurrent spawn has failed, let us try ourselves
+        except Exception as exc:
+            logger.error(f"{self}: cannot use redis - {exc}")
+            return None
+
+    def release(self, spawned=None):
+        """
+        spawned is the SpawnResult if the spawn was successful
+        """
+        if not self.owned:
+            return
+        self.owned = False
+        shared = encode_port_token(spawned.port, spawned.token) if spawned else ''
+        try:
+            released = _release(
+                keys=[self.lock_key, self.result_key],
+                args=[self.owner, shared, 1000 * RESULT_TTL, self.channel])
+            if not released:
+                logger.warning(f"{self}: lock had expired before the spawn was over")
+        except Exception as exc:
+            logger.error(f"{self}: cannot release in redis - {exc}")
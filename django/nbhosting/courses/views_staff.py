@@ -179,6 +179,7 @@ def staff_course_update(request, course):
             coursedir.autopull = form.cleaned_data['autopull']
             coursedir.archived = form.cleaned_data['archived']
             coursedir.autobuild = form.cleaned_data['autobuild']
+            coursedir.pool_size = form.cleaned_data['pool_size'] or 0
             coursedir.image = form.cleaned_data['image']
             coursedir.staff_usernames = form.cleaned_data['staff_usernames']
             coursedir.save()
@@ -192,6 +193,7 @@ def staff_course_update(request, course):
             initial=dict(
                 autopull=coursedir.autopull,
                 autobuild=coursedir.autobuild,
+                pool_size=coursedir.pool_size,
                 archived=coursedir.archived,
                 image=coursedir.image,
                 staff_usernames="\n".join(coursedir.staff_usernames.split()),
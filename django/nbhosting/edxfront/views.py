@@ -7,7 +7,6 @@ import re
 
 import pickle
 import time
-import itertools
 
 
 from http import HTTPStatus
@@ -17,6 +16,8 @@ from django.http import HttpResponseRedirect, JsonResponse, HttpResponseForbidde
 from nbh_main.settings import sitesettings
 from nbh_main.settings import logger, DEBUG
 from nbhosting.courses.model_course import CourseDir, JLAB_NOTEBOOK_URL_FORMAT
+from nbhosting.courses.spawn import SpawnError
+from nbhosting.courses.spawnlock import SpawnLock
 from nbhosting.stats.stats import Stats
 
 from nbhosting.version import __version__ as nbh_version
@@ -72,6 +73,12 @@ def failed_command_message(command_str, completed, prefix=None):
     return result
 
 
+def spawn_error_message(spawner, exc):
+    return (f"failed to spawn notebook container\n"
+            f"{spawner}\n"
+            f"{type(exc).__name__}: {exc}")
+
+
 def failed_command_header(action):
     if action == 'failed-garbage-collecting':
         return 'Please try again later'
@@ -83,6 +90,8 @@ def failed_command_header(action):
         return 'Your container is taking too long to answer'
     elif action == 'failed-unknown-image':
         return 'Image not found for course'
+    elif action == 'failed-unknown-course':
+        return 'Course not found'
     else:
         # failed-cannot-add-student-in-course
         # failed-unknown-student $student
@@ -250,90 +259,36 @@ def _open_notebook(request, coursename, student, notebook,
                           msg, header="notebook not found")
 
 
-    # deal with concurrent requests on the same container
-    # by using a shared memory (a redis cache)
-    # starting_containers is the cache name
-    # as configured in nbhosting.ini(.in)
-
-    # in devel mode we don't have redis
-    redis_cache = None
-    try:
-
-        import redis
-        idling = 0.5
-        # just a safety in case our code would not release stuff properly
-        expire_in_s = 15
-
-        def my_repr(timedelta):
-            return f"{timedelta.seconds}s {timedelta.microseconds}µs"
-
-        redis_cache = redis.Redis()
-        container = f'{coursename}-x-{student}'
-        for attempt in itertools.count(1):
-            already = redis_cache.get(container)
-
-            # good to go
-            if not already:
-                logger.info(f"{attempt=} going ahead with {container=} and {notebook=}")
-                redis_cache.set(container, b'1')
-                redis_cache.expire(container, expire_in_s)
-                break
-
-            # has the stored token expired ?
-            logger.info(f"{attempt=} waiting for {idling=} because {container} is being started"
-                        f"with {container=} and {notebook=}")
-            time.sleep(idling)
-    except ModuleNotFoundError:
-        # make sure this error does not go unnoticed in production
-        if not DEBUG:
-            raise
-        else:
-            pass
-
-
-    subcommand = 'container-view-student-course-notebook'
-
-    # build command
-    command = ['nbh', '-d', sitesettings.nbhroot]
-    if DEBUG:
-        command.append('-x')
-    command.append(subcommand)
-    # propagate the forcecopy flag for reset_from_origin
-    if forcecopy:
-        command.append('-f')
-    # propagate that a git initialization was requested
-    # forcecopy has no effect in this case
-    if init_student_git:
-        command.append('-g')
-        # a student repo gets cloned from local course git
-        # for lower delays when updating, and removing issues
-        # like accessing private repos from the students space
-        ref_giturl = str(coursedir.git_dir)
-    else:
-        ref_giturl = coursedir.giturl
-
-    # add arguments to the subcommand
-    command += [student, coursename, notebook_with_ext,
-                coursedir.image, ref_giturl]
-    command_str = " ".join(command)
-    logger.info(f'edxfront is running (DEBUG={DEBUG}): {command_str}')
-    completed = subprocess.run(
-        command, universal_newlines=True,
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    log_completed_process(completed, subcommand)
-
+    spawner = coursedir.spawner(student)
+    logger.info(f'edxfront is spawning (DEBUG={DEBUG}): {spawner} for {notebook_with_ext}'
+                f' ({forcecopy=}, {init_student_git=})')
+    # deal with concurrent requests on the same container:
+    # only one spawns it, the other ones wait and reuse its port and token
+    lock = SpawnLock(spawner.container)
+    spawned = None
+    beg = time.time()
     try:
-        action, _container_name, actual_port, jupyter_token = completed.stdout.split()
-
-        if completed.returncode != 0 or action.startswith("failed"):
-            message = failed_command_message(
-                command_str, completed, prefix="failed to spawn notebook container")
-            header = failed_command_header(action)
-            return error_page(
-                request, coursename, student, notebook, message, header)
+        while spawned is None:
+            shared = lock.acquire()
+            if shared is None:
+                spawned = spawner.open_notebook(
+                    notebook_with_ext, forcecopy=forcecopy,
+                    init_student_git=init_student_git)
+            else:
+                # None if the container has gone in the meantime
+                spawned = spawner.fast_open(
+                    notebook_with_ext, forcecopy=forcecopy,
+                    init_student_git=init_student_git, known=shared)
+        duration_ms = round(1000 * (time.time() - beg))
+        logger.info(f"{spawner} -> {spawned.line()} in {duration_ms} ms")
+        actual_port, jupyter_token = spawned.port, spawned.token
 
         # remember that in events file for statistics
-        Stats(coursename).record_open_notebook(student, notebook, action, actual_port)
+        stats = Stats(coursename)
+        stats.record_open_notebook(student, notebook, spawned.action, actual_port)
+        # and how long it took
+        stats.record_open_latency(student, notebook, spawned.action, duration_ms,
+                                  spawned.timings)
         # redirect with same proto (http or https) as incoming
         scheme = request.scheme
         # get the host part of the incoming URL
@@ -362,15 +317,18 @@ def _open_notebook(request, coursename, student, notebook,
         logger.info(f"edxfront: redirecting to {url}")
         return HttpResponseRedirect(url)
 
+    except SpawnError as exc:
+        message = spawn_error_message(spawner, exc)
+        header = failed_command_header(exc.action)
+        return error_page(
+            request, coursename, student, notebook, message, header)
     except Exception as exc:
-        prefix = (f"exception when parsing output of nbh {subcommand}\n"
-                   f"{type(exc)}: {exc}")
-        message = failed_command_message(command_str, completed, prefix=prefix)
+        logger.exception(f"{spawner} failed")
+        message = spawn_error_message(spawner, exc)
         return error_page(
             request, coursename, student, notebook, message)
     finally:
-        if redis_cache:
-            redis_cache.delete(container)
+        lock.release(spawned)
 
 
 def share_notebook(request, course, student, notebook):
@@ -491,38 +449,11 @@ def _jupyterdir_forward(request, coursename, student, jupyter_url):
             f"no such coursename {coursename}"
         )
 
-    # nbh's subcommand
-    subcommand = 'container-view-student-course-jupyterdir'
-
-    # build command
-    command = ['nbh', '-d', sitesettings.nbhroot]
-    if DEBUG:
-        command.append('-x')
-    command.append(subcommand)
-
-    # add arguments to the subcommand
-    command += [student, coursename, coursedir.image]
-    command_str = " ".join(command)
-    logger.info(f"Running command {command_str}")
-    completed = subprocess.run(
-        command, universal_newlines=True,
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    log_completed_process(completed, subcommand)
-
-    if completed.returncode != 0:
-        message = failed_command_message(command_str, completed)
-        return error_page(
-            request, coursename, student, "jupyterdir", message)
-
+    spawner = coursedir.spawner(student)
+    logger.info(f"jupyterdir_forward is spawning {spawner}")
     try:
-        action, _container_name, actual_port, jupyter_token = completed.stdout.split()
-
-        if completed.returncode != 0 or action.startswith("failed"):
-            message = failed_command_message(
-                command_str, completed, prefix="failed to spawn notebook container")
-            header = failed_command_header(action)
-            return error_page(
-                request, coursename, student, "n/a", message, header)
+        spawned = spawner.open_jupyterdir()
+        actual_port, jupyter_token = spawned.port, spawned.token
 
         # remember that in events file for statistics
         # not yet implemented on the Stats side
@@ -545,10 +476,14 @@ def _jupyterdir_forward(request, coursename, student, jupyter_url):
         logger.info(f"jupyterdir_forward: redirecting to {url}")
         return HttpResponseRedirect(url)
 
+    except SpawnError as exc:
+        message = spawn_error_message(spawner, exc)
+        header = failed_command_header(exc.action)
+        return error_page(
+            request, coursename, student, "n/a", message, header)
     except Exception as exc:
-        prefix = (f"exception when parsing output of nbh {subcommand}\n"
-                   f"{type(exc)}: {exc}")
-        message = failed_command_message(command_str, completed, prefix=prefix)
+        logger.exception(f"{spawner} failed")
+        message = spawn_error_message(spawner, exc)
         return error_page(
             request, coursename, student, "jupyterdir", message)
 
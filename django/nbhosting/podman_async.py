@@ -0,0 +1,135 @@
+"""
+a minimal asynchronous client for the podman (libpod) REST API
+
+podman-py is synchronous, so using it from a coroutine blocks the whole
+event loop; this module talks to the same unix socket through aiohttp,
+and exposes only the few calls that nbhosting needs
+
+typical usage is
+
+    async with AsyncPodman() as podman_api:
+        inspection = await podman_api.inspect_container(name)
+"""
+
+# pylint: disable=c0111
+
+import json
+from urllib.parse import quote
+
+import aiohttp
+
+PODMAN_SOCKET = "/run/podman/podman.sock"
+# the host part is ignored when talking over a unix socket
+PODMAN_API = "http://d/v4.0.0/libpod"
+
+# how many requests can be in flight on the socket at the same time
+DEFAULT_PODMAN_CONCURRENCY = 16
+# timeout in seconds for one API call
+DEFAULT_PODMAN_TIMEOUT = 30
+
+
+class AsyncPodmanError(Exception):
+    """
+    the podman API answered with an error code
+    """
+    def __init__(self, status, message):
+        self.status = status
+        self.message = message
+        super().__init__(f"podman API error {status}: {message}")
+
+
+class AsyncPodmanNotFound(AsyncPodmanError):
+    """
+    typically the container or image does not exist (any longer)
+    """
+
+
+class AsyncPodman:
+
+    def __init__(self, socket_path=PODMAN_SOCKET,
+                 concurrency=DEFAULT_PODMAN_CONCURRENCY,
+                 timeout=DEFAULT_PODMAN_TIMEOUT):
+        self.socket_path = socket_path
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.UnixConnector(
+                path=self.socket_path, limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def _request(self, method, path, params=None):
+        """
+        returns the decoded JSON answer, or None if the answer is empty
+        """
+        url = f"{PODMAN_API}{path}"
+        async with self.session.request(method, url, params=params) as response:
+            text = await response.text()
+            if response.status >= 400:
+                try:
+                    message = json.loads(text)['message']
+                except Exception:
+                    message = text
+                if response.status == 404:
+                    raise AsyncPodmanNotFound(response.status, message)
+                raise AsyncPodmanError(response.status, message)
+        return json.loads(text) if text.strip() else None
+
+    ##########
+    async def list_containers(self, all=True,   # pylint: disable=redefined-builtin
+                              filters=None):
+        """
+        same contents as the attrs of podman-py's containers.list()
+        filters is a dict like e.g. {'id': [container_id]}
+        """
+        params = {'all': 'true' if all else 'false'}
+        if filters:
+            params['filters'] = json.dumps(filters)
+        return await self._request('GET', "/containers/json", params) or []
+
+    async def inspect_container(self, name):
+        """
+        same contents as the attrs of podman-py's containers.get(name)
+        """
+        return await self._request('GET', f"/containers/{quote(name)}/json")
+
+    async def kill_container(self, name, signal=None):
+        params = {'signal': signal} if signal else None
+        return await self._request(
+            'POST', f"/containers/{quote(name)}/kill", params)
+
+    async def remove_container(self, name, force=False):
+        params = {'force': 'true' if force else 'false'}
+        return await self._request(
+            'DELETE', f"/containers/{quote(name)}", params)
+
+    async def events(self, filters=None, since=None):
+        """
+        an asynchronous generator on the podman events stream
+
+        filters is a dict like e.g. {'type': ['container'], 'event': ['start']}
+        since is an epoch; past events are replayed from that time on
+
+        each event is a dict with keys like 'Type', 'Action', 'Actor' and 'time'
+        """
+        params = {'stream': 'true'}
+        if filters:
+            params['filters'] = json.dumps(filters)
+        if since is not None:
+            params['since'] = str(int(since))
+        url = f"{PODMAN_API}/events"
+        # the stream is not supposed to end, so no overall timeout here
+        async with self.session.get(
+                url, params=params,
+                timeout=aiohttp.ClientTimeout(total=None)) as response:
+            if response.status >= 400:
+                raise AsyncPodmanError(response.status, await response.text())
+            async for line in response.content:
+                if line.strip():
+                    yield json.loads(line)
@@ -0,0 +1,112 @@
+"""
+per-container resource usage, read from cgroup v2
+
+with podman, each container runs in a scope named libpod-<id>.scope,
+typically in /sys/fs/cgroup/machine.slice; we read from there
+* cpu.stat        usage_usec
+* memory.current
+* memory.events   oom_kill
+
+all the containers are read in one pass over the cgroup tree,
+and the results are indexed by container Id; this is all about
+the nbhosting containers, the callers are expected to filter
+on the Ids they care about
+"""
+
+# pylint: disable=c0111, w0703
+
+import os
+import re
+
+from nbh_main.settings import monitor_logger as logger
+from nbhosting.stats.sampler import read_flat_keyed, read_single_value
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+# the conmon scopes are named libpod-conmon-<id>.scope
+SCOPE_PATTERN = re.compile(r"libpod-(?P<id>[0-9a-f]{64})\.scope")
+
+
+def scan_container_cgroups(root=CGROUP_ROOT):
+    """
+    returns a dict container Id -> dict with keys
+    cpu_usage_usec, memory_current, oom_kill
+    (the values are None when not available)
+
+    the scopes are not descended into
+    """
+    result = {}
+    # machine.slice is where rootful podman puts them,
+    # but be ready to look further with other setups
+    start = os.path.join(root, "machine.slice")
+    if not os.path.isdir(start):
+        start = root
+    for dirpath, dirnames, _ in os.walk(start):
+        scopes = []
+        for dirname in dirnames:
+            match = SCOPE_PATTERN.fullmatch(dirname)
+            if match:
+                scopes.append(dirname)
+                result[match.group('id')] = read_scope(
+                    os.path.join(dirpath, dirname))
+        # no need to walk the scopes
+        for scope in scopes:
+            dirnames.remove(scope)
+    return result
+
+
+def read_scope(scope_dir):
+    cpu_stat = read_flat_keyed(f"{scope_dir}/cpu.stat") or {}
+    memory_events = read_flat_keyed(f"{scope_dir}/memory.events") or {}
+    return dict(
+        cpu_usage_usec=cpu_stat.get('usage_usec'),
+        memory_current=read_single_value(f"{scope_dir}/memory.current"),
+        oom_kill=memory_events.get('oom_kill'),
+    )
+
+
+class CgroupTracker:
+    """
+    cpu usage and oom kills are cumulative in cgroups
+    so to get per-cycle figures we need to remember the previous values
+    """
+
+    def __init__(self, root=CGROUP_ROOT):
+        self.root = root
+        # container Id -> the raw figures at the previous scan
+        self.previous = {}
+
+    def scan(self):
+        """
+        returns a dict container Id -> dict with keys
+        * cpu_seconds: the cpu time used since last scan (float)
+        * memory_current: in bytes
+        * oom_kill: the number of oom kills since last scan
+
+        for a container seen for the first time, the deltas
+        are computed since its creation
+        """
+        try:
+            current = scan_container_cgroups(self.root)
+        except Exception:
+            logger.exception("cannot scan cgroups")
+            return {}
+        result = {}
+        for container_id, figures in current.items():
+            previous = self.previous.get(container_id, {})
+            result[container_id] = dict(
+                cpu_seconds=self._delta(figures, previous, 'cpu_usage_usec') / 1_000_000,
+                memory_current=figures['memory_current'] or 0,
+                oom_kill=self._delta(figures, previous, 'oom_kill'),
+            )
+        # also forget about the containers that are gone
+        self.previous = current
+        return result
+
+    @staticmethod
+    def _delta(figures, previous, key):
+        value = figures[key]
+        if value is None:
+            return 0
+        # also covers a restarted container
+        return max(0, value - (previous.get(key) or 0))
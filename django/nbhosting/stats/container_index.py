@@ -0,0 +1,200 @@
+"""
+an in-memory index of the nbhosting containers,
+kept up to date from the podman events stream
+
+this is used by the monitor in its event-driven mode, so that
+each cycle no longer needs to list all the containers; the index is
+maintained by a ContainerWatcher that runs in a separate thread,
+with its own event loop
+"""
+
+# pylint: disable=c0111, w0703
+
+import time
+import threading
+import asyncio
+from collections import Counter
+
+from nbh_main.settings import monitor_logger as logger
+from nbhosting.podman_async import AsyncPodman
+from nbhosting.courses.image_cache import image_hash_cache
+from nbhosting.courses.registry import container_registry
+
+# the container events we care about; the containers from the warm pools
+# only get their nbhosting name when renamed, see courses/pool.py
+CONTAINER_EVENTS = ['create', 'start', 'rename', 'died', 'remove']
+# the image events that invalidate the image hash cache
+IMAGE_EVENTS = ['build', 'pull', 'tag', 'untag', 'remove', 'import', 'load']
+
+# when the events stream breaks, wait that long before we reconnect
+RECONNECT_DELAY = 5
+
+
+def nbhosting_coursename(name):
+    """
+    nbhosting containers are named <course>-x-<student>
+    return the course name, or None for other containers
+    """
+    try:
+        coursename, _student = name.split('-x-')
+        return coursename
+    except ValueError:
+        return None
+
+
+class ContainerIndex:
+    """
+    a thread-safe map container name -> container dict
+
+    the container dicts have the same format as the items
+    in the containers list API (see HighlevelContainer in monitor.py)
+    so they include the ports and creation time
+
+    like in the list API, the containers that are not running are
+    in there too, until they get removed; so the monitor deals with
+    the stopped containers the same way in both modes
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._containers = {}
+        # how many containers have died since the last snapshot, per course
+        # not counting the ones that the monitor has killed
+        self._died = Counter()
+        # the names of the containers that the monitor is killing
+        self._killing = set()
+        # becomes True once the initial listing is done
+        # and back to False when the events stream breaks
+        self.synced = False
+
+    def __len__(self):
+        with self._lock:
+            return len(self._containers)
+
+    def reset(self, containers):
+        with self._lock:
+            self._containers = {
+                container['Names'][0]: container
+                for container in containers
+                if nbhosting_coursename(container['Names'][0])
+            }
+            self.synced = True
+
+    def add(self, container):
+        name = container['Names'][0]
+        if not nbhosting_coursename(name):
+            return
+        with self._lock:
+            self._containers[name] = container
+
+    def killing(self, name):
+        """
+        the monitor is about to kill that container,
+        so its death is not to be counted
+        """
+        with self._lock:
+            self._killing.add(name)
+
+    def kill_failed(self, name):
+        with self._lock:
+            self._killing.discard(name)
+
+    def died(self, name):
+        with self._lock:
+            container = self._containers.get(name)
+            if container is not None:
+                # the event does not tell more, the exact state
+                # will come with the next listing or event
+                self._containers[name] = dict(container, State='exited')
+                if name in self._killing:
+                    self._killing.discard(name)
+                else:
+                    self._died[nbhosting_coursename(name)] += 1
+
+    def discard(self, name):
+        with self._lock:
+            self._containers.pop(name, None)
+            self._killing.discard(name)
+
+    def snapshot(self):
+        """
+        returns a tuple
+        * the list of containers, running or not
+        * a Counter course -> number of containers that died since last snapshot,
+          other than the ones killed by the monitor
+        """
+        with self._lock:
+            containers = list(self._containers.values())
+            died, self._died = self._died, Counter()
+        return containers, died
+
+
+class ContainerWatcher:
+    """
+    subscribes to the podman events stream, and keeps a ContainerIndex
+    up to date; runs in a daemon thread
+
+    image events are used to invalidate the image hash cache
+
+    on each (re)connection, the index is rebuilt from a full listing,
+    and the events that occur during that listing get replayed
+    """
+
+    def __init__(self, index: ContainerIndex):
+        self.index = index
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=lambda: asyncio.run(self._co_watch_forever()),
+            name='container-watcher', daemon=True)
+        self.thread.start()
+
+    async def _co_watch_forever(self):
+        while True:
+            try:
+                await self._co_watch()
+            except Exception:
+                logger.exception("podman events stream broken")
+            self.index.synced = False
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def _co_watch(self):
+        async with AsyncPodman() as podman_api:
+            since = time.time()
+            self.index.reset(await podman_api.list_containers(all=True))
+            logger.info(f"container index synced with {len(self.index)} containers")
+            # when the stream breaks we may miss image events
+            image_hash_cache.invalidate()
+            filters = {'type': ['container', 'image'],
+                       'event': sorted(set(CONTAINER_EVENTS + IMAGE_EVENTS))}
+            async for event in podman_api.events(filters=filters, since=since):
+                await self._co_handle(podman_api, event)
+
+    async def _co_handle(self, podman_api, event):
+        action = event.get('Action')
+        actor = event.get('Actor', {})
+        if event.get('Type') == 'image':
+            if action in IMAGE_EVENTS:
+                # tags make it hard to map an event to an image name
+                # and this is a rare event anyway
+                logger.info(f"podman image event {action} - "
+                            f"flushing image hash cache")
+                image_hash_cache.invalidate()
+            return
+        name = actor.get('Attributes', {}).get('name')
+        if not name or not nbhosting_coursename(name):
+            return
+        logger.debug(f"podman event {action} on {name}")
+        if action in ('create', 'start', 'rename'):
+            # the event does not carry the ports, so fetch the list format
+            containers = await podman_api.list_containers(
+                all=True, filters={'id': [actor['ID']]})
+            for container in containers:
+                self.index.add(container)
+        elif action == 'died':
+            self.index.died(name)
+            container_registry().forget(name)
+        elif action == 'remove':
+            self.index.discard(name)
+            container_registry().forget(name)
@@ -0,0 +1,345 @@
+"""
+a columnar binary store for the monitor counts - raw/<course>/counts.bin
+
+the file is made of
+* a header
+  * 8 bytes of magic
+  * the header size as a little-endian int64
+  * a JSON object {"columns": [...]}, padded with spaces so that
+    the header size is a multiple of 8
+* then fixed-width records, one per monitor cycle, each made of
+  as many little-endian int64 as there are columns;
+  the first column is always 'timestamp', as an epoch in seconds
+
+the columns in the header are how the schema gets versioned; when
+new counts get added to Stats.known_counts, the file is rewritten
+with the new columns, where the older records get MISSING
+
+the records can be read in one go as a numpy 2D array through memmap
+
+the writers - appending a record, or rewriting the whole file - hold an
+exclusive flock on a companion file .counts.bin.lock, so that a record
+is never appended to a file that is being replaced; readers need no lock
+"""
+
+# pylint: disable=c0111, w0703
+
+import os
+import fcntl
+import json
+import time
+import calendar
+import heapq
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+from nbh_main.settings import logger
+
+MAGIC = b"NBHCNT01"
+DTYPE = np.dtype('<i8')
+# for the values that were not recorded
+MISSING = np.iinfo(DTYPE).min
+
+TIMESTAMP = 'timestamp'
+
+
+def _header_bytes(columns):
+    payload = json.dumps({'columns': columns}).encode()
+    size = len(MAGIC) + DTYPE.itemsize + len(payload)
+    padded = -(-size // 8) * 8
+    return (MAGIC + np.array([padded], dtype=DTYPE).tobytes()
+            + payload + b' ' * (padded - size))
+
+
+class CountsStore:
+
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self):
+        return self.path.exists()
+
+    @contextmanager
+    def _locked(self):
+        # not on the file itself, as it gets replaced when rewritten
+        lock_path = self.path.parent / f".{self.path.name}.lock"
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _header_from_fd(self, fd):
+        prefix = os.pread(fd, len(MAGIC) + DTYPE.itemsize, 0)
+        if prefix[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{self.path}: not a counts file")
+        header_size = int(np.frombuffer(prefix[len(MAGIC):], dtype=DTYPE)[0])
+        payload = os.pread(fd, header_size - len(prefix), len(prefix))
+        return header_size, json.loads(payload)['columns']
+
+    def header(self):
+        """
+        returns a tuple header_size, columns
+        """
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            return self._header_from_fd(fd)
+        finally:
+            os.close(fd)
+
+    def columns(self):
+        return self.header()[1]
+
+    def read(self):
+        """
+        returns a tuple columns, records
+        where records is a read-only 2D numpy array (memmap)
+        with one line per record, and one column per column
+        a partially written last record is ignored
+        """
+        header_size, columns = self.header()
+        record_size = DTYPE.itemsize * len(columns)
+        nb_records = (self.path.stat().st_size - header_size) // record_size
+        if nb_records <= 0:
+            return columns, np.empty((0, len(columns)), dtype=DTYPE)
+        records = np.memmap(self.path, dtype=DTYPE, mode='r', offset=header_size,
+                            shape=(nb_records, len(columns)))
+        return columns, records
+
+    def write(self, columns, records):
+        """
+        atomically (re)writes the whole file
+        """
+        with self._locked():
+            self._write(columns, records)
+
+    def rewrite(self, transform):
+        """
+        transform(columns, records) returns a new tuple (columns, records)
+        to be written in place of the current ones, or None to leave the
+        file alone; no record can be appended in the meantime
+        """
+        with self._locked():
+            result = transform(*self.read())
+            if result is not None:
+                self._write(*result)
+
+    def _write(self, columns, records):
+        directory = self.path.parent
+        with tempfile.NamedTemporaryFile(
+                'wb', dir=directory, prefix=f".{self.path.name}.",
+                delete=False) as feed:
+            feed.write(_header_bytes(columns))
+            feed.write(np.ascontiguousarray(records, dtype=DTYPE).tobytes())
+        os.chmod(feed.name, 0o644)
+        os.replace(feed.name, self.path)
+
+    def create(self, columns):
+        self.write([TIMESTAMP] + list(columns),
+                   np.empty((0, len(columns) + 1), dtype=DTYPE))
+
+    def ensure_columns(self, columns):
+        """
+        make sure the file has this exact set of columns - plus timestamp;
+        the existing records get MISSING for the new columns
+
+        this never drops a column: if the file has columns that are
+        not in columns, ValueError is raised, see drop_columns()
+
+        creates the file if needed
+        """
+        wanted = [TIMESTAMP] + list(columns)
+        if not self.exists():
+            self.create(columns)
+            return
+        current = self.columns()
+        if current == wanted:
+            return
+        extra = [column for column in current if column not in wanted]
+        if extra:
+            raise ValueError(f"{self.path}: would drop columns {extra}")
+        self._rewrite(wanted)
+
+    def drop_columns(self, columns):
+        """
+        remove these columns, and their values, from the file
+        the ones that are not in the file are ignored
+        """
+        current = self.columns()
+        kept = [column for column in current
+                if column == TIMESTAMP or column not in columns]
+        if kept != current:
+            self._rewrite(kept)
+
+    def _rewrite(self, wanted):
+        def migrate(current, records):
+            if current == wanted:
+                return None
+            logger.info(f"{self.path}: migrating from {len(current)} "
+                        f"to {len(wanted)} columns")
+            upgraded = np.full((len(records), len(wanted)), MISSING, dtype=DTYPE)
+            for index, column in enumerate(wanted):
+                if column in current:
+                    upgraded[:, index] = records[:, current.index(column)]
+            return wanted, upgraded
+        self.rewrite(migrate)
+
+    def append(self, timestamp, values):
+        """
+        timestamp is an epoch, values are the counts in the
+        same order as the columns in the file; missing values at
+        the end are set to MISSING, and None means MISSING as well
+
+        the record is written in a single write() on a file
+        opened in append mode, the same that the header is read from
+        """
+        with self._locked():
+            fd = os.open(self.path, os.O_RDWR | os.O_APPEND)
+            try:
+                _, columns = self._header_from_fd(fd)
+                if len(values) > len(columns) - 1:
+                    raise ValueError(f"too many values ({len(values)}) "
+                                     f"for {len(columns)-1} counts")
+                record = np.full(len(columns), MISSING, dtype=DTYPE)
+                record[0] = int(timestamp)
+                for index, value in enumerate(values, 1):
+                    if value is not None:
+                        record[index] = int(value)
+                os.write(fd, record.tobytes())
+            finally:
+                os.close(fd)
+
+
+def parse_timestamp(timestamp, time_format):
+    return calendar.timegm(time.strptime(timestamp, time_format))
+
+
+def format_timestamps(epochs):
+    """
+    a numpy array of epochs -> a list of strings in the
+    time_format used in all raw files, i.e. %Y-%m-%dT%H:%M:%S
+    """
+    return np.asarray(epochs).astype('datetime64[s]').astype(str).tolist()
+
+
+def column_to_list(column):
+    """
+    a numpy column -> a list of ints, with None for MISSING
+    """
+    result = column.tolist()
+    if (column == MISSING).any():
+        result = [None if value == MISSING else value for value in result]
+    return result
+
+
+def read_text_counts(raw_path, known_counts, time_format):
+    """
+    read a counts.raw text file - where the values are
+    positional along known_counts
+
+    returns a 2D array, with timestamp as the first column
+    """
+    nb_counts = len(known_counts)
+    rows = []
+    with raw_path.open() as feed:
+        for lineno, line in enumerate(feed, 1):
+            if line.startswith('#'):
+                continue
+            try:
+                timestamp, *values = line.split()
+                if len(values) > nb_counts:
+                    logger.error(f"{raw_path}:{lineno}: "
+                                 f"counts line has too many fields "
+                                 f"- {len(values)} > {nb_counts}")
+                    continue
+                row = [parse_timestamp(timestamp, time_format)]
+                row += [int(value) for value in values]
+                row += [MISSING] * (nb_counts - len(values))
+                rows.append(row)
+            except Exception:
+                logger.exception(f"{raw_path}:{lineno}: "
+                                 f"skipped misformed counts line - {line}")
+    return np.array(rows, dtype=DTYPE).reshape(len(rows), nb_counts + 1)
+
+
+def convert_text_counts(raw_path, store, known_counts, time_format):
+    """
+    (re)write store from a counts.raw text file
+
+    returns the number of records written
+    """
+    records = read_text_counts(raw_path, known_counts, time_format)
+    store.write([TIMESTAMP] + list(known_counts), records)
+    return len(records)
+
+
+def merge_text_counts(raw_path, store, known_counts, time_format):
+    """
+    counts.raw is no longer written once store exists, so store
+    has the most recent records, and possibly fewer columns;
+    this keeps all the records in store, and the columns as well,
+    and only adds the records from raw_path that are older than them
+
+    returns the number of records added
+    """
+    older = read_text_counts(raw_path, known_counts, time_format)
+    raw_columns = [TIMESTAMP] + list(known_counts)
+    added = []
+    def prepend(columns, records):
+        selected = older[older[:, 0] < records[0, 0]] if len(records) else older
+        rows = np.full((len(selected), len(columns)), MISSING, dtype=DTYPE)
+        for index, column in enumerate(columns):
+            if column in raw_columns:
+                rows[:, index] = selected[:, raw_columns.index(column)]
+        added.append(len(rows))
+        if not len(rows):
+            return None
+        return columns, np.concatenate([rows, records])
+    store.rewrite(prepend)
+    return added[0]
+
+
+def align(epochs, reference, tolerance):
+    """
+    for each epoch, the index of the nearest epoch in reference - both
+    sorted - or -1 if it is more than tolerance seconds away
+    """
+    epochs = np.asarray(epochs)
+    reference = np.asarray(reference)
+    if not len(reference):
+        return np.full(len(epochs), -1, dtype=np.int64)
+    right = np.clip(np.searchsorted(reference, epochs), 0, len(reference) - 1)
+    left = np.clip(right - 1, 0, len(reference) - 1)
+    nearest = np.where(np.abs(reference[left] - epochs) <= np.abs(reference[right] - epochs),
+                       left, right)
+    return np.where(np.abs(reference[nearest] - epochs) <= tolerance, nearest, -1)
+
+
+def merge_stores(stores, columns, min_gap):
+    """
+    k-way merge of the records in several stores, restricted to columns
+
+    used to extract the counts that used to be duplicated in all stores;
+    records less than min_gap seconds after the previous one
+    are considered duplicates, and only the first one is kept
+
+    returns a 2D array, with timestamp as the first column
+    """
+    def records_with(store):
+        current, records = store.read()
+        if any(column not in current for column in columns):
+            return
+        indices = [current.index(TIMESTAMP)] + [current.index(column) for column in columns]
+        yield from records[:, indices].tolist()
+    rows = []
+    last = None
+    for row in heapq.merge(*(records_with(store) for store in stores),
+                           key=lambda row: row[0]):
+        if last is not None and row[0] - last < min_gap:
+            continue
+        rows.append(row)
+        last = row[0]
+    return np.array(rows, dtype=DTYPE).reshape(len(rows), len(columns) + 1)
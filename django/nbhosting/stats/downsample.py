@@ -0,0 +1,149 @@
+"""
+time-range selection and downsampling for the stats time series
+
+the series are cut in at most max_points buckets of consecutive points,
+and each bucket is summarized with its mean, min and max; the mean is
+what gets plotted, and min/max provide an envelope so that peaks
+survive the downsampling
+
+everything here works on numpy arrays
+* epochs: a 1D int64 array of timestamps, in seconds, sorted
+* values: a 2D float64 array, one line per timestamp,
+  one column per series, with nan for the missing values
+"""
+
+# pylint: disable=c0111
+
+import calendar
+import time
+
+import numpy as np
+
+from nbhosting.stats.countstore import format_timestamps
+
+# the formats accepted for the from= and to= query parameters
+# in addition to epochs
+TIME_FORMATS = ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d"]
+
+
+def parse_time(text):
+    """
+    an epoch, or a UTC date or datetime in ISO format -> an epoch
+    raises ValueError if not understood
+    """
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    for time_format in TIME_FORMATS:
+        try:
+            return calendar.timegm(time.strptime(text, time_format))
+        except ValueError:
+            pass
+    raise ValueError(f"unrecognized time {text}")
+
+
+def parse_query(query):
+    """
+    query is typically request.GET
+    returns a tuple start, end, max_points - each may be None
+    raises ValueError if something is wrong
+    """
+    start = query.get('from')
+    end = query.get('to')
+    max_points = query.get('max_points')
+    start = parse_time(start) if start else None
+    end = parse_time(end) if end else None
+    max_points = int(max_points) if max_points else None
+    if max_points is not None and max_points < 1:
+        raise ValueError(f"max_points must be positive, got {max_points}")
+    return start, end, max_points
+
+
+def select_range(epochs, start=None, end=None):
+    """
+    returns a slice on the points within [start, end]
+    """
+    beg = 0 if start is None else np.searchsorted(epochs, start, side='left')
+    fin = len(epochs) if end is None else np.searchsorted(epochs, end, side='right')
+    return slice(beg, fin)
+
+
+def downsample(epochs, values, max_points):
+    """
+    returns epochs, means, mins, maxs
+    with at most max_points lines, each one summarizing
+    a bucket of consecutive points; the epoch of a bucket
+    is the mean of its epochs
+
+    a bucket where a series is all missing gets nan for that series
+    """
+    nb_points = len(epochs)
+    if nb_points <= max_points:
+        return epochs, values, values, values
+    # the indices where each bucket starts
+    starts = np.linspace(0, nb_points, max_points, endpoint=False).astype(np.int64)
+    sizes = np.diff(np.append(starts, nb_points))
+    bucket_epochs = np.add.reduceat(epochs, starts) // sizes
+    present = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(present, values, 0.), starts, axis=0)
+    counts = np.add.reduceat(present, starts, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums / counts, np.nan)
+    # fmin and fmax ignore nan
+    mins = np.fmin.reduceat(values, starts, axis=0)
+    maxs = np.fmax.reduceat(values, starts, axis=0)
+    return bucket_epochs, means, mins, maxs
+
+
+def float_column_to_list(column, digits=None):
+    """
+    a float column -> a list with None instead of nan
+    integral values come back as ints
+    """
+    if digits is not None:
+        column = np.round(column, digits)
+    return [None if value != value
+            else int(value) if value.is_integer() else value
+            for value in column.tolist()]
+
+
+def series(timestamps, columns, start=None, end=None, max_points=None):
+    """
+    the high-level entry point
+
+    timestamps: an array of epochs
+    columns: a dict name -> array of values, with nan or None for missing values
+
+    returns a tuple timestamps, series, envelopes
+    * timestamps is a list of strings in the raw files time format
+    * series is a dict name -> list of values (means if downsampled)
+    * envelopes is None if no downsampling occurred, or else
+      a dict name -> {'min': list, 'max': list}
+    """
+    epochs = np.asarray(timestamps, dtype=np.int64)
+    names = list(columns)
+    values = np.empty((len(epochs), len(names)), dtype=np.float64)
+    for index, name in enumerate(names):
+        values[:, index] = np.asarray(columns[name], dtype=np.float64)
+    selected = select_range(epochs, start, end)
+    epochs, values = epochs[selected], values[selected]
+    envelopes = None
+    if max_points is not None and len(epochs) > max_points:
+        epochs, means, mins, maxs = downsample(epochs, values, max_points)
+        envelopes = {
+            name: {'min': float_column_to_list(mins[:, index]),
+                   'max': float_column_to_list(maxs[:, index])}
+            for index, name in enumerate(names)
+        }
+        values = means
+    result = {name: float_column_to_list(values[:, index], digits=2)
+              for index, name in enumerate(names)}
+    return format_timestamps(epochs), result, envelopes
+
+
+def to_epochs(timestamps):
+    """
+    a list of strings in the raw files time format -> an array of epochs
+    """
+    return np.array(timestamps, dtype='datetime64[s]').astype(np.int64)
@@ -0,0 +1,329 @@
+"""
+writing and rotating the events files - raw/<course>/events.raw
+
+writing
+* a line gets written with a single write() on a file descriptor
+  opened with O_APPEND, so lines from concurrent processes never get
+  interleaved; the descriptors are kept open, and the inode is checked
+  before each write so as to follow rotations
+* depending on sitesettings.events_buffering, lines are
+  - None: written right away (the default)
+  - 'local': buffered in the process, and written in batches
+  - 'redis': pushed in a redis list, that the monitor drains every cycle
+
+rotation
+* the monitor renames events.raw into events-<timestamp>.raw when it
+  gets too big or too old, and the older segments get gzipped
+* the readers get the segments, oldest first, through events_segments()
+"""
+
+# pylint: disable=c0111, w0703
+
+import os
+import gzip
+import time
+import atexit
+import calendar
+import threading
+from collections import defaultdict
+
+from nbh_main.settings import sitesettings, logger
+
+# using gmtime in all raw files
+time_format = "%Y-%m-%dT%H:%M:%S"
+
+LIVE_NAME = "events.raw"
+SEGMENT_PATTERN = "events-*.raw*"
+SEGMENT_TIME_FORMAT = "%Y%m%dT%H%M%S"
+# the rotated segments are gzipped only after that many seconds without
+# a write, so that the writers have all noticed the rotation
+COMPRESS_GRACE = 3600
+
+REDIS_KEY = "nbhosting:events"
+
+
+class EventsWriter:
+    """
+    the file descriptors are cached, one per file
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # path -> (fd, inode)
+        self.fds = {}
+
+    def write(self, path, data: bytes):
+        with self.lock:
+            os.write(self._fd(str(path)), data)
+
+    def record(self, path, line):
+        self.write(path, line.encode())
+
+    def _fd(self, path):
+        try:
+            inode = os.stat(path).st_ino
+        except FileNotFoundError:
+            inode = None
+        cached = self.fds.get(path)
+        if cached is not None:
+            fd, cached_inode = cached
+            if cached_inode == inode:
+                return fd
+            # the file has been rotated
+            os.close(fd)
+            del self.fds[path]
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.fds[path] = (fd, os.fstat(fd).st_ino)
+        return fd
+
+    def close(self):
+        with self.lock:
+            for fd, _ in self.fds.values():
+                os.close(fd)
+            self.fds = {}
+
+
+class LocalBuffer:
+    """
+    lines are kept in memory, and written when there are batch_size
+    of them, or when the oldest one has waited for delay seconds
+    """
+
+    def __init__(self, writer, batch_size, delay):
+        self.writer = writer
+        self.batch_size = batch_size
+        self.delay = delay
+        self.lock = threading.Lock()
+        # path -> list of lines
+        self.pending = defaultdict(list)
+        self.nb_pending = 0
+        self.flusher = None
+        atexit.register(self.flush)
+
+    def record(self, path, line):
+        with self.lock:
+            self.pending[str(path)].append(line)
+            self.nb_pending += 1
+            if self.nb_pending >= self.batch_size:
+                self._flush()
+        if self.flusher is None:
+            self.flusher = threading.Thread(
+                target=self._flush_forever, daemon=True, name="events-flusher")
+            self.flusher.start()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        pending, self.pending, self.nb_pending = self.pending, defaultdict(list), 0
+        for path, lines in pending.items():
+            try:
+                self.writer.write(path, "".join(lines).encode())
+            except Exception as exc:
+                logger.exception(f"Cannot store {len(lines)} stats lines "
+                                 f"into {path}, {type(exc)}")
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(self.delay)
+            self.flush()
+
+
+class RedisBuffer:
+    """
+    lines are pushed in a redis list, together with their path
+    the monitor writes them at the next cycle, see drain_redis_events()
+    if redis is unreachable, lines get written right away
+    """
+
+    def __init__(self, writer):
+        import redis
+        self.writer = writer
+        self.redis = redis.Redis()
+
+    def record(self, path, line):
+        try:
+            self.redis.rpush(REDIS_KEY, f"{path}\t{line}")
+        except Exception as exc:
+            logger.error(f"cannot push stats line to redis ({exc}) - writing it")
+            self.writer.record(path, line)
+
+
+# one per process, created upon first use
+_writer = None
+_sink = None
+
+def _reset_after_fork():
+    global _writer, _sink                                   # pylint: disable=w0603
+    _writer, _sink = None, None
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def events_writer():
+    global _writer                                          # pylint: disable=w0603
+    if _writer is None:
+        _writer = EventsWriter()
+    return _writer
+
+
+def events_sink():
+    """
+    the object where to record events, depending on sitesettings
+    """
+    global _sink                                            # pylint: disable=w0603
+    if _sink is None:
+        writer = events_writer()
+        buffering = getattr(sitesettings, 'events_buffering', None)
+        if buffering == 'local':
+            _sink = LocalBuffer(
+                writer, getattr(sitesettings, 'events_batch_size', 100),
+                getattr(sitesettings, 'events_batch_delay', 2))
+        elif buffering == 'redis':
+            try:
+                _sink = RedisBuffer(writer)
+            except ModuleNotFoundError:
+                logger.error("events_buffering is 'redis' but redis is not installed")
+                _sink = writer
+        else:
+            _sink = writer
+    return _sink
+
+
+def record_event(path, line):
+    """
+    line is expected to end with a newline
+    """
+    events_sink().record(path, line)
+
+
+def drain_redis_events(batch=10_000):
+    """
+    write the lines pushed in redis by the RedisBuffer objects
+    each file gets one write per batch
+
+    the lines are removed from redis only once written, so a monitor
+    that dies mid-drain may write some lines twice, but loses none;
+    the lines that could not be written are pushed back for the next cycle
+
+    returns the number of lines written
+    """
+    import redis
+    client = redis.Redis()
+    writer = events_writer()
+    total = 0
+    while True:
+        items = client.lrange(REDIS_KEY, 0, batch-1)
+        lines_by_path = defaultdict(list)
+        for item in items:
+            path, line = item.decode().split('\t', 1)
+            lines_by_path[path].append(line)
+        failed = []
+        for path, lines in lines_by_path.items():
+            try:
+                writer.write(path, "".join(lines).encode())
+                total += len(lines)
+            except Exception as exc:
+                logger.exception(f"Cannot store {len(lines)} stats lines "
+                                 f"into {path}, {type(exc)} - will retry")
+                failed.extend(f"{path}\t{line}" for line in lines)
+        # there is only one drainer, and the web workers only push
+        # at the end, so the batch is still at the head of the list
+        with client.pipeline() as pipe:
+            pipe.ltrim(REDIS_KEY, len(items), -1)
+            if failed:
+                pipe.rpush(REDIS_KEY, *failed)
+            pipe.execute()
+        if failed or len(items) < batch:
+            return total
+
+
+####################
+def segment_key(path):
+    """
+    a segment keeps its identity once gzipped
+    """
+    name = path.name
+    return name[:-3] if name.endswith('.gz') else name
+
+
+def events_segments(directory):
+    """
+    the events files in a course directory, oldest first;
+    the live file comes last, if present
+
+    while a segment is being compressed, both the plain
+    and gzipped versions exist, and the plain one is used
+    """
+    by_key = {}
+    for path in directory.glob(SEGMENT_PATTERN):
+        if path.suffix not in ('.raw', '.gz'):
+            continue
+        key = segment_key(path)
+        if key not in by_key or path.suffix == '.raw':
+            by_key[key] = path
+    segments = [by_key[key] for key in sorted(by_key)]
+    live = directory / LIVE_NAME
+    if live.exists():
+        segments.append(live)
+    return segments
+
+
+def open_segment(path):
+    if path.suffix == '.gz':
+        return gzip.open(path, 'rb')
+    return path.open('rb')
+
+
+def _first_epoch(path):
+    with path.open() as feed:
+        line = feed.readline()
+    return calendar.timegm(time.strptime(line.split()[0], time_format))
+
+
+def rotate_events(directory, max_size=None, max_age=None, now=None):
+    """
+    rename the live file into a new segment if it is larger than
+    max_size bytes, or if its first line is older than max_age seconds;
+    also compress the segments that are not written into anymore
+
+    returns the new segment, or None
+    """
+    now = now or time.time()
+    live = directory / LIVE_NAME
+    rotated = None
+    try:
+        size = live.stat().st_size
+        if size and ((max_size and size >= max_size)
+                     or (max_age and _first_epoch(live) <= now - max_age)):
+            stamp = time.strftime(SEGMENT_TIME_FORMAT, time.gmtime(now))
+            target = directory / f"events-{stamp}.raw"
+            if not target.exists():
+                live.rename(target)
+                logger.info(f"rotated {live} into {target.name} ({size} bytes)")
+                rotated = target
+    except FileNotFoundError:
+        pass
+    except Exception:
+        logger.exception(f"could not rotate {live}")
+    compress_segments(directory, now)
+    return rotated
+
+
+def compress_segments(directory, now=None):
+    now = now or time.time()
+    for path in directory.glob("events-*.raw"):
+        try:
+            if path.stat().st_mtime > now - COMPRESS_GRACE:
+                continue
+            target = path.with_name(path.name + ".gz")
+            temporary = path.with_name(f".{target.name}.tmp")
+            with path.open('rb') as feed, gzip.open(temporary, 'wb') as sink:
+                while chunk := feed.read(1024 * 1024):
+                    sink.write(chunk)
+            os.chmod(temporary, 0o644)
+            os.replace(temporary, target)
+            path.unlink()
+        except Exception:
+            logger.exception(f"could not compress {path}")
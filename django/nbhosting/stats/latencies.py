@@ -0,0 +1,104 @@
+"""
+how long it takes to open a notebook - raw/<course>/latencies.raw
+
+each line describes one successful opening, with the same first
+5 fields as in events.raw, then the durations in ms
+  timestamp course student notebook action total account copy run http
+where
+* action is 'created' (cold start) or 'existing' (warm open)
+* total is the time spent spawning, as seen from edxfront
+* the other ones are the phases as measured in nbhosting.courses.spawn,
+  that edxfront gets in SpawnResult.timings
+  - account: creating the student account if needed
+  - copy: copying the notebook or creating the student repo
+  - run: checks, and podman run for a cold start
+  - http: waiting for jupyter to answer over http
+  a phase that was not reported is '-'
+"""
+
+# pylint: disable=c0111, w0703
+
+from collections import defaultdict
+
+from nbhosting.utils import percentiles
+from nbh_main.settings import logger
+
+PHASES = ['account', 'copy', 'run', 'http']
+
+# the actions in the events file
+KINDS = {'created': 'cold', 'existing': 'warm'}
+
+RATIOS = (.5, .95, .99)
+
+
+def format_latency_line(timestamp, coursename, student, notebook,
+                        action, total, timings):
+    fields = [str(total)] + ['-' if timings.get(phase) is None
+                             else str(timings[phase]) for phase in PHASES]
+    return (f"{timestamp} {coursename} {student} {notebook} {action} "
+            f"{' '.join(fields)}\n")
+
+
+def _percentiles_by_day(days):
+    # days is a dict day -> list of values
+    return [percentiles(days[day], RATIOS) for day in sorted(days)]
+
+
+def open_latencies(path, start=None, end=None):
+    """
+    read a latencies file, and compute daily percentiles;
+    start and end are timestamps in the raw files time format
+
+    returns a dict with keys 'cold' and 'warm', each being a dict with
+    * 'timestamps': the days, with time 23:59:59 as in daily_metrics
+    * 'counts': the number of openings that day
+    * 'p50', 'p95', 'p99': the total duration in ms
+    * 'phases': a dict phase -> {'p50', 'p95', 'p99'}
+    """
+    # kind -> day -> list of totals
+    totals = {kind: defaultdict(list) for kind in KINDS.values()}
+    # kind -> phase -> day -> list of durations
+    phases = {kind: {phase: defaultdict(list) for phase in PHASES}
+              for kind in KINDS.values()}
+    try:
+        with path.open() as feed:
+            for lineno, line in enumerate(feed, 1):
+                try:
+                    timestamp, _course, _student, _notebook, action, total, *timings = \
+                        line.split()
+                    if (start and timestamp < start) or (end and timestamp > end):
+                        continue
+                    kind = KINDS.get(action)
+                    if kind is None:
+                        continue
+                    day = timestamp[:10] + ' 23:59:59'
+                    totals[kind][day].append(int(total))
+                    for phase, value in zip(PHASES, timings):
+                        if value != '-':
+                            phases[kind][phase][day].append(int(value))
+                except Exception:
+                    logger.exception(f"{path}:{lineno}: "
+                                     f"skipped misformed latencies line - {line}")
+    except FileNotFoundError:
+        pass
+    result = {}
+    for kind in KINDS.values():
+        days = totals[kind]
+        by_day = _percentiles_by_day(days)
+        result[kind] = {
+            'timestamps': sorted(days),
+            'counts': [len(days[day]) for day in sorted(days)],
+        }
+        for index, ratio in enumerate(RATIOS):
+            result[kind][f"p{round(100*ratio)}"] = [values[index] for values in by_day]
+        result[kind]['phases'] = {}
+        for phase in PHASES:
+            # align on the days where totals are known
+            phase_days = phases[kind][phase]
+            by_day = [percentiles(phase_days.get(day, []), RATIOS)
+                      for day in sorted(days)]
+            result[kind]['phases'][phase] = {
+                f"p{round(100*ratio)}": [values[index] for values in by_day]
+                for index, ratio in enumerate(RATIOS)
+            }
+    return result
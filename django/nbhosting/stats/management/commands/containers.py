@@ -20,7 +20,7 @@ import asyncio
 import podman
 PODMAN_URL = "unix:///run/podman/podman.sock"
 
-from nbhosting.stats.monitor import MonitoredJupyter, CourseFigures
+from nbhosting.stats.monitor import MonitoredJupyter, CourseFigures, KernelsProber
 
 
 loop = asyncio.get_event_loop()
@@ -79,13 +79,14 @@ class Command(BaseCommand):
         """
 
         with podman.PodmanClient(base_url=PODMAN_URL) as api:
-            containers = api.containers.list()
+            # MonitoredJupyter expects the raw dicts
+            containers = [c.attrs for c in api.containers.list()]
 
-        all_running = [ c for c in containers if c.attrs['State'] == 'running']
-        all_stopped = [ c for c in containers if c.attrs['State'] != 'running']
+        all_running = [ c for c in containers if c['State'] == 'running']
+        all_stopped = [ c for c in containers if c['State'] != 'running']
 
         def monitored(container):
-            name = container.attrs['Names'][0]
+            name = container['Names'][0]
             try:
                 course, student = name.split('-x-')
             except ValueError:
@@ -99,10 +100,12 @@ class Command(BaseCommand):
 
         if show_details or show_idle:
             # probe them to fill las_activity and number_kernels
-            futures = [mon.count_running_kernels() for mon in running_monitoreds]
-            #loop.run_until_complete(asyncio.gather(*futures))
-            for future in futures:
-                loop.run_until_complete(future)
+            async def probe_all():
+                async with KernelsProber() as prober:
+                    await asyncio.gather(
+                        *(mon.count_running_kernels(prober)
+                          for mon in running_monitoreds))
+            loop.run_until_complete(probe_all())
 
         if show_details:
 
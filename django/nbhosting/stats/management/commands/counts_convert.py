@@ -0,0 +1,58 @@
+# pylint: disable=c0111, w0703
+
+from django.core.management.base import BaseCommand
+
+from nbhosting.courses.model_course import CourseDir
+from nbhosting.matching import matching_policy
+from nbhosting.stats.stats import Stats, time_format
+from nbhosting.stats.countstore import convert_text_counts, merge_text_counts
+
+
+class Command(BaseCommand):
+
+    help = """
+    convert the monitor counts of courses from the legacy text format
+    (raw/<course>/counts.raw) into the binary format (counts.bin)
+
+    without argument it converts all courses; with arguments
+    it converts all courses whose name contains any of the tokens;
+
+    courses that already have a counts.bin are left alone unless -f is given,
+    in which case the records of counts.raw that are older than the ones
+    in counts.bin are added to it - counts.bin is never overwritten, since
+    counts.raw no longer gets the records written after the conversion;
+    counts.raw is left untouched in all cases
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-f", "--force", default=False, action="store_true",
+            help="merge older records into existing counts.bin files")
+        parser.add_argument("patterns", nargs='*', type=str)
+
+    def handle(self, *args, **kwargs):
+        patterns = kwargs['patterns']
+        for coursedir in CourseDir.objects.all():
+            coursename = coursedir.coursename
+            if not matching_policy(coursename, patterns):
+                continue
+            stats = Stats(coursename)
+            text_path = stats.monitor_counts_path()
+            store = stats.monitor_counts_store()
+            if not text_path.exists():
+                print(f"{coursename}: no {text_path.name} - skipped")
+                continue
+            if store.exists() and not kwargs['force']:
+                print(f"{coursename}: {store.path.name} already there - skipped")
+                continue
+            try:
+                if store.exists():
+                    nb_records = merge_text_counts(
+                        text_path, store, Stats.known_counts, time_format)
+                    print(f"{coursename}: merged {nb_records} older records")
+                    continue
+                nb_records = convert_text_counts(
+                    text_path, store, Stats.known_counts, time_format)
+                print(f"{coursename}: converted {nb_records} records")
+            except Exception as exc:
+                print(f"{coursename}: conversion failed - {type(exc)} {exc}")
@@ -0,0 +1,126 @@
+# pylint: disable=c0111, w0703
+
+import time
+import random
+import tempfile
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from nbhosting.stats.scanner import (
+    time_format, EventsScanner, DailyConsumer, TotalsConsumer,
+    NotebooksConsumer, BucketsConsumer, HeatmapConsumer)
+
+
+def generate_events(path, nb_lines, nb_students, nb_notebooks, seed=0):
+    """
+    write a synthetic events file, with events every 5s on average
+    and about 5% of 'killing' lines
+    """
+    rnd = random.Random(seed)
+    students = [f"student.{index:05d}" for index in range(nb_students)]
+    notebooks = [f"w{index // 10}/w{index // 10}-s{index % 10}.ipynb"
+                 for index in range(nb_notebooks)]
+    epoch = int(time.time()) - nb_lines * 5
+    with path.open('w') as feed:
+        lines = []
+        for _ in range(nb_lines):
+            epoch += rnd.randint(0, 10)
+            timestamp = time.strftime(time_format, time.gmtime(epoch))
+            student = rnd.choice(students)
+            if rnd.random() < 0.05:
+                lines.append(f"{timestamp} course {student} - killing -\n")
+            else:
+                lines.append(f"{timestamp} course {student} "
+                             f"{rnd.choice(notebooks)} running 8888\n")
+            if len(lines) >= 100_000:
+                feed.writelines(lines)
+                lines = []
+        feed.writelines(lines)
+
+
+def all_consumers():
+    daily = DailyConsumer()
+    notebooks = NotebooksConsumer()
+    return [BucketsConsumer(notebooks), daily, TotalsConsumer(daily),
+            notebooks, HeatmapConsumer()]
+
+
+def per_metric_consumers():
+    """
+    the consumers for one scan per metric; the buckets and totals
+    need the notebooks and daily consumers in the same pass
+    """
+    daily = DailyConsumer()
+    notebooks = NotebooksConsumer()
+    yield 'daily', [DailyConsumer()]
+    yield 'totals', [daily, TotalsConsumer(daily)]
+    yield 'notebooks', [NotebooksConsumer()]
+    yield 'buckets', [BucketsConsumer(notebooks), notebooks]
+    yield 'heatmap', [HeatmapConsumer()]
+
+
+def timed_scan(events_path, consumers):
+    """
+    returns the time it takes to scan the file and compute the results
+    """
+    beg = time.perf_counter()
+    scanner = EventsScanner(set(), consumers)
+    scanner.catch_up([events_path])
+    for consumer in consumers:
+        consumer.result()
+    return time.perf_counter() - beg
+
+
+class Command(BaseCommand):
+
+    help = """
+    measure the time it takes to scan an events file and compute
+    all the stats metrics, on a synthetic file
+
+    the single-pass scan, where all the metrics are fed at the same time,
+    is compared with one scan per metric unless -s is given
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-n", "--lines", default=5_000_000, type=int,
+            help="number of lines in the synthetic events file")
+        parser.add_argument(
+            "-u", "--students", default=20_000, type=int,
+            help="number of distinct students")
+        parser.add_argument(
+            "-b", "--notebooks", default=100, type=int,
+            help="number of distinct notebooks")
+        parser.add_argument(
+            "-f", "--file", default=None,
+            help="use (and keep) that events file; it is created if missing")
+        parser.add_argument(
+            "-s", "--single-only", default=False, action="store_true",
+            help="skip the one-scan-per-metric measurement")
+
+    def handle(self, *args, **kwargs):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            if kwargs['file']:
+                events_path = Path(kwargs['file'])
+            else:
+                events_path = Path(tmpdir) / "events.raw"
+            if not events_path.exists():
+                beg = time.perf_counter()
+                generate_events(events_path, kwargs['lines'],
+                                kwargs['students'], kwargs['notebooks'])
+                print(f"generated {events_path} in {time.perf_counter()-beg:.2f}s")
+            size = events_path.stat().st_size
+            print(f"{events_path}: {size/2**20:.1f} MiB")
+
+            single = timed_scan(events_path, all_consumers())
+            print(f"single pass, all metrics: {single:.2f}s")
+            if kwargs['single_only']:
+                return
+            separate = 0.
+            for name, consumers in per_metric_consumers():
+                elapsed = timed_scan(events_path, consumers)
+                print(f"  {name} alone: {elapsed:.2f}s")
+                separate += elapsed
+            print(f"one pass per metric: {separate:.2f}s "
+                  f"- speedup x{separate/single:.2f}")
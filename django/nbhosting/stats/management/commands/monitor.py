@@ -4,7 +4,11 @@
 
 from django.core.management.base import BaseCommand
 
-from nbhosting.stats.monitor import Monitor
+from nbhosting.stats.monitor import (
+    Monitor, PressurePolicy, DEFAULT_PROBE_CONCURRENCY, DEFAULT_PROBE_TIMEOUT,
+    DEFAULT_KILL_WORKERS, DEFAULT_PRESSURE_AVAILABLE, DEFAULT_PRESSURE_PSI,
+    DEFAULT_PRESSURE_IDLE, DEFAULT_EVENTS_MAX_SIZE, DEFAULT_EVENTS_MAX_AGE)
+from nbhosting.stats.sampler import DEFAULT_SAMPLE_INTERVAL
 
 DEFAULT_PERIOD = 10
 DEFAULT_IDLE = 30
@@ -28,6 +32,54 @@ class Command(BaseCommand):
             "-l", "--lingering", default=DEFAULT_LINGERING, type=int, dest='lingering',
             help="timeout in hours - kill containers older than that "
                  f"(default={DEFAULT_LINGERING})")
+        parser.add_argument(
+            "-c", "--concurrency", default=DEFAULT_PROBE_CONCURRENCY, type=int,
+            help="how many containers can be probed simultaneously "
+                 f"(default={DEFAULT_PROBE_CONCURRENCY})")
+        parser.add_argument(
+            "-t", "--probe-timeout", default=DEFAULT_PROBE_TIMEOUT, type=int,
+            dest='probe_timeout',
+            help="timeout in seconds for probing one container "
+                 f"(default={DEFAULT_PROBE_TIMEOUT})")
+        parser.add_argument(
+            "-k", "--kill-workers", default=DEFAULT_KILL_WORKERS, type=int,
+            dest='kill_workers',
+            help="how many containers can be killed simultaneously "
+                 f"(default={DEFAULT_KILL_WORKERS})")
+        parser.add_argument(
+            "-s", "--sample-interval", default=DEFAULT_SAMPLE_INTERVAL, type=int,
+            dest='sample_interval',
+            help="how often in seconds the system load and memory are sampled "
+                 f"(default={DEFAULT_SAMPLE_INTERVAL})")
+        parser.add_argument(
+            "--pressure-available", default=DEFAULT_PRESSURE_AVAILABLE, type=int,
+            dest='pressure_available',
+            help="memory pressure if available memory is below that percentage, "
+                 f"0 to disable (default={DEFAULT_PRESSURE_AVAILABLE})")
+        parser.add_argument(
+            "--pressure-psi", default=DEFAULT_PRESSURE_PSI, type=int,
+            dest='pressure_psi',
+            help="memory pressure if PSI memory is above that percentage, "
+                 f"0 to disable (default={DEFAULT_PRESSURE_PSI})")
+        parser.add_argument(
+            "--pressure-idle", default=DEFAULT_PRESSURE_IDLE//60, type=int,
+            dest='pressure_idle',
+            help="timeout in minutes - the idle timeout under memory pressure "
+                 f"(default={DEFAULT_PRESSURE_IDLE//60})")
+        parser.add_argument(
+            "--events-max-size", default=DEFAULT_EVENTS_MAX_SIZE // 2**20, type=int,
+            dest='events_max_size',
+            help="rotate the events files above that size in MiB, 0 to disable "
+                 f"(default={DEFAULT_EVENTS_MAX_SIZE // 2**20})")
+        parser.add_argument(
+            "--events-max-age", default=DEFAULT_EVENTS_MAX_AGE // (24*3600), type=int,
+            dest='events_max_age',
+            help="rotate the events files older than that many days, 0 to disable "
+                 f"(default={DEFAULT_EVENTS_MAX_AGE // (24*3600)})")
+        parser.add_argument(
+            "-e", "--events", action='store_true', default=False,
+            help="track containers from the podman events stream, "
+                 "rather than by listing them at each cycle")
         parser.add_argument(
             "-d", "--debug", action='store_true', default=False)
 
@@ -37,5 +89,16 @@ class Command(BaseCommand):
             period=60 * kwargs['period'],
             idle=60 * kwargs['idle'],
             lingering=3600 * kwargs['lingering'],
-            debug=kwargs['debug'])
+            debug=kwargs['debug'],
+            probe_concurrency=kwargs['concurrency'],
+            probe_timeout=kwargs['probe_timeout'],
+            events=kwargs['events'],
+            kill_workers=kwargs['kill_workers'],
+            sample_interval=kwargs['sample_interval'],
+            pressure=PressurePolicy(
+                available=kwargs['pressure_available'],
+                psi=kwargs['pressure_psi'],
+                idle=60 * kwargs['pressure_idle']),
+            events_max_size=2**20 * kwargs['events_max_size'],
+            events_max_age=24 * 3600 * kwargs['events_max_age'])
         monitor.run_forever()
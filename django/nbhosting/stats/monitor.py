@@ -7,9 +7,9 @@ import time
 from datetime import datetime
 import calendar
 import json
-import subprocess
 import logging
 import re
+import heapq
 
 from typing import Dict
 
@@ -23,13 +23,24 @@ PODMAN_URL = "unix:///run/podman/podman.sock"
 from nbh_main.settings import sitesettings
 from nbh_main.settings import monitor_logger as logger
 from nbhosting.courses.model_course import CourseDir
+from nbhosting.courses.image_cache import image_hash_cache
+from nbhosting.utils import percentiles
+from nbhosting.podman_async import AsyncPodman, AsyncPodmanError, AsyncPodmanNotFound
 
 from nbhosting.stats.stats import Stats
+from nbhosting.stats.platformstats import PlatformStats
+from nbhosting.stats.eventlog import drain_redis_events
+from nbhosting.stats.container_index import ContainerIndex, ContainerWatcher
+from nbhosting.courses.registry import container_registry
+from nbhosting.courses.pool import top_up_pools, POOL_LABEL
+from nbhosting.courses.spawn import FRESH_LABEL
+from nbhosting.stats.sampler import SystemSampler, DEFAULT_SAMPLE_INTERVAL
+from nbhosting.stats.cgroups import CgroupTracker
 
 # podman containers come in 2 flavours
 
-# first call to containers.list() returns a list of
-# objects whose attrs attribute is a dict that contains
+# one call to the containers list API returns a list of
+# dicts (the attrs of podman-py's containers.list()) that contain
 
 HighlevelContainer = Dict
 
@@ -37,7 +48,8 @@ HighlevelContainer = Dict
 # 'Id', 'Image', 'ImageID', 'IsInfra', 'Labels', 'Mounts', 'Names', 'Namespaces',
 # 'Networks', 'Pid', 'Pod', 'PodName', 'Ports', 'Size', 'StartedAt', 'State', 'Status'],
 
-# further call to containers.get(name) returns these keys
+# that is enough for the monitor, which only needs the State - as a string
+# a further call to containers.get(name) would return these keys
 
 LowlevelContainer = Dict
 
@@ -55,8 +67,9 @@ It will trigger on a cyclic basis - typically 15 minutes, and will
 * spot and kill jupyter instances that have had no recent activity
 * when an instance is killed, the stats/<course>/events.raw file
   is updated with a 'killing' line
-* also writes into stats/<course>/counts.raw one line with the numbers
+* also writes into stats/<course>/counts.bin one record with the numbers
   of jupyter instances (running and frozen), and number of running kernels
+  (see countstore.py)
 
 Also note that
 
@@ -71,14 +84,356 @@ Also note that
 # before we decide to kill it, to make sure it is not simply taking off
 # makes sense to pick something in the order of magnitude of the
 # global timeout in scripts/nbh
+# this waiting is done off the main cycle, see RecheckQueue
 GRACE = 30
 
+# how many /api/kernels probes can be in flight at the same time
+DEFAULT_PROBE_CONCURRENCY = 32
+# timeout in seconds for one /api/kernels probe
+DEFAULT_PROBE_TIMEOUT = 10
+# how many kill/remove operations can be in flight at the same time
+DEFAULT_KILL_WORKERS = 8
+# how many times we try to kill or remove a container
+KILL_ATTEMPTS = 3
+# wait that long before retrying, times the attempt number
+KILL_BACKOFF = 1.
+# memory pressure: the host is under pressure when the available memory
+# goes below that percentage of the total, or PSI memory above that percentage
+DEFAULT_PRESSURE_AVAILABLE = 10
+DEFAULT_PRESSURE_PSI = 20
+# the idle timeout that applies under pressure, in seconds
+DEFAULT_PRESSURE_IDLE = 10 * 60
+# containers active more recently than that are never reaped for pressure
+PRESSURE_FLOOR = 2 * 60
+# when pressure is only visible through PSI, try to release that
+# percentage of the total memory
+PRESSURE_PSI_RELEASE = 5
+# at most that many containers get killed for pressure in one cycle
+PRESSURE_MAX_KILLS = 32
+
+# the events files get rotated when they reach that size, in bytes
+DEFAULT_EVENTS_MAX_SIZE = 100 * 2**20
+# or when their first event is older than that, in seconds; 0 to disable
+DEFAULT_EVENTS_MAX_AGE = 0
+
+
+class KernelsProber:
+    """
+    the resources shared by all the /api/kernels probes in one monitor cycle
+
+    * one aiohttp session, i.e. one connection pool for the whole cycle
+    * a semaphore that bounds the number of probes in flight
+    * a timeout on each individual request
+    * the latencies of the successful probes, for reporting
+
+    to be used as an asynchronous context manager, from within the loop
+    """
+
+    def __init__(self, concurrency=DEFAULT_PROBE_CONCURRENCY,
+                 timeout=DEFAULT_PROBE_TIMEOUT):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.session = None
+        self.semaphore = None
+        self.latencies = []
+        self.failures = 0
+
+    async def __aenter__(self):
+        # both need to be created with the loop running
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def get_json(self, url):
+        async with self.semaphore:
+            beg = time.perf_counter()
+            try:
+                async with self.session.get(url) as response:
+                    json_str = await response.text()
+            except Exception:
+                self.failures += 1
+                raise
+            self.latencies.append(time.perf_counter() - beg)
+        return json.loads(json_str)
+
+    def report(self):
+        """
+        a one-liner about the latencies observed during the cycle
+        """
+        if not self.latencies:
+            return f"no successful probe ({self.failures} failures)"
+        p50, p90, p99, pmax = (
+            round(1000 * x)
+            for x in percentiles(self.latencies, (.5, .9, .99, 1.)))
+        return (f"{len(self.latencies)} probes: "
+                f"p50={p50}ms p90={p90}ms p99={p99}ms max={pmax}ms "
+                f"({self.failures} failures)")
+
+
+class RecheckQueue:
+    """
+    containers that look suspicious - unreachable, or running with no kernel -
+    are not killed right away, they get a second chance once
+    their grace period is over
+
+    instead of waiting inline, which would delay the whole cycle,
+    they are spared and recorded here, together with the reason why;
+    this state is carried across cycles, and the monitor re-probes them
+    when they are due - between cycles, or at the next cycle at the latest
+    """
+
+    def __init__(self, grace=GRACE):
+        self.grace = grace
+        # container name -> (reason, due, MonitoredJupyter)
+        self.suspects = {}
+
+    def __len__(self):
+        return len(self.suspects)
+
+    def check(self, monitored, reason, now):
+        """
+        to be called on a container that is found suspicious for reason
+
+        returns True if that container was already suspicious for
+        the same reason, and its grace period is over: time to kill it
+
+        otherwise the container is scheduled for a recheck, and False is returned
+        """
+        name = monitored.name
+        if name in self.suspects:
+            previous_reason, due, _ = self.suspects[name]
+            if previous_reason == reason:
+                if now >= due:
+                    del self.suspects[name]
+                    return True
+                # keep the most recent view on that container
+                self.suspects[name] = (reason, due, monitored)
+                return False
+        logger.info(f"{reason} (1) {monitored} - will try again in {self.grace}s")
+        self.suspects[name] = (reason, now + self.grace, monitored)
+        return False
+
+    def clear(self, monitored):
+        self.suspects.pop(monitored.name, None)
+
+    def prune(self, names):
+        """
+        forget about the containers that are gone
+        """
+        for name in list(self.suspects):
+            if name not in names:
+                del self.suspects[name]
+
+    def next_due(self):
+        return min((due for (_, due, _) in self.suspects.values()),
+                   default=None)
+
+    def due_monitoreds(self, now):
+        return [monitored for (_, due, monitored) in self.suspects.values()
+                if due <= now]
+
+    def discard_due(self, now):
+        """
+        after a recheck, all the due containers have been either
+        killed or rescheduled; anything left is stale
+        """
+        for name, (_, due, _) in list(self.suspects.items()):
+            if due <= now:
+                del self.suspects[name]
+
+
+class KillPipeline:
+    """
+    the kill and remove decisions made during a cycle are collected here
+    and then carried out all at once, by a bounded pool of workers
+    that share the same podman connection pool, with retries
+
+    the outcome is accounted for in each course's CourseFigures,
+    and the pipeline keeps track of its overall duration
+
+    index is the ContainerIndex in event-driven mode, that
+    needs to know which deaths are caused by the monitor
+    """
+
+    def __init__(self, workers=DEFAULT_KILL_WORKERS,
+                 attempts=KILL_ATTEMPTS, backoff=KILL_BACKOFF, index=None):
+        self.workers = workers
+        self.index = index
+        self.attempts = attempts
+        self.backoff = backoff
+        # a list of tuples (monitored, action)
+        self.jobs = []
+        self.done = 0
+        self.failed = 0
+        # in seconds
+        self.duration = 0.
+
+    def kill(self, monitored):
+        self.jobs.append((monitored, 'kill'))
+
+    def remove(self, monitored):
+        self.jobs.append((monitored, 'remove'))
+
+    async def co_run(self, podman_api):
+        if not self.jobs:
+            return
+        beg = time.perf_counter()
+        queue = asyncio.Queue()
+        for job in self.jobs:
+            queue.put_nowait(job)
+        self.jobs = []
+        nb_workers = min(self.workers, queue.qsize())
+        await asyncio.gather(
+            *(self._co_worker(queue, podman_api) for _ in range(nb_workers)))
+        self.duration += time.perf_counter() - beg
+
+    async def _co_worker(self, queue, podman_api):
+        while not queue.empty():
+            monitored, action = queue.get_nowait()
+            success = await self._co_carry_out(monitored, action, podman_api)
+            monitored.figures.count_kill(success)
+            if success:
+                # so that edxfront does not try to reuse it
+                container_registry().forget(monitored.name)
+                self.done += 1
+            else:
+                self.failed += 1
+
+    async def _co_carry_out(self, monitored, action, podman_api):
+        # the 'died' event may come before the kill call returns
+        if action == 'kill' and self.index is not None:
+            self.index.killing(monitored.name)
+        for attempt in range(1, self.attempts + 1):
+            try:
+                if action == 'kill':
+                    await monitored.co_kill_container(podman_api)
+                else:
+                    await monitored.co_remove_container(podman_api)
+                return True
+            except Exception as exc:
+                logger.warning(f"could not {action} {monitored} "
+                               f"(attempt {attempt}/{self.attempts}) - {exc}")
+                if attempt < self.attempts:
+                    await asyncio.sleep(self.backoff * attempt)
+        logger.error(f"giving up on {action} {monitored}")
+        if action == 'kill' and self.index is not None:
+            self.index.kill_failed(monitored.name)
+        return False
+
+    def report(self):
+        total = self.done + self.failed
+        if not total:
+            return "no container to kill"
+        rate = self.done / self.duration if self.duration else 0
+        return (f"{self.done}/{total} containers killed or removed "
+                f"in {self.duration:.1f}s ({rate:.1f}/s) "
+                f"- {self.failed} failures")
+
+
+class PressurePolicy:
+    """
+    decides whether the host is under memory pressure, from a sampler's sample
+
+    under pressure the monitor
+    * uses a shorter idle timeout
+    * and then kills the least recently active containers first,
+      until the estimated available memory is back above the threshold
+
+    the memory released by a kill is estimated from the container's
+    cgroup memory.current; a threshold set to 0 disables that criterion
+    """
+
+    def __init__(self, available=DEFAULT_PRESSURE_AVAILABLE,
+                 psi=DEFAULT_PRESSURE_PSI, idle=DEFAULT_PRESSURE_IDLE):
+        # percentages
+        self.available = available
+        self.psi = psi
+        # seconds
+        self.idle = idle
+
+    def assess(self, sample):
+        """
+        returns None if there is no pressure
+        otherwise the amount of memory to release, in bytes
+        """
+        meminfo = sample['meminfo']
+        total = meminfo.get('MemTotal')
+        available = meminfo.get('MemAvailable')
+        if not total or available is None:
+            return None
+        target = total * self.available / 100
+        if self.available and available < target:
+            logger.warning(f"memory pressure: available memory is "
+                           f"{100*available/total:.1f}% < {self.available}%")
+            return target - available
+        memory_pressure = sample['pressure'].get('memory')
+        if self.psi and memory_pressure:
+            psi = memory_pressure['some']['avg10']
+            if psi > self.psi:
+                logger.warning(f"memory pressure: PSI memory "
+                               f"is {psi:.1f}% > {self.psi}%")
+                return total * PRESSURE_PSI_RELEASE / 100
+        return None
+
+    @staticmethod
+    def reap(monitoreds, to_release, killer, now):
+        """
+        kill the least recently active among the spared containers
+        until the estimated released memory reaches to_release,
+        and no more than PRESSURE_MAX_KILLS of them
+
+        a container with no cgroup data is assumed to use the average
+        memory of the ones that do have some; with no cgroup data at all
+        there is no way to tell when to stop, so nothing gets killed
+        """
+        known = [mon.resources['memory_current']
+                 for mon in monitoreds if mon.resources]
+        if not known:
+            logger.warning("memory pressure: no cgroup data, "
+                           "cannot estimate the memory to release - not reaping")
+            return
+        average = sum(known) / len(known)
+        heap = [(mon.last_activity, index, mon)
+                for index, mon in enumerate(monitoreds)
+                if mon.spared and now - mon.last_activity > PRESSURE_FLOOR]
+        heapq.heapify(heap)
+        released, killed = 0, 0
+        while heap and released < to_release and killed < PRESSURE_MAX_KILLS:
+            last_activity, _, mon = heapq.heappop(heap)
+            idle_minutes = int((now - last_activity) // 60)
+            logger.warning(f"Killing (memory pressure) {mon} "
+                           f"that has been idle for {idle_minutes} mn")
+            killer.kill(mon)
+            mon.spared = False
+            killed += 1
+            released += mon.resources['memory_current'] if mon.resources else average
+        logger.info(f"memory pressure: {killed} more containers killed, "
+                    f"releasing about {int(released)//(1024**2)} "
+                    f"of {int(to_release)//(1024**2)} MiB")
+
+
 class CourseFigures:
 
     def __init__(self):
         self.frozen_containers = 0
         self.running_containers = 0
         self.running_kernels = 0
+        self.killed_containers = 0
+        self.kill_failures = 0
+        # from cgroups, since the previous cycle
+        self.cpu_seconds = 0.
+        # in bytes
+        self.memory_current = 0
+        self.oom_kills = 0
+        # from the podman events, the containers that died since the
+        # previous cycle without being killed by the monitor, e.g. oom
+        # or crash; None when the containers are listed at each cycle
+        self.died_containers = None
 
     # to avoid counting kernels in containers that get killed
     # we count updateboth counters at the same time
@@ -91,11 +446,32 @@ class CourseFigures:
         else:
             self.frozen_containers += 1
 
+    def count_kill(self, success: bool):
+        if success:
+            self.killed_containers += 1
+        else:
+            self.kill_failures += 1
+
+    def count_died(self, died: int):
+        self.died_containers = (self.died_containers or 0) + died
+
+    def add_kills(self, other):
+        """
+        the kills accounted for in other, see Monitor.pending_figures
+        """
+        self.killed_containers += other.killed_containers
+        self.kill_failures += other.kill_failures
+
+    def count_resources(self, resources: dict):
+        self.cpu_seconds += resources['cpu_seconds']
+        self.memory_current += resources['memory_current']
+        self.oom_kills += resources['oom_kill']
+
 
 class MonitoredJupyter:
 
-    # container is an instance of
-    #
+    # container is a HighlevelContainer, i.e. one item
+    # in the result of the bulk containers list
     def __init__(self,
                  container: HighlevelContainer,
                  course: str,
@@ -111,7 +487,10 @@ class MonitoredJupyter:
         #
         self.nb_kernels = None
         self.last_activity = 0.
-        self.inspection: LowlevelContainer = None
+        # see CgroupTracker; None if not found in the cgroups
+        self.resources = None
+        # True when found running and active, and not killed
+        self.spared = False
 
     def __str__(self):
         details = f" [{self.nb_kernels}k]" if self.nb_kernels is not None else ""
@@ -119,38 +498,48 @@ class MonitoredJupyter:
 
     @property
     def name(self):
-        return self.container.attrs['Names'][0]
+        return self.container['Names'][0]
+
+    @property
+    def state(self):
+        # e.g. 'running', 'exited', 'stopped', ...
+        return self.container['State']
+
+    def detailed_state(self):
+        container = self.container
+        return (f"State={container.get('State')} "
+                f"ExitCode={container.get('ExitCode')} "
+                f"ExitedAt={container.get('ExitedAt')}")
 
     def port_number(self):
         try:
-            return self.container.attrs['Ports'][0]['host_port']
+            return self.container['Ports'][0]['host_port']
         except Exception:
             logger.exception(f"Cannot locate port number for {self}")
             return 0
 
-    # podman does not seem to expose an asynchronous way to do this
-    def inspect(self):
-        # run only once
-        if self.inspection is None:
-            self.reload()
-
-    def reload(self):
-        # refresh no matter what
-        try:
-            with podman.PodmanClient(base_url=PODMAN_URL) as podman_api:
-                self.inspection = podman_api.containers.get(self.name).attrs
-        except podman.errors.InternalServerError:
-            logger.error(f"error 500 with {self.name}")
-            self.inspection = None
-
     def creation_time(self):
         # this returns format 2021-03-24T12:50:44.429575432Z
         # which has nanoseconds !
-        created = self.container.attrs['Created']
+        created = self.container['Created']
+        # some podman versions expose an epoch instead
+        if isinstance(created, (int, float)):
+            return created
         epoch = datetime.strptime(created[:-4], '%Y-%m-%dT%H:%M:%S.%f').timestamp()
         return epoch
 
 
+    def fresh_until(self):
+        """
+        the epoch until which a pre-spawned container is spared,
+        see course_prespawn; None for the other containers
+        """
+        labels = self.container.get('Labels') or {}
+        try:
+            return int(labels[FRESH_LABEL])
+        except (KeyError, ValueError):
+            return None
+
     def last_activity_human(self):
         timestamp = self.last_activity or 0
         return f"{datetime.fromtimestamp(timestamp):%H:%M}"
@@ -202,23 +591,26 @@ class MonitoredJupyter:
             return time.time()
 
 
-    async def count_running_kernels(self):
+    async def count_running_kernels(self, prober=None):
         """
         updates:
         * self.figures with number of running kernels
         * self.last_activity - a epoch/timestamp/nb of seconds
           may be None if using an old jupyter
+
+        prober is the KernelsProber shared across the monitor cycle;
+        when not provided, a private one is used
         """
+        if prober is None:
+            async with KernelsProber(concurrency=1) as private_prober:
+                return await self.count_running_kernels(private_prober)
         port = self.port_number()
         if not port:
             return
         url = f"http://localhost:{port}/{port}/api/kernels?token={self.name}"
         self.last_activity = None
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    json_str = await response.text()
-            api_kernels = json.loads(json_str)
+            api_kernels = await prober.get_json(url)
             self.nb_kernels = len(api_kernels)
 
             last_times = [
@@ -232,93 +624,113 @@ class MonitoredJupyter:
         except ClientConnectionError as _exc:
             logger.info(f"could not reach warming up {url} for last activity")
 
+        except asyncio.TimeoutError:
+            logger.info(f"timed out after {prober.timeout}s "
+                        f"when probing {url} for last activity")
+
         except Exception:
             logger.exception(f"Cannot probe number of kernels with {self} - unhandled exception")
 
 
-    def kill_container(self):
-        # using a new connection each time turns out much more robust
-        with podman.PodmanClient(base_url=PODMAN_URL) as podman_api:
-            podman_api.containers.get(self.name).kill()
+    # these 2 are carried out by the KillPipeline
+    async def co_kill_container(self, podman_api: AsyncPodman):
+        try:
+            await podman_api.kill_container(self.name)
+        # may happen with deferred rechecks
+        except AsyncPodmanNotFound:
+            logger.info(f"{self} has already gone")
 
     # this should not be needed in theory, but...
     # under heavy load we sometimes observe containers
     # that end up as 'stopped'
-    def remove_container(self):
-        with podman.PodmanClient(base_url=PODMAN_URL) as podman_api:
-            podman_api.containers.get(self.name).remove()
+    async def co_remove_container(self, podman_api: AsyncPodman):
+        try:
+            await podman_api.remove_container(self.name)
+        except AsyncPodmanNotFound:
+            logger.info(f"{self} has already gone")
 
 
-    async def co_run(self, idle, lingering):
+    async def co_run(self, idle, lingering, prober, rechecks, killer):
         try:
-            await self._co_run(idle, lingering)
+            await self._co_run(idle, lingering, prober, rechecks, killer)
         except Exception as exc:
             # xx used to be a simple error but until pip podman 3.x is settled
             # it's probably best like this
             logger.exception(f"unexpected error {type(exc)} "
                              f"when dealing with {self.name} - ignored\n...exception={exc}")
 
-    async def _co_run(self, idle, lingering):
+    async def _co_run(self, idle, lingering, prober, rechecks, killer):
         """
         both timeouts in seconds
+        rechecks is the RecheckQueue where suspicious containers are deferred
+        killer is the KillPipeline where the containers to kill are sent
         """
         now = time.time()
-        self.reload()
-        # inspection remains None on InternalServerError
-        if self.inspection is None:
-            logger.info(f"BLIP weirdo (0) {self.name} - cannot inspect - ignored")
-            return
-
-        state = self.inspection['State']['Status']
+        # the state comes with the bulk list, no need to inspect
+        state = self.state
 
         if state in ('stopped', 'configured'):
             logger.info(f"BLIP weirdo (1) {self.name} - removing")
-            logger.info(f"BLIP weirdo (1) detailed state was {self.inspection['State']}")
-            self.remove_container()
+            logger.info(f"BLIP weirdo (1) detailed state was {self.detailed_state()}")
+            killer.remove(self)
             return
 
         # ignore non running containers
         if state != 'running':
             logger.info(f"BLIP weirdo (2) {self.name} - ignoring")
-            logger.info(f"BLIP weirdo (2) detailed state was {self.inspection['State']}")
+            logger.info(f"BLIP weirdo (2) detailed state was {self.detailed_state()}")
+            return
+
+        # pre-spawned for a classroom session that has not started yet;
+        # not spared either, so memory pressure does not reap it
+        fresh_until = self.fresh_until()
+        if fresh_until and now < fresh_until:
+            logger.debug(f"Sparing pre-spawned {self} until "
+                         f"{datetime.fromtimestamp(fresh_until):%H:%M}")
+            rechecks.clear(self)
+            self.figures.count_container(True)
             return
 
         # count number of kernels and last activity
-        await self.count_running_kernels()
+        await self.count_running_kernels(prober)
+        # a pre-spawned container has probably not been used before the
+        # session starts, so the idle timeout starts with the session
+        if fresh_until and self.last_activity is not None:
+            self.last_activity = max(self.last_activity, fresh_until)
         # last_activity may be 0 if no kernel is running inside that container
         # or None if we could not determine it properly
         if self.last_activity is None:
             # an unreachable container may be one that is just taking off
             # as unlikely as that sounds, it actually tends to happen much more
             # often than I at least had foreseen at first
-            logger.info(f"unreachable (1) {self} - will try again in {GRACE}s")
-            await asyncio.sleep(GRACE)
-            await self.count_running_kernels()
-            if self.last_activity is None:
-                logger.info(f"Killing unreachable (2) {self}")
-                self.kill_container()
+            if not rechecks.check(self, 'unreachable', now):
+                self.figures.count_container(True, self.nb_kernels)
                 return
+            logger.info(f"Killing unreachable (2) {self}")
+            killer.kill(self)
+            return
         # check there has been activity in the last grace_idle_in_minutes
         idle_minutes = (int)((now - self.last_activity) // 60)
         if (now - self.last_activity) < idle:
             logger.debug(
                 f"Sparing running {self} that had activity {idle_minutes} mn ago")
+            rechecks.clear(self)
             self.figures.count_container(True, self.nb_kernels)
+            self.spared = True
         elif self.last_activity == 0:
-            logger.info(f"running and empty (1) {self} - will try again in {GRACE}s")
-            await asyncio.sleep(GRACE)
-            await self.count_running_kernels()
-            if self.last_activity == 0:
-                logger.info(
-                    f"Killing (running and empty) (2) {self} "
-                    f"that has no kernel attached")
-                self.kill_container()
+            if not rechecks.check(self, 'running and empty', now):
+                self.figures.count_container(True, self.nb_kernels)
                 return
+            logger.info(
+                f"Killing (running and empty) (2) {self} "
+                f"that has no kernel attached")
+            killer.kill(self)
+            return
         else:
             logger.info(
                 f"Killing (running & idle) {self} "
                 f"that has been idle for {idle_minutes} mn")
-            self.kill_container()
+            killer.kill(self)
             return
 
         # if students accidentally leave stuff running in the background
@@ -334,13 +746,22 @@ class MonitoredJupyter:
                 f"Removing lingering {self} "
                 f"that was created {created_days} days "
                 f"{created_hours} hours ago (idle_minutes={idle_minutes})")
-            self.kill_container()
+            self.spared = False
+            killer.kill(self)
             return
 
 
 class Monitor:
 
-    def __init__(self, period, idle, lingering, debug):
+    def __init__(self, period, idle, lingering, debug,
+                 probe_concurrency=DEFAULT_PROBE_CONCURRENCY,
+                 probe_timeout=DEFAULT_PROBE_TIMEOUT,
+                 events=False,
+                 kill_workers=DEFAULT_KILL_WORKERS,
+                 sample_interval=DEFAULT_SAMPLE_INTERVAL,
+                 pressure=None,
+                 events_max_size=DEFAULT_EVENTS_MAX_SIZE,
+                 events_max_age=DEFAULT_EVENTS_MAX_AGE):
         """
         All times in seconds
 
@@ -348,21 +769,56 @@ class Monitor:
           period: is how often the monitor runs
           grace: is how long an idle container is kept running before we kill it
           debug(bool): turn on more logs
+          probe_concurrency: max. number of jupyter http probes in flight
+          probe_timeout: timeout for each jupyter http probe
+          events(bool): track containers from the podman events stream
+            instead of listing them at each cycle
+          kill_workers: max. number of kill/remove operations in flight
+          sample_interval: how often the system facts are sampled
+          pressure: a PressurePolicy, a default one is used if not set
+          events_max_size, events_max_age: when to rotate the events files,
+            0 to disable
         """
         self.period = period
         self.idle = idle
         self.lingering = lingering
+        self.probe_concurrency = probe_concurrency
+        self.probe_timeout = probe_timeout
+        self.kill_workers = kill_workers
+        self.events_max_size = events_max_size
+        self.events_max_age = events_max_age
         if debug:
             logger.setLevel(logging.DEBUG)
         self._graphroot = None
         self.system_containers = 0
         self.system_kernels = 0
+        # the kill pipeline for the current cycle
+        self.killer = KillPipeline()
+        self.rechecks = RecheckQueue()
+        # in event-driven mode, the ContainerWatcher
+        # gets started in run_forever
+        self.index = ContainerIndex() if events else None
+        # started in run_forever as well
+        self.sampler = SystemSampler(sample_interval)
+        self.cgroups = CgroupTracker()
+        self.pressure = pressure or PressurePolicy()
+        # how much memory we need to release, None when no pressure
+        self.to_release = None
+        # the idle timeout in use - shorter under pressure
+        self.effective_idle = idle
+        # when the previous cycle gathered the system facts
+        self._last_facts = None
+        # coursename -> number of warm containers after the previous cycle
+        self.pool_levels = {}
+        # coursename -> CourseFigures, where the kills performed during
+        # the rechecks are accounted for, until the next cycle writes them
+        self.pending_figures = {}
 
 
     def run_once(self):
         try:
             return self._run_once()
-        except podman.errors.InternalServerError as exc:
+        except (podman.errors.InternalServerError, AsyncPodmanError) as exc:
             reporter = logger.exception if sitesettings.DEBUG else logger.error
             reporter(f"{exc} - skipping rest of monitor cycle")
         except Exception:
@@ -373,9 +829,30 @@ class Monitor:
     def _run_once(self):
         figures_by_course = {c.coursename : CourseFigures()
                              for c in CourseDir.objects.all()}
+        # the kills made during the rechecks since the previous cycle
+        pending, self.pending_figures = self.pending_figures, {}
+        for coursename, figures in pending.items():
+            if coursename in figures_by_course:
+                figures_by_course[coursename].add_kills(figures)
         disk_spaces, loads, memory = self._gather_system_facts(figures_by_course)
         self._scan_containers(figures_by_course)
         self._write_results(figures_by_course, disk_spaces, loads, memory)
+        self._maintain_events(figures_by_course)
+        # no new warm containers under memory pressure
+        top_up_pools(CourseDir.objects.all(), self.pool_levels,
+                     grow=self.to_release is None, lingering=self.lingering)
+
+    def _maintain_events(self, figures_by_course):
+        # write the events lines buffered in redis by the web workers
+        if getattr(sitesettings, 'events_buffering', None) == 'redis':
+            try:
+                drained = drain_redis_events()
+                logger.info(f"wrote {drained} events lines from redis")
+            except Exception:
+                logger.exception("could not drain events lines from redis")
+        for coursename in figures_by_course:
+            Stats(coursename).rotate_events(
+                self.events_max_size, self.events_max_age)
 
     def _scan_containers(self, figures_by_course):
 
@@ -384,20 +861,137 @@ class Monitor:
         logger.info(f"monitor cycle with period={self.period//60}' "
                     f"idle={self.idle//60}' "
                     f"lingering={self.lingering//3600}h")
+        # mostly served from the image hash cache
         hash_by_course = {c.coursename : c.image_hash()
                           for c in CourseDir.objects.all()}
+        # the lookups since the previous cycle, this one included
+        logger.info(image_hash_cache.report(reset=True))
 
-        with podman.PodmanClient(base_url=PODMAN_URL) as podman_api:
-            # returns None when no container is found !
-            containers = podman_api.containers.list(all=True)
-        logger.info(f"found {len(hash_by_course)} courses "
-                    f"and {len(containers)} containers")
+        # resources used by each container, from cgroups
+        resources_by_id = self.cgroups.scan()
 
+        # the sampler has just taken a fresh sample
+        self.to_release = self.pressure.assess(self.sampler.latest())
+        self.effective_idle = self.idle if self.to_release is None \
+            else min(self.idle, self.pressure.idle)
+        if self.to_release is not None:
+            logger.warning(f"under memory pressure, idle timeout is "
+                           f"{self.effective_idle//60}'")
+
+        # run the whole stuff
+        beg = time.time()
+        self.killer = KillPipeline(self.kill_workers, index=self.index)
+        monitoreds, prober = asyncio.get_event_loop().run_until_complete(
+            self._co_scan(figures_by_course, hash_by_course, resources_by_id))
+        logger.info(f"probing took {time.time()-beg:.1f}s - {prober.report()}")
+        logger.info(self.killer.report())
+
+        self.system_containers = len(monitoreds)
+        self.system_kernels = sum((mon.nb_kernels or 0) for mon in monitoreds)
+
+
+    async def _co_scan(self, figures_by_course, hash_by_course, resources_by_id):
+        # one connection pool to podman, and one to the jupyters
+        async with AsyncPodman() as podman_api, \
+                   KernelsProber(self.probe_concurrency,
+                                 self.probe_timeout) as prober:
+            containers = await self._co_containers(podman_api, figures_by_course)
+            logger.info(f"found {len(hash_by_course)} courses "
+                        f"and {len(containers)} containers")
+            monitoreds = self._monitoreds(
+                containers, figures_by_course, hash_by_course)
+            for mon in monitoreds:
+                mon.resources = resources_by_id.get(mon.container['Id'])
+                if mon.resources:
+                    mon.figures.count_resources(mon.resources)
+            self.rechecks.prune(set(mon.name for mon in monitoreds))
+            await self._co_run_monitoreds(monitoreds, prober)
+            if self.to_release is not None:
+                self._release_memory(monitoreds)
+            await self.killer.co_run(podman_api)
+        return monitoreds, prober
+
+    def _release_memory(self, monitoreds):
+        # the containers already doomed release memory too
+        doomed = set(mon.name for mon, _ in self.killer.jobs)
+        released = sum(mon.resources['memory_current'] for mon in monitoreds
+                       if mon.name in doomed and mon.resources)
+        if released < self.to_release:
+            self.pressure.reap(
+                monitoreds, self.to_release - released, self.killer, time.time())
+
+    async def _co_containers(self, podman_api, figures_by_course):
+        # event-driven mode: no need to ask podman
+        if self.index is not None and self.index.synced:
+            containers, died = self.index.snapshot()
+            for figures in figures_by_course.values():
+                figures.died_containers = 0
+            for coursename, number in died.items():
+                if coursename in figures_by_course:
+                    figures_by_course[coursename].count_died(number)
+            if died:
+                details = ", ".join(f"{course}:{nb}" for course, nb in died.items())
+                logger.info(f"{sum(died.values())} containers have died unexpectedly "
+                            f"since last cycle ({details})")
+            return containers
+        # one single call gets the state of all containers
+        return await podman_api.list_containers(all=True)
+
+    async def _co_run_monitoreds(self, monitoreds, prober):
+        futures = [mon.co_run(self.effective_idle, self.lingering,
+                              prober, self.rechecks, self.killer)
+                   for mon in monitoreds]
+        await asyncio.gather(*futures)
+
+    def run_rechecks(self):
+        """
+        re-probe the suspicious containers whose grace period is over
+        this is done between cycles, so the figures have already been written;
+        the outcome goes in pending_figures, for the next cycle to write
+        """
+        now = time.time()
+        monitoreds = self.rechecks.due_monitoreds(now)
+        if not monitoreds:
+            return
+        logger.info(f"re-checking {len(monitoreds)} suspicious container(s)")
+        for mon in monitoreds:
+            mon.figures = self.pending_figures.setdefault(mon.course, CourseFigures())
+        self.killer = KillPipeline(self.kill_workers, index=self.index)
+        try:
+            asyncio.get_event_loop().run_until_complete(
+                self._co_rechecks(monitoreds))
+            logger.info(f"rechecks: {self.killer.report()}")
+        finally:
+            self.rechecks.discard_due(now)
+
+    async def _co_rechecks(self, monitoreds):
+        async with AsyncPodman() as podman_api, \
+                   KernelsProber(self.probe_concurrency,
+                                 self.probe_timeout) as prober:
+            # the container dicts are from the previous cycle, get fresh ones
+            containers = await podman_api.list_containers(
+                all=True, filters={'id': [mon.container['Id'] for mon in monitoreds]})
+            by_id = {container['Id']: container for container in containers}
+            current = []
+            for mon in monitoreds:
+                container = by_id.get(mon.container['Id'])
+                if container is None:
+                    logger.info(f"{mon} is gone - no need to recheck")
+                    continue
+                mon.container = container
+                current.append(mon)
+            await self._co_run_monitoreds(current, prober)
+            await self.killer.co_run(podman_api)
 
+    @staticmethod
+    def _monitoreds(containers, figures_by_course, hash_by_course):
         monitoreds = []
         for container in containers:
+            name = container['Names'][0]
+            # the warm containers are not bound to a student yet
+            if '-x-' not in name and POOL_LABEL in (container.get('Labels') or {}):
+                continue
             try:
-                name = container.attrs['Names'][0]
                 coursename, student = name.split('-x-')
                 figures_by_course.setdefault(coursename, CourseFigures())
                 figures = figures_by_course[coursename]
@@ -411,26 +1005,15 @@ class Monitor:
             except ValueError:
                 # ignore this container as we don't even know
                 # in what course it belongs
-                logger.info(f"ignoring non-nbhosting {container}")
+                logger.info(f"ignoring non-nbhosting {name}")
             except KeyError:
                 # typically hash_by_course[coursename] is failing
                 # this may happen when a course gets outdated
-                logger.info(f"ignoring container {container} - "
+                logger.info(f"ignoring container {name} - "
                             f"can't find image hash for {coursename}")
             except Exception:
-                logger.exception(f"monitor has to ignore {container}")
-
-        # run the whole stuff
-        futures = [mon.co_run(self.idle, self.lingering)
-                   for mon in monitoreds]
-
-        #asyncio.run(asyncio.gather(*futures))
-        asyncio.get_event_loop().run_until_complete(
-            asyncio.gather(*futures))
-
-        self.system_containers = len(monitoreds)
-        self.system_kernels = sum((mon.nb_kernels or 0) for mon in monitoreds)
-
+                logger.exception(f"monitor has to ignore {name}")
+        return monitoreds
 
     def _gather_system_facts(self, figures_by_course):
         # ds stands for disk_space
@@ -456,39 +1039,23 @@ class Monitor:
                 logger.exception(
                     f"monitor cannot compute disk space {name} on {root}")
 
-        # loads
-        try:
-            uptime_output = subprocess.check_output('uptime').decode().strip()
-            end_of_line = uptime_output.split(':')[-1]
-            floads = end_of_line.split(', ')
-            load1, load5, load15 = [round(100*float(x)) for x in floads]
-
-        except Exception:
-            load1, load5, load15 = 0, 0, 0
-            logger.exception(f"monitor cannot compute cpu loads")
-
+        # loads, memory and pressure come from the sampler
+        # take a fresh sample for the loads and memory
+        sample = self.sampler.sample()
+        load1, load5, load15 = [round(100*x) for x in sample['loads']]
         loads = dict(load1=load1, load5=load5, load15=load15)
 
-        # memory from /proc/meminfo
-        try:
-            def handle_line(line):
-                _label, value, unit = line.split()
-                if unit == 'kB':
-                    return int(value) * 1024
-                logger.warning(f"unexpected unit {unit} in meminfo")
-                return 0
-            with open("/proc/meminfo") as feed:
-                total_line = feed.readline()
-                free_line  = feed.readline()
-                avail_line  = feed.readline()
-                total_mem = handle_line(total_line)
-                free_mem = handle_line(free_line)
-                avail_mem = handle_line(avail_line)
-        except:
-            logger.exception("failed to probe memory")
-            total_mem, free_mem, avail_mem = 0, 0, 0
-
-        memory = dict(memory_total=total_mem, memory_free=free_mem, memory_available=avail_mem)
+        meminfo = sample['meminfo']
+        memory = dict(memory_total=meminfo.get('MemTotal', 0),
+                      memory_free=meminfo.get('MemFree', 0),
+                      memory_available=meminfo.get('MemAvailable', 0))
+
+        # pressure is the peak over the samples taken since the last cycle
+        # as a percentage times 100, like the loads
+        since, self._last_facts = self._last_facts, sample['time']
+        for resource in ('cpu', 'memory', 'io'):
+            loads[f'{resource}_pressure'] = round(
+                100 * self.sampler.peak_pressure(resource, since))
 
         return disk_spaces, loads, memory
 
@@ -496,6 +1063,21 @@ class Monitor:
                        disk_spaces, loads, memory):
         coursedirs_by_name = {c.coursename : c
                               for c in CourseDir.objects.all()}
+        # the same timestamp in all stores, so they can be matched
+        now = time.time()
+        # the system-wide figures are written once
+        PlatformStats().record_monitor_counts(
+            loads['load1'], loads['load5'], loads['load15'],
+            disk_spaces['container']['percent'], disk_spaces['container']['free'],
+            disk_spaces['nbhosting']['percent'], disk_spaces['nbhosting']['free'],
+            disk_spaces['system']['percent'], disk_spaces['system']['free'],
+            memory['memory_total'], memory['memory_free'], memory['memory_available'],
+            self.system_containers, self.system_kernels,
+            # in ms, for all courses
+            round(1000 * self.killer.duration),
+            loads['cpu_pressure'], loads['memory_pressure'], loads['io_pressure'],
+            timestamp=now,
+        )
         # write results
         for coursename, figures in figures_by_course.items():
             nb_student_homes = coursedirs_by_name[coursename].nb_student_homes()
@@ -503,12 +1085,13 @@ class Monitor:
                 figures.running_containers, figures.frozen_containers,
                 figures.running_kernels,
                 nb_student_homes,
-                loads['load1'], loads['load5'], loads['load15'],
-                disk_spaces['container']['percent'], disk_spaces['container']['free'],
-                disk_spaces['nbhosting']['percent'], disk_spaces['nbhosting']['free'],
-                disk_spaces['system']['percent'], disk_spaces['system']['free'],
-                memory['memory_total'], memory['memory_free'], memory['memory_available'],
-                self.system_containers, self.system_kernels,
+                figures.killed_containers, figures.kill_failures,
+                round(figures.cpu_seconds),
+                # in MiB
+                round(figures.memory_current / (1024**2)),
+                figures.oom_kills,
+                figures.died_containers,
+                timestamp=now,
             )
 
     def run_forever(self):
@@ -517,6 +1100,10 @@ class Monitor:
         # one cycle can take some time as all the jupyters need to be http-probed
         # so let us compute the actual time to wait
         logger.info("nbh-monitor is starting up")
+        if self.index is not None:
+            logger.info("tracking containers from the podman events stream")
+            ContainerWatcher(self.index).start()
+        self.sampler.start()
         for c in CourseDir.objects.all():
             Stats(c.coursename).record_monitor_known_counts_line()
         while True:
@@ -528,4 +1115,19 @@ class Monitor:
             tick += self.period
             duration = max(0, int(tick - time.time()))
             logger.info(f"monitor is waiting for {duration}s")
-            time.sleep(duration)
+            self.wait_until(tick)
+
+    def wait_until(self, tick):
+        """
+        sleep until tick, while taking care of the deferred rechecks
+        """
+        while True:
+            due = self.rechecks.next_due()
+            if due is None or due >= tick:
+                time.sleep(max(0, tick - time.time()))
+                return
+            time.sleep(max(0, due - time.time()))
+            try:
+                self.run_rechecks()
+            except Exception:
+                logger.exception("Unexpected error in rechecks")
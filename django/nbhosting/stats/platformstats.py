@@ -0,0 +1,220 @@
+"""
+stats for the whole platform, i.e. across all courses - raw/.platform
+
+* the system counts (loads, memory, disk space...) are the same for
+  all courses, so the monitor writes them once per cycle in
+  raw/.platform/counts.bin, see Stats.system_counts
+* the counts of all courses are merged on their timestamps, and the
+  events of all courses are merged day by day, from the per-course
+  aggregates that are maintained incrementally - see PlatformConsumer;
+  this produces platform-wide figures: concurrent containers,
+  the share of each course, and the peak hours
+"""
+
+# pylint: disable=c0111, w0703
+
+import json
+import time
+import datetime
+from collections import defaultdict
+
+import numpy as np
+
+from nbhosting.stats.stats import (
+    Stats, platform_dir, platform_counts_store, prepare_platform_counts)
+from nbhosting.stats.countstore import align, MISSING, TIMESTAMP
+from nbhosting.stats import downsample
+from nbhosting.stats.resultcache import SourceSignature, ResultCache
+from nbhosting.courses.model_course import CourseDir
+from nbh_main.settings import logger
+
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+
+class PlatformStats:
+
+    # bump this whenever the format of the results changes
+    results_layout = 2
+
+    ####################
+    def record_monitor_counts(self, *args, timestamp=None):
+        """
+        the values of Stats.system_counts, in that order
+        """
+        store = platform_counts_store()
+        if len(args) > len(Stats.system_counts):
+            logger.error(f"two many arguments to counts line "
+                         f"- dropped {args} from {store.path}")
+            return
+        try:
+            if not store.exists():
+                prepare_platform_counts()
+            store.append(timestamp or time.time(), args)
+        except Exception as exc:
+            logger.exception(f"Cannot store counts record into {store.path}, {type(exc)}")
+
+    ####################
+    @staticmethod
+    def _staffs_by_course():
+        return {coursedir.coursename: coursedir.staffs
+                for coursedir in CourseDir.objects.all()}
+
+    def result_signature(self):
+        staffs_by_course = self._staffs_by_course()
+        paths = [platform_counts_store().path]
+        for coursename in sorted(staffs_by_course):
+            stats = Stats(coursename)
+            paths.append(stats.monitor_counts_store().path)
+            paths.extend(stats.notebook_events_segments())
+        extras = [f"{coursename}:{','.join(sorted(staffs))}"
+                  for coursename, staffs in sorted(staffs_by_course.items())]
+        return SourceSignature(paths, self.results_layout, *extras)
+
+    def cached_json(self, signature, *args):
+        """
+        returns the JSON-encoded result of self.platform_usage(*args)
+        as bytes, from the cache if the sources have not changed
+        """
+        cache = ResultCache(platform_dir() / ".cache")
+        encoded = cache.get('platform_usage', signature, args)
+        if encoded is None:
+            encoded = json.dumps(self.platform_usage(*args)).encode()
+            cache.put('platform_usage', signature, args, encoded)
+        return encoded
+
+    def platform_usage(self, start=None, end=None, max_points=None):
+        """
+        returns a dict with the following keys
+        * 'timestamps', 'system_containers', 'system_kernels' : the monitor
+          figures for the whole platform, downsampled to max_points
+        * 'containers_by_course' : a dict course -> running containers
+          at the same timestamps
+        * 'shares' : a dict course -> dict with 'container_hours',
+          'opens' (notebooks opened) and 'students'
+        * 'peak_hours' : a dict with
+          'weekdays', 'hours' : the labels,
+          'opens' : the number of notebooks opened, 7 x 24 (weekday x hour)
+          'containers' : the mean number of containers, 24 (hour)
+        * 'daily' : the platform-wide unique/new students/notebooks per day
+          like in Stats.daily_metrics
+
+        start and end (epochs) restrict the time range; the parts
+        that come from the events - shares, opens and daily - are
+        aggregated per day, so there the range is rounded to whole days
+        """
+        staffs_by_course = self._staffs_by_course()
+        result = self._merged_counts(sorted(staffs_by_course), start, end, max_points)
+        self._merged_events(staffs_by_course, start, end, result)
+        return result
+
+    def _merged_counts(self, coursenames, start, end, max_points):
+        store = platform_counts_store()
+        if store.exists():
+            columns, records = store.read()
+        else:
+            columns = [TIMESTAMP] + Stats.system_counts
+            records = np.empty((0, len(columns)), dtype=np.int64)
+        epochs = records[:, columns.index(TIMESTAMP)]
+        selected = downsample.select_range(epochs, start, end)
+        records, epochs = records[selected], epochs[selected]
+
+        def as_floats(column):
+            values = column.astype('float64')
+            values[column == MISSING] = np.nan
+            return values
+
+        system = {f"{count}s": as_floats(records[:, columns.index(count)])
+                  for count in ('system_container', 'system_kernel')}
+        # how long each record stands for, the monitor outages left aside
+        if len(epochs) > 1:
+            period = np.median(np.diff(epochs))
+            durations = np.minimum(
+                np.diff(epochs, append=epochs[-1] + period), 2 * period)
+        else:
+            durations = np.zeros(len(epochs))
+
+        containers_by_course = {}
+        shares = {}
+        for coursename in coursenames:
+            course_store = Stats(coursename).monitor_counts_store()
+            running = np.full(len(epochs), np.nan)
+            if course_store.exists() and len(epochs):
+                course_columns, course_records = course_store.read()
+                index = align(epochs, course_records[:, course_columns.index(TIMESTAMP)],
+                              Stats.counts_tolerance)
+                found = index >= 0
+                running[found] = as_floats(course_records[
+                    index[found], course_columns.index('running_container')])
+            containers_by_course[coursename] = running
+            shares[coursename] = dict(
+                container_hours=round(float(np.nansum(running * durations)) / 3600, 1),
+                opens=0, students=0)
+
+        # mean number of containers per hour of the day
+        containers = system['system_containers']
+        known = ~np.isnan(containers)
+        hours = (epochs[known] // 3600) % 24
+        sums = np.bincount(hours, weights=containers[known], minlength=24)
+        counts = np.bincount(hours, minlength=24)
+        with np.errstate(invalid='ignore'):
+            hourly = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+        timestamps, result, envelopes = downsample.series(
+            epochs, system, max_points=max_points)
+        _, by_course, _ = downsample.series(
+            epochs, containers_by_course, max_points=max_points)
+        result['timestamps'] = timestamps
+        if envelopes:
+            result['envelopes'] = envelopes
+        result['containers_by_course'] = by_course
+        result['shares'] = shares
+        result['peak_hours'] = dict(
+            weekdays=WEEKDAYS, hours=list(range(24)),
+            containers=downsample.float_column_to_list(hourly, digits=2))
+        return result
+
+    @staticmethod
+    def _merged_events(staffs_by_course, start, end, result):
+        start, end = (None if epoch is None
+                      else time.strftime("%Y-%m-%d", time.gmtime(epoch))
+                      for epoch in (start, end))
+        opens = np.zeros((7, 24), dtype=np.int64)
+        opens_by_course = defaultdict(int)
+        students_by_course = defaultdict(set)
+        # day -> students, and notebooks, over all courses
+        students_by_day = defaultdict(set)
+        notebooks_by_day = defaultdict(set)
+        for coursename in sorted(staffs_by_course):
+            for day, hourly, students, notebooks in \
+                    Stats(coursename).daily_activity(start, end):
+                try:
+                    weekday = datetime.date.fromisoformat(day).weekday()
+                except ValueError:
+                    logger.error(f"{coursename}: skipped events with bad day {day}")
+                    continue
+                opens[weekday] += hourly
+                opens_by_course[coursename] += sum(hourly)
+                students_by_course[coursename] |= students
+                students_by_day[day] |= students
+                # notebooks from different courses are different notebooks
+                notebooks_by_day[day].update(
+                    f"{coursename}:{notebook}" for notebook in notebooks)
+        for coursename, share in result['shares'].items():
+            share['opens'] = opens_by_course[coursename]
+            share['students'] = len(students_by_course[coursename])
+        result['peak_hours']['opens'] = opens.tolist()
+        # like DailyConsumer.result()
+        daily = defaultdict(list)
+        cumul_students, cumul_notebooks = set(), set()
+        for day in sorted(students_by_day):
+            students, notebooks = students_by_day[day], notebooks_by_day[day]
+            daily['timestamps'].append(f"{day} 23:59:59")
+            daily['unique_students'].append(len(students))
+            daily['unique_notebooks'].append(len(notebooks))
+            daily['new_students'].append(len(students - cumul_students))
+            daily['new_notebooks'].append(len(notebooks - cumul_notebooks))
+            cumul_students |= students
+            cumul_notebooks |= notebooks
+        result['daily'] = {key: daily[key] for key in (
+            'timestamps', 'unique_students', 'unique_notebooks',
+            'new_students', 'new_notebooks')}
@@ -0,0 +1,87 @@
+"""
+a file cache for the JSON results of the stats views, shared by
+all the web workers, and stored in raw/<course>/.cache
+
+a result is valid as long as its source files are unchanged, so
+the entries are named after
+* the kind of result, e.g. 'material_usage'
+* a signature of its sources - typically size/mtime/inode of events.raw
+* a signature of the query parameters
+
+the source signature also serves to build the ETag of the response
+"""
+
+# pylint: disable=c0111, w0703
+
+import os
+import hashlib
+import tempfile
+
+from nbh_main.settings import logger
+
+
+def _digest(text):
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+class SourceSignature:
+    """
+    describes the state of the files a result is computed from,
+    plus any other relevant input (e.g. the staffs)
+    """
+
+    def __init__(self, paths, *extras):
+        parts = []
+        self.last_modified = None
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                parts.append(f"{path}:-")
+                continue
+            parts.append(f"{path}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}")
+            self.last_modified = max(self.last_modified or 0, stat.st_mtime)
+        parts.extend(str(extra) for extra in extras)
+        self.digest = _digest(" ".join(parts))
+
+
+class ResultCache:
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, kind, source_digest, params_digest):
+        return self.directory / f"{kind}-{source_digest}-{params_digest}.json"
+
+    @staticmethod
+    def params_digest(params):
+        return _digest(repr(params))
+
+    def get(self, kind, signature, params):
+        path = self._path(kind, signature.digest, self.params_digest(params))
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logger.exception(f"could not read cached result {path}")
+            return None
+
+    def put(self, kind, signature, params, encoded: bytes):
+        """
+        store a result, and remove the entries of that kind
+        that were computed from older sources
+        """
+        try:
+            self.directory.mkdir(exist_ok=True)
+            path = self._path(kind, signature.digest, self.params_digest(params))
+            with tempfile.NamedTemporaryFile(
+                    'wb', dir=self.directory, prefix=f".{path.name}.",
+                    delete=False) as feed:
+                feed.write(encoded)
+            os.replace(feed.name, path)
+            for stale in self.directory.glob(f"{kind}-*.json"):
+                if not stale.name.startswith(f"{kind}-{signature.digest}-"):
+                    stale.unlink(missing_ok=True)
+        except Exception:
+            logger.exception(f"could not cache {kind} result in {self.directory}")
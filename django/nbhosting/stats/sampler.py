@@ -0,0 +1,210 @@
+"""
+a cheap sampler for the system facts that the monitor records
+
+everything is read straight from /proc and /sys - no subprocess:
+* /proc/loadavg
+* /proc/meminfo
+* /proc/pressure/{cpu,memory,io} - PSI, pressure stall information
+* the cgroup v2 stats of the slice where the containers run
+
+the sampler runs in a daemon thread, at a finer grain than the monitor
+period, and keeps a rolling window of samples in memory; each sample
+is a plain dict, with its 'time' as an epoch
+"""
+
+# pylint: disable=c0111, w0703
+
+import time
+import threading
+from collections import deque
+
+from nbh_main.settings import monitor_logger as logger
+
+# in seconds
+DEFAULT_SAMPLE_INTERVAL = 10
+# how many samples we keep; at 10s that is 2 hours
+DEFAULT_WINDOW = 720
+
+PSI_RESOURCES = ('cpu', 'memory', 'io')
+
+# rootful podman puts the containers in there
+# it is also where to look for a cgroup-wide memory.current
+CONTAINERS_CGROUP = "/sys/fs/cgroup/machine.slice"
+
+
+def read_loadavg():
+    """
+    a tuple of 3 floats
+    """
+    with open("/proc/loadavg") as feed:
+        load1, load5, load15, *_ = feed.read().split()
+    return float(load1), float(load5), float(load15)
+
+
+def read_meminfo():
+    """
+    a dict like {'MemTotal': ..., 'MemFree': ...}
+    with all the fields in /proc/meminfo, in bytes
+    (the ones without a unit, like HugePages_Total, are left as-is)
+    """
+    meminfo = {}
+    with open("/proc/meminfo") as feed:
+        for line in feed:
+            label, value, *unit = line.split()
+            value = int(value)
+            if unit == ['kB']:
+                value *= 1024
+            meminfo[label.rstrip(':')] = value
+    return meminfo
+
+
+def parse_pressure(path):
+    """
+    parses a PSI file like /proc/pressure/memory, that reads
+    some avg10=0.00 avg60=0.00 avg300=0.00 total=0
+    full avg10=0.00 avg60=0.00 avg300=0.00 total=0
+
+    returns a dict like {'some': {'avg10': 0.0, ..., 'total': 0}, 'full': ...}
+    or None if the file is not there (kernel without PSI)
+    """
+    try:
+        with open(path) as feed:
+            text = feed.read()
+    except OSError:
+        return None
+    pressure = {}
+    for line in text.splitlines():
+        kind, *fields = line.split()
+        pressure[kind] = {
+            key: (int(value) if key == 'total' else float(value))
+            for key, value in (field.split('=') for field in fields)
+        }
+    return pressure
+
+
+def read_flat_keyed(path):
+    """
+    for cgroup files like cpu.stat or memory.events
+    returns a dict key -> int, or None if the file is not there
+    """
+    try:
+        with open(path) as feed:
+            return {key: int(value) for key, value
+                    in (line.split() for line in feed if line.strip())}
+    except OSError:
+        return None
+
+
+def read_single_value(path):
+    """
+    for cgroup files like memory.current
+    returns an int, or None if the file is not there
+    """
+    try:
+        with open(path) as feed:
+            return int(feed.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def read_cgroup(cgroup_dir=CONTAINERS_CGROUP):
+    """
+    the cgroup v2 figures for the containers slice
+    values are None when not available (e.g. cgroup v1)
+    """
+    cpu_stat = read_flat_keyed(f"{cgroup_dir}/cpu.stat") or {}
+    return dict(
+        cpu_usage_usec=cpu_stat.get('usage_usec'),
+        memory_current=read_single_value(f"{cgroup_dir}/memory.current"),
+        memory_pressure=parse_pressure(f"{cgroup_dir}/memory.pressure"),
+    )
+
+
+def take_sample(cgroup_dir=CONTAINERS_CGROUP):
+    """
+    one sample - a dict with keys
+    time, loads, meminfo, pressure, cgroup
+    """
+    sample = dict(time=time.time())
+    try:
+        sample['loads'] = read_loadavg()
+    except Exception:
+        logger.exception("sampler cannot read loadavg")
+        sample['loads'] = (0., 0., 0.)
+    try:
+        sample['meminfo'] = read_meminfo()
+    except Exception:
+        logger.exception("sampler cannot read meminfo")
+        sample['meminfo'] = {}
+    sample['pressure'] = {
+        resource: parse_pressure(f"/proc/pressure/{resource}")
+        for resource in PSI_RESOURCES
+    }
+    sample['cgroup'] = read_cgroup(cgroup_dir)
+    return sample
+
+
+class SystemSampler:
+    """
+    takes a sample every interval seconds in a daemon thread
+    and keeps the last window samples
+    """
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL,
+                 window=DEFAULT_WINDOW, cgroup_dir=CONTAINERS_CGROUP):
+        self.interval = interval
+        self.cgroup_dir = cgroup_dir
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=window)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self._sample_forever, name='system-sampler', daemon=True)
+        self.thread.start()
+
+    def _sample_forever(self):
+        while True:
+            beg = time.time()
+            try:
+                self.sample()
+            except Exception:
+                logger.exception("sampler failed")
+            time.sleep(max(0, self.interval - (time.time() - beg)))
+
+    def sample(self):
+        """
+        take a sample right away, store it in the window and return it
+        """
+        sample = take_sample(self.cgroup_dir)
+        with self._lock:
+            self._samples.append(sample)
+        return sample
+
+    def samples(self, since=None):
+        """
+        the samples in the window, oldest first
+        optionally only the ones taken after since (an epoch)
+        """
+        with self._lock:
+            samples = list(self._samples)
+        if since is not None:
+            samples = [sample for sample in samples if sample['time'] > since]
+        return samples
+
+    def latest(self):
+        with self._lock:
+            return self._samples[-1] if self._samples else None
+
+    def peak_pressure(self, resource, since=None, kind='some'):
+        """
+        the highest avg10 value for that resource among the samples
+        taken since then, as a percentage; 0 if PSI is not available
+        """
+        values = [
+            sample['pressure'][resource][kind]['avg10']
+            for sample in self.samples(since)
+            if sample['pressure'].get(resource)
+            and kind in sample['pressure'][resource]
+        ]
+        return max(values, default=0.)
@@ -0,0 +1,510 @@
+"""
+a single-pass scanner for the events files - raw/<course>/events*.raw
+
+the files are read once, and each relevant event is handed to a set
+of consumers, each of them in charge of one family of metrics
+(daily figures, totals, per-notebook, time buckets, heatmap...)
+
+the scanner takes care of the parts that all consumers share
+* splitting the lines, and ignoring the 'killing' events
+* filtering out the staff and artefact users - cached per student
+* canonicalizing the notebook names - cached per raw name
+* remembering how far it went in the segments, so it can resume later on
+
+a consumer is any object with a method
+    consume(timestamp, student, notebook)
+called in the order of the files, with a canonical notebook name
+"""
+
+# pylint: disable=c0111, w0703
+
+import os
+from pathlib import Path
+from collections import OrderedDict, defaultdict
+from datetime import timedelta
+import itertools
+
+import numpy as np
+
+from nbhosting.stats.timebuckets import TimeBuckets
+from nbhosting.stats.eventlog import (
+    time_format, LIVE_NAME, segment_key, open_segment)
+from nbh_main.settings import logger
+
+# this is to skip artefact-users like e.g. 'student'
+# used to have regexps for edx-like hashes,
+# but proved too restrictive for users from m@gistere
+# who were asked to forge their hashes in separate namespaces
+# so for now let's just keep the long ones
+def artefact_user(user_hash):
+    # actual students get a username in first.last
+    # so this should be considered real
+    if '.' in user_hash:
+        return False
+    return len(user_hash) < 28
+
+# an iterable has no builtin len method
+def iter_len(iterable):
+    count = 0
+    for _ in iterable:
+        count += 1
+    return count
+
+# remove known extension if present
+# xxx the extension list should be configurable
+# todo clean up production events.raw once this
+# version is rolled out
+def canonicalize(notebook):
+    known_exts = ('.ipynb', '.md', '.py')
+    path = Path(notebook)
+    if path.suffix in known_exts:
+        notebook = path.parent / path.stem
+    return str(notebook)
+
+
+class EventsScanner:
+    """
+    feeds the consumers with the events in a course, skipping staffs
+
+    the events come in segments, see eventlog.py; the object remembers
+    which segments it has read entirely, and how far it went in the
+    current one, so it can be saved on disk and later on resume with
+    only the lines appended since then
+
+    if the segment being read was gzipped or truncated in the meanwhile,
+    or if older segments were removed, a new object must be created;
+    as the staffs are filtered out when reading, a change in the staffs
+    also requires a new object
+    """
+
+    def __init__(self, staffs, consumers):
+        self.staffs = staffs
+        self.consumers = consumers
+        # the keys of the rotated segments that have been read entirely
+        self.done = []
+        # where we are in the segment being read
+        self.inode = None
+        self.offset = 0
+        self.lineno = 0
+        # raw notebook name -> canonical name
+        self.canonical = {}
+        # student -> True if the student is to be taken into account
+        self.accepted = {}
+
+    def can_resume(self, staffs, segments):
+        """
+        segments is the list of paths returned by eventlog.events_segments()
+        """
+        if self.staffs != staffs:
+            return False
+        if [segment_key(path) for path in segments[:len(self.done)]] != self.done:
+            return False
+        if not self.offset:
+            return True
+        pending = segments[len(self.done):]
+        if not pending or pending[0].suffix == '.gz':
+            return False
+        stat = pending[0].stat()
+        return stat.st_ino == self.inode and stat.st_size >= self.offset
+
+    def catch_up(self, segments):
+        """
+        read the lines appended since last time
+        a last line without a newline is still being written, and is left alone
+
+        returns True if the object has changed
+        """
+        changed = False
+        for path in segments[len(self.done):]:
+            with open_segment(path) as feed:
+                if path.suffix != '.gz':
+                    inode = os.fstat(feed.fileno()).st_ino
+                    if inode != self.inode:
+                        self.inode, self.offset, self.lineno = inode, 0, 0
+                    feed.seek(self.offset)
+                changed |= self._scan(feed, path)
+            if path.name != LIVE_NAME:
+                self.done.append(segment_key(path))
+                self.inode, self.offset, self.lineno = None, 0, 0
+                changed = True
+        return changed
+
+    def _scan(self, feed, path):
+        # this is the hot loop, so bind all we can locally
+        consumes = [consumer.consume for consumer in self.consumers]
+        canonical = self.canonical
+        accepted = self.accepted
+        staffs = self.staffs
+        changed = False
+        for raw in feed:
+            if not raw.endswith(b'\n'):
+                break
+            changed = True
+            self.offset += len(raw)
+            self.lineno += 1
+            line = raw.decode(errors='replace')
+            try:
+                timestamp, _coursename, student, notebook, action, *_ = line.split()
+                # if action is 'killing' then notebook is '-'
+                # which should not be counted as a notebook of course
+                # so let's ignore these lines altogether
+                if action == 'killing':
+                    continue
+                # ignore staff or other artefact users
+                keep = accepted.get(student)
+                if keep is None:
+                    keep = accepted[student] = not (
+                        student in staffs or artefact_user(student))
+                if not keep:
+                    continue
+                name = canonical.get(notebook)
+                if name is None:
+                    name = canonical[notebook] = canonicalize(notebook)
+                for consume in consumes:
+                    consume(timestamp, student, name)
+            except Exception as exc:
+                logger.exception(f"{path}:{self.lineno}: "
+                                 f"skipped misformed events line {type(exc)}:{line}")
+        return changed
+
+
+class DailyFigures:
+    """
+    keep track of the activity during a given day, as compared
+    to the previous day
+    in order to avoid useless expensive set copies, when moving to the next day,
+    caller must call the wrap() method that does accounting
+    """
+    def __init__(self, previous=None):
+        self.students = set()
+        self.notebooks = set()
+        if previous is None:
+            self.cumul_students = set()
+            self.cumul_notebooks = set()
+        else:
+            self.cumul_students = previous.cumul_students
+            self.cumul_notebooks = previous.cumul_notebooks
+        self._nb_total_students = len(self.cumul_students)
+        self._nb_total_notebooks = len(self.cumul_notebooks)
+
+
+    def add_student(self, student):
+        if student not in self.students and student not in self.cumul_students:
+            self._nb_total_students += 1
+        self.students.add(student)
+    def add_notebook(self, notebook):
+        if notebook not in self.notebooks and notebook not in self.cumul_notebooks:
+            self._nb_total_notebooks += 1
+        self.notebooks.add(notebook)
+
+
+    # we call these zillions of times, can't afford to
+    # compute a set union each time we need this
+    def nb_total_students(self):
+        # return len(self.students | self.cumul_students)
+        return self._nb_total_students
+    def nb_total_notebooks(self):
+        # return len(self.notebooks | self.cumul_notebooks)
+        return self._nb_total_notebooks
+
+
+    def wrap(self):
+        self.nb_unique_students = len(self.students)
+        self.nb_unique_notebooks = len(self.notebooks)
+        self.nb_new_students = len(self.students - self.cumul_students)
+        self.nb_new_notebooks = len(self.notebooks - self.cumul_notebooks)
+        self.cumul_students.update(self.students)
+        self.cumul_notebooks.update(self.notebooks)
+
+
+class TotalsAccumulator:
+    """
+    if we do not pay attention we end up issuing way too many events
+    so they need to be filtered out a bit
+
+    an accumulator essentially remembers stuff like
+
+    timestamps = [14:00 14:05 14:08 15:00] some time stamps (in fact a longer format is used)
+    students =   [12    13    14    15]    number of students known at that time
+    notebooks =  [20    20    21    22]    number of notebooks opened at least once at that time
+
+    """
+    def __init__(self):
+        self.timestamps = []
+        # these 2 will remember numbers of students or of notebooks
+        self.students = []
+        self.notebooks = []
+        self.last_t, self.last_s, self.last_n = None, None, None
+
+
+    def _insert(self, timestamp, nb_students, nb_notebooks):
+        self.timestamps.append(timestamp)
+        self.students.append(nb_students)
+        self.notebooks.append(nb_notebooks)
+
+
+    def insert(self, timestamp, nb_students, nb_notebooks):
+        # in all cases, remember the last one, so we are sure to mention it at the end
+        self.last_t, self.last_s, self.last_n = timestamp, nb_students, nb_notebooks
+        # object is empty, record without thinking more
+        if not self.timestamps:
+            self._insert(timestamp, nb_students, nb_notebooks)
+            return
+        # same numbers as the previous entry : skip
+        if nb_students == self.students[-1] and nb_notebooks == self.notebooks[-1]:
+            return
+        # otherwise : insert it
+        self._insert(timestamp, nb_students, nb_notebooks)
+
+
+    def wrap(self):
+        # nothing to remember
+        if self.last_t is None:
+            return
+        # check if we have recorded this event
+        if self.timestamps[-1] == self.last_t \
+           and self.students[-1] == self.last_s \
+           and self.notebooks[-1] == self.last_n:
+            pass
+        # record it
+        self._insert(self.last_t, self.last_s, self.last_n)
+
+    def snapshot(self):
+        """
+        returns copies of timestamps, students and notebooks
+        with the last event mentioned, like after wrap()
+        but the object is left untouched so it can be fed further
+        """
+        timestamps, students, notebooks = \
+            self.timestamps[:], self.students[:], self.notebooks[:]
+        if self.last_t is not None and timestamps[-1] != self.last_t:
+            timestamps.append(self.last_t)
+            students.append(self.last_s)
+            notebooks.append(self.last_n)
+        return timestamps, students, notebooks
+
+
+####################
+# the consumers
+class DailyConsumer:
+    """
+    unique and new students and notebooks, day by day
+    """
+
+    def __init__(self):
+        # the days that are over -> (unique_students, unique_notebooks,
+        #                             new_students, new_notebooks)
+        self.past_days = OrderedDict()
+        self.current_day = None
+        self.current_figures = DailyFigures()
+
+    def consume(self, timestamp, student, notebook):
+        day = timestamp[:10] + ' 23:59:59'
+        # events may come slightly out of order around midnight
+        if day != self.current_day and day not in self.past_days:
+            if self.current_day is not None:
+                self.past_days[self.current_day] = \
+                    self._day_figures(self.current_figures)
+                self.current_figures.wrap()
+                self.current_figures = DailyFigures(self.current_figures)
+            self.current_day = day
+        self.current_figures.add_notebook(notebook)
+        self.current_figures.add_student(student)
+
+    @staticmethod
+    def _day_figures(figures):
+        # like DailyFigures.wrap() but without side effect
+        return (len(figures.students), len(figures.notebooks),
+                len(figures.students - figures.cumul_students),
+                len(figures.notebooks - figures.cumul_notebooks))
+
+    def result(self):
+        days = OrderedDict(self.past_days)
+        if self.current_day is not None:
+            days[self.current_day] = self._day_figures(self.current_figures)
+        unique_students, unique_notebooks, new_students, new_notebooks = (
+            [figures[index] for figures in days.values()]
+            for index in range(4))
+        return { 'timestamps' : list(days),
+                 'unique_students' : unique_students,
+                 'unique_notebooks' : unique_notebooks,
+                 'new_students' : new_students,
+                 'new_notebooks' : new_notebooks}
+
+
+class TotalsConsumer:
+    """
+    the total number of students and notebooks over time
+
+    the totals are the ones maintained by a DailyConsumer,
+    that must come first in the consumers list
+    """
+
+    def __init__(self, daily):
+        self.daily = daily
+        self.accumulator = TotalsAccumulator()
+
+    def consume(self, timestamp, _student, _notebook):
+        figures = self.daily.current_figures
+        self.accumulator.insert(
+            timestamp, figures.nb_total_students(), figures.nb_total_notebooks())
+
+    def result(self):
+        timestamps, total_students, total_notebooks = self.accumulator.snapshot()
+        return { 'timestamps' : timestamps,
+                 'total_students' : total_students,
+                 'total_notebooks' : total_notebooks}
+
+
+class NotebooksConsumer:
+    """
+    which students have opened which notebooks
+    """
+
+    def __init__(self):
+        # a dict notebook -> set of students
+        self.set_by_notebook = defaultdict(set)
+        # a dict student -> set of notebooks
+        self.set_by_student = defaultdict(set)
+
+    def consume(self, _timestamp, student, notebook):
+        self.set_by_notebook[notebook].add(student)
+        self.set_by_student[student].add(notebook)
+
+    def nbstudents(self, notebooks):
+        return [(notebook, len(self.set_by_notebook[notebook]))
+                for notebook in sorted(notebooks)]
+
+    def result(self):
+        nb_by_student = [len(s) for s in self.set_by_student.values()]
+        # counting in the other direction is surprisingly tedious
+        nbstudents_per_nbnotebooks = [
+            (number, iter_len(v))
+            for (number, v) in itertools.groupby(sorted(nb_by_student))
+        ]
+        return {
+            'nbnotebooks' : len(self.set_by_notebook),
+            'nbstudents' : len(self.set_by_student),
+            'nbstudents_per_notebook' : self.nbstudents(self.set_by_notebook),
+            'nbstudents_per_nbnotebooks' : nbstudents_per_nbnotebooks,
+        }
+
+
+class BucketsConsumer:
+    """
+    each time bucket holds the changes in the number of students
+    per notebook, i.e. a sorted list of (notebook, nb_students)
+    for the notebooks that have had new students in that bucket
+
+    the students per notebook are the ones maintained by
+    a NotebooksConsumer, that must come *after* this one in the
+    consumers list, so that new students can be spotted
+    """
+
+    def __init__(self, notebooks, grain=timedelta(hours=6)):
+        self.notebooks = notebooks
+        self.buckets = TimeBuckets(grain=grain, time_format=time_format)
+        # the notebooks that have changed since the last bucket
+        self.changed_notebooks = set()
+
+    def consume(self, timestamp, student, notebook):
+        previous, next, changed = self.buckets.prepare(timestamp)
+        if changed:
+            self.buckets.record_data(
+                self.notebooks.nbstudents(self.changed_notebooks), previous, next)
+            self.changed_notebooks = set()
+        if notebook in self.changed_notebooks:
+            return
+        students = self.notebooks.set_by_notebook.get(notebook)
+        if students is None or student not in students:
+            self.changed_notebooks.add(notebook)
+
+    def result(self):
+        return self.buckets.snapshot(
+            self.notebooks.nbstudents(self.changed_notebooks))
+
+
+class PlatformConsumer:
+    """
+    what the platform-wide stats need to know about a course, day by day;
+    these get merged across courses, so the events are only read once,
+    incrementally, like for the course stats
+    """
+
+    def __init__(self):
+        # day (YYYY-MM-DD) -> notebooks opened per hour of the day
+        self.opens = {}
+        # day -> set of students, and of notebooks
+        self.students = defaultdict(set)
+        self.notebooks = defaultdict(set)
+
+    def consume(self, timestamp, student, notebook):
+        day, hour = timestamp[:10], int(timestamp[11:13])
+        hourly = self.opens.get(day)
+        if hourly is None:
+            hourly = self.opens[day] = [0] * 24
+        hourly[hour] += 1
+        self.students[day].add(student)
+        self.notebooks[day].add(notebook)
+
+    def days(self, start=None, end=None):
+        """
+        returns a list of tuples (day, opens per hour, students, notebooks)
+        for the days between start and end included, as copies
+        """
+        return [(day, hourly[:], set(self.students[day]), set(self.notebooks[day]))
+                for day, hourly in sorted(self.opens.items())
+                if not (start and day < start) and not (end and day > end)]
+
+
+class HeatmapConsumer:
+    """
+    the number of visits per (notebook, student)
+    """
+
+    def __init__(self):
+        # a dict hashed on a tuple (notebook, student) -> number of visits
+        self.raw_counts = defaultdict(int)
+
+    def consume(self, _timestamp, student, notebook):
+        self.raw_counts[notebook, student] += 1
+
+    def result(self):
+        """
+        the matrix student x notebook -> number of visits is mostly empty
+        so it is sent in COO format, i.e. 3 arrays of the same size
+        'rows' (student index), 'cols' (notebook index) and 'values'
+        the client is expected to rebuild the matrix, with null
+        in the empty cells - they need to stand out, 0 would not
+
+        rows are sorted on the total number of visits,
+        and 'y' - the students - is sorted accordingly
+        """
+        raw_counts = self.raw_counts
+        notebooks = sorted({notebook for notebook, _ in raw_counts})
+        students = sorted({student for _, student in raw_counts})
+        notebook_index = {notebook: index for index, notebook in enumerate(notebooks)}
+        student_index = {student: index for index, student in enumerate(students)}
+        nnz = len(raw_counts)
+        cols = np.fromiter((notebook_index[notebook] for notebook, _ in raw_counts),
+                           dtype=np.int64, count=nnz)
+        rows = np.fromiter((student_index[student] for _, student in raw_counts),
+                           dtype=np.int64, count=nnz)
+        values = np.fromiter(raw_counts.values(), dtype=np.int64, count=nnz)
+        # sort students on total number of opened notebooks
+        row_sums = np.bincount(rows, weights=values, minlength=len(students))
+        order = np.argsort(row_sums, kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        rows = rank[rows]
+        coo_order = np.lexsort((cols, rows))
+        return {
+            'format' : 'coo',
+            'x' : notebooks,
+            'y' : [students[index] for index in order],
+            'rows' : rows[coo_order].tolist(),
+            'cols' : cols[coo_order].tolist(),
+            'values' : values[coo_order].tolist(),
+            'zmin' : int(values.min()) if nnz else 0,
+            'zmax' : int(values.max()) if nnz else 0,
+        }
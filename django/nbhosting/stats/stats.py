@@ -1,150 +1,113 @@
 from pathlib import Path
+import os
+import json
 import time
 import re
-import itertools
-from datetime import timedelta
-from collections import OrderedDict, defaultdict
-
-from nbhosting.stats.timebuckets import TimeBuckets
+import pickle
+import tempfile
+import threading
+
+import numpy as np
+
+from nbhosting.stats.eventlog import (
+    time_format, record_event, events_segments, rotate_events)
+from nbhosting.stats.scanner import (
+    canonicalize, EventsScanner, DailyConsumer, TotalsConsumer,
+    NotebooksConsumer, BucketsConsumer, HeatmapConsumer, PlatformConsumer)
+from nbhosting.stats.countstore import (
+    CountsStore, convert_text_counts, format_timestamps, column_to_list,
+    align, merge_stores, MISSING, DTYPE, TIMESTAMP)
+from nbhosting.stats import downsample
+from nbhosting.stats import latencies
+from nbhosting.stats.resultcache import SourceSignature, ResultCache
 from nbhosting.courses.model_course import CourseDir
 from nbh_main.settings import sitesettings, logger
 
 nbhroot = Path(sitesettings.nbhroot)
 
-# using gmtime in all raw files
-time_format = "%Y-%m-%dT%H:%M:%S"
-
-# this is to skip artefact-users like e.g. 'student'
-# used to have regexps for edx-like hashes,
-# but proved too restrictive for users from m@gistere
-# who were asked to forge their hashes in separate namespaces
-# so for now let's just keep the long ones
-def artefact_user(user_hash):
-    # actual students get a username in first.last
-    # so this should be considered real
-    if '.' in user_hash:
-        return False
-    return len(user_hash) < 28
-
-# an iterable has no builtin len method
-def iter_len(iterable):
-    count = 0
-    for _ in iterable:
-        count += 1
-    return count
-
-# remove known extension if present
-# xxx the extension list should be configurable
-# todo clean up production events.raw once this
-# version is rolled out 
-def canonicalize(notebook):
-    known_exts = ('.ipynb', '.md', '.py')
-    path = Path(notebook)
-    if path.suffix in known_exts:
-        notebook = path.parent / path.stem
-    return str(notebook)
-
-
-class DailyFigures:
-    """
-    keep track of the activity during a given day, as compared
-    to the previous day
-    in order to avoid useless expensive set copies, when moving to the next day,
-    caller must call the wrap() method that does accounting
+
+class EventsAggregator(EventsScanner):
     """
-    def __init__(self, previous=None):
-        self.students = set()
-        self.notebooks = set()
-        if previous is None:
-            self.cumul_students = set()
-            self.cumul_notebooks = set()
-        else:
-            self.cumul_students = previous.cumul_students
-            self.cumul_notebooks = previous.cumul_notebooks
-        self._nb_total_students = len(self.cumul_students)
-        self._nb_total_notebooks = len(self.cumul_notebooks)
-
-
-    def add_student(self, student):
-        if student not in self.students and student not in self.cumul_students:
-            self._nb_total_students += 1
-        self.students.add(student)
-    def add_notebook(self, notebook):
-        if notebook not in self.notebooks and notebook not in self.cumul_notebooks:
-            self._nb_total_notebooks += 1
-        self.notebooks.add(notebook)
-
-
-    # we call these zillions of times, can't afford to
-    # compute a set union each time we need this
-    def nb_total_students(self):
-        # return len(self.students | self.cumul_students)
-        return self._nb_total_students
-    def nb_total_notebooks(self):
-        # return len(self.notebooks | self.cumul_notebooks)
-        return self._nb_total_notebooks
-
-
-    def wrap(self):
-        self.nb_unique_students = len(self.students)
-        self.nb_unique_notebooks = len(self.notebooks)
-        self.nb_new_students = len(self.students - self.cumul_students)
-        self.nb_new_notebooks = len(self.notebooks - self.cumul_notebooks)
-        self.cumul_students.update(self.students)
-        self.cumul_notebooks.update(self.notebooks)
-
-
-class TotalsAccumulator:
+    everything that daily_metrics and material_usage need to know
+    about the events file, computed incrementally in a single pass
     """
-    if we do not pay attention we end up issuing way too many events
-    so they need to be filtered out a bit
 
-    an accumulator essentially remembers stuff like
+    # bump this whenever the layout of the object changes
+    layout = 5
+
+    def __init__(self, staffs):
+        self.version = self.layout
+        self.daily = DailyConsumer()
+        self.totals = TotalsConsumer(self.daily)
+        self.notebooks = NotebooksConsumer()
+        self.buckets = BucketsConsumer(self.notebooks)
+        self.heatmap = HeatmapConsumer()
+        self.platform = PlatformConsumer()
+        # buckets need to see the events before notebooks,
+        # and totals after daily
+        super().__init__(staffs, [self.buckets, self.daily, self.totals,
+                                  self.notebooks, self.heatmap, self.platform])
+
+    def can_resume(self, staffs, segments):
+        return self.version == self.layout and super().can_resume(staffs, segments)
 
-    timestamps = [14:00 14:05 14:08 15:00] some time stamps (in fact a longer format is used)
-    students =   [12    13    14    15]    number of students known at that time
-    notebooks =  [20    20    21    22]    number of notebooks opened at least once at that time
+    def daily_metrics(self):
+        """
+        see Stats.daily_metrics
+        """
+        return { 'daily' : self.daily.result(),
+                 'events' : self.totals.result()}
 
-    """
-    def __init__(self):
-        self.timestamps = []
-        # these 2 will remember numbers of students or of notebooks
-        self.students = []
-        self.notebooks = []
-        self.last_t, self.last_s, self.last_n = None, None, None
-
-
-    def _insert(self, timestamp, nb_students, nb_notebooks):
-        self.timestamps.append(timestamp)
-        self.students.append(nb_students)
-        self.notebooks.append(nb_notebooks)
-
-
-    def insert(self, timestamp, nb_students, nb_notebooks):
-        # in all cases, remember the last one, so we are sure to mention it at the end
-        self.last_t, self.last_s, self.last_n = timestamp, nb_students, nb_notebooks
-        # object is empty, record without thinking more
-        if not self.timestamps:
-            self._insert(timestamp, nb_students, nb_notebooks)
-            return
-        # same numbers as the previous entry : skip
-        if nb_students == self.students[-1] and nb_notebooks == self.notebooks[-1]:
-            return
-        # otherwise : insert it
-        self._insert(timestamp, nb_students, nb_notebooks)
+    def material_usage(self):
+        """
+        see Stats.material_usage
+        """
+        result = self.notebooks.result()
+        result['nbstudents_per_notebook_deltas'] = self.buckets.result()
+        result['heatmap'] = self.heatmap.result()
+        return result
 
 
-    def wrap(self):
-        # nothing to remember
-        if self.last_t is None:
-            return
-        # check if we have recorded this event
-        if self.timestamps[-1] == self.last_t \
-           and self.students[-1] == self.last_s \
-           and self.notebooks[-1] == self.last_n:
-            pass
-        # record it
-        self._insert(self.last_t, self.last_s, self.last_n)
+# the aggregators are kept in memory, hashed by coursename,
+# so that a process only reads the checkpoint file once
+_aggregators = {}
+_aggregators_lock = threading.Lock()
+
+
+# the stats about the whole platform
+def platform_dir():
+    return nbhroot / "raw" / ".platform"
+
+def platform_counts_store():
+    return CountsStore(platform_dir() / "counts.bin")
+
+def prepare_platform_counts():
+    """
+    make sure the platform store exists and has the right columns
+
+    the first time around, it is built from the system counts
+    that were previously duplicated in all the courses counts
+    """
+    store = platform_counts_store()
+    if store.exists():
+        store.ensure_columns(Stats.system_counts)
+        return
+    platform_dir().mkdir(parents=True, exist_ok=True)
+    stores = []
+    for course_dir in sorted((nbhroot / "raw").iterdir()):
+        if course_dir.name.startswith('.') or not course_dir.is_dir():
+            continue
+        stats = Stats(course_dir.name)
+        course_store = stats.monitor_counts_store()
+        text_path = stats.monitor_counts_path()
+        if not course_store.exists() and text_path.exists():
+            convert_text_counts(text_path, course_store, Stats.known_counts, time_format)
+        if course_store.exists():
+            stores.append(course_store)
+    records = merge_stores(stores, Stats.system_counts, Stats.counts_tolerance)
+    store.write([TIMESTAMP] + Stats.system_counts, records)
+    logger.info(f"created {store.path} with {len(records)} records "
+                f"from {len(stores)} courses")
 
 
 class Stats:
@@ -156,19 +119,37 @@ class Stats:
         self.course_dir.mkdir(parents=True, exist_ok=True)
 
     ####################
+    # the live events file
     def notebook_events_path(self):
         return self.course_dir / "events.raw"
+
+    # all the events files, including the rotated ones, oldest first
+    def notebook_events_segments(self):
+        return events_segments(self.course_dir)
+    # the legacy text format
     def monitor_counts_path(self):
         return self.course_dir / "counts.raw"
 
+    def monitor_counts_store(self):
+        return CountsStore(self.course_dir / "counts.bin")
+
+    def open_latencies_path(self):
+        return self.course_dir / "latencies.raw"
+
+    def events_checkpoint_path(self):
+        return self.course_dir / "events.checkpoint"
+
+    def results_cache(self):
+        return ResultCache(self.course_dir / ".cache")
+
     ####################
     def _write_events_line(self, student, notebook, action, port):
         timestamp = time.strftime(time_format, time.gmtime())
         path = self.notebook_events_path()
         coursename = self.coursename
         try:
-            with path.open("a") as f:
-                f.write(f"{timestamp} {coursename} {student} {notebook} {action} {port}\n")
+            record_event(
+                path, f"{timestamp} {coursename} {student} {notebook} {action} {port}\n")
         except Exception as exc:
             logger.exception(f"Cannot store stats line into {path}, {type (exc)}")
 
@@ -188,6 +169,27 @@ class Stats:
         """
         return self._write_events_line(student, '-', 'killing', '-')
 
+    def record_open_latency(self, student, notebook, action, total, timings):
+        """
+        add one line in the latencies file for that course
+        total is the duration of the whole spawn in ms, and timings
+        the phases as in SpawnResult.timings - see courses.spawn
+        """
+        timestamp = time.strftime(time_format, time.gmtime())
+        path = self.open_latencies_path()
+        try:
+            record_event(path, latencies.format_latency_line(
+                timestamp, self.coursename, student, canonicalize(notebook),
+                action, total, timings))
+        except Exception as exc:
+            logger.exception(f"Cannot store latencies line into {path}, {type (exc)}")
+
+    def rotate_events(self, max_size=None, max_age=None):
+        """
+        called by the monitor; see eventlog.rotate_events
+        """
+        return rotate_events(self.course_dir, max_size, max_age)
+
     ####################
     # every cycle the monitor writes a counts line
     # with a predefined set of integer counts
@@ -204,32 +206,91 @@ class Stats:
         'system_ds_percent', 'system_ds_free',
         'memory_total', 'memory_free', 'memory_available',
         'system_container', 'system_kernel',
+        # containers killed during the cycle, and failed attempts
+        'killed_container', 'kill_failure',
+        # time spent killing, in ms, for all courses
+        'kill_duration',
+        # PSI, peak avg10 since last cycle, in % x 100 like the loads
+        'cpu_pressure', 'memory_pressure', 'io_pressure',
+        # from the course containers cgroups: cpu used since last cycle,
+        # memory in MiB, and number of oom kills since last cycle
+        'cpu_second', 'memory_current', 'oom_kill',
+        # containers that died since last cycle without being killed
+        # by the monitor - e.g. oom or crash; only in events mode
+        'died_container',
+    ]
+
+    # the counts that are the same for all courses are stored once,
+    # in the platform store - see platform_counts_store()
+    system_counts = [
+        'load1', 'load5', 'load15',
+        'container_ds_percent', 'container_ds_free',
+        'nbhosting_ds_percent', 'nbhosting_ds_free',
+        'system_ds_percent', 'system_ds_free',
+        'memory_total', 'memory_free', 'memory_available',
+        'system_container', 'system_kernel',
+        'kill_duration',
+        'cpu_pressure', 'memory_pressure', 'io_pressure',
     ]
+    # the other ones go in counts.bin, and this is the list - in that
+    # order - of arguments to record_monitor_counts
+    course_counts = [
+        'running_container', 'frozen_container',
+        'running_kernel',
+        'student_home',
+        'killed_container', 'kill_failure',
+        'cpu_second', 'memory_current', 'oom_kill',
+        'died_container',
+    ]
+    # the course and platform records are matched
+    # if their timestamps are that close, in seconds
+    counts_tolerance = 30
 
     def record_monitor_known_counts_line(self):
-        # timestamp = time.strftime(time_format, time.gmtime())
-        path = self.monitor_counts_path()
+        """
+        called by the monitor when it starts; the header of counts.bin
+        records the course counts, so this makes sure it is up to date
+        """
+        store = self.monitor_counts_store()
         try:
-            with path.open('a') as f:
-                f.write("# " + " ".join(self.known_counts) + "\n")
+            self._prepare_counts_store(store)
         except Exception as exc:
-            logger.exception(f"Cannot store headers line into {path}, {type(exc)}")
-
-    def record_monitor_counts(self, *args):
-        timestamp = time.strftime(time_format, time.gmtime())
-        path = self.monitor_counts_path()
-        if len(args) > len(self.known_counts):
+            logger.exception(f"Cannot prepare counts store {store.path}, {type(exc)}")
+
+    def _prepare_counts_store(self, store):
+        # the first time around, start from the legacy text file if present
+        text_path = self.monitor_counts_path()
+        if not store.exists() and text_path.exists():
+            nb_records = convert_text_counts(
+                text_path, store, self.known_counts, time_format)
+            logger.info(f"converted {nb_records} records "
+                        f"from {text_path} into {store.path}")
+        # the system counts used to be stored in all courses,
+        # they need to be in the platform store before they are dropped
+        prepare_platform_counts()
+        if store.exists():
+            store.drop_columns(self.system_counts)
+        store.ensure_columns(self.course_counts)
+
+    def record_monitor_counts(self, *args, timestamp=None):
+        """
+        the values of course_counts, in that order; the timestamp
+        should be the same as the one used for the platform counts
+        """
+        store = self.monitor_counts_store()
+        if len(args) > len(self.course_counts):
             logger.error(f"two many arguments to counts line "
-                         f"- dropped {args} from {path}")
+                         f"- dropped {args} from {store.path}")
+            return
         try:
-            with path.open('a') as f:
-                payload = " ".join(str(arg) for arg in args)
-                f.write(f"{timestamp} {payload}\n")
+            if not store.exists():
+                self._prepare_counts_store(store)
+            store.append(timestamp or time.time(), args)
         except Exception as exc:
-            logger.exception(f"Cannot store counts line into {path}, {type(exc)}")
+            logger.exception(f"Cannot store counts record into {store.path}, {type(exc)}")
 
     ####################
-    def daily_metrics(self):
+    def daily_metrics(self, start=None, end=None, max_points=None):
         """
         read the events file for that course and produce
         data arrays suitable for being composed under plotly
@@ -241,77 +302,120 @@ class Stats:
           (one per day, time is always 23:59:59)
         * 'events': { 'timestamps', 'total_students', 'total_notebooks' }
            - all 3 same size
+
+        start and end (epochs) restrict the time range, and max_points
+        is the maximal number of points in each part; see downsample.py
+        when downsampling occurs, the part gets an extra 'envelopes' key
         """
 
-        events_path = self.notebook_events_path()
-        # a dictionary day -> figures
-        figures_by_day = OrderedDict()
-        previous_figures = None
-        current_figures = DailyFigures()
-        # the events dimension
-        accumulator = TotalsAccumulator()
-        #
+        with _aggregators_lock:
+            result = self._events_aggregator().daily_metrics()
+        if start is None and end is None and max_points is None:
+            return result
+        for part in result.values():
+            timestamps = part.pop('timestamps')
+            timestamps, series, envelopes = downsample.series(
+                downsample.to_epochs(timestamps), part,
+                start, end, max_points)
+            part.update(series)
+            part['timestamps'] = timestamps
+            if envelopes:
+                part['envelopes'] = envelopes
+        return result
+
+    ####################
+    # the views send JSON-encoded results of
+    # daily_metrics, monitor_counts and material_usage
+    # these are cached on disk, together with a signature of their sources
+    # bump this whenever the format of these results changes
+    results_layout = 2
+
+    def result_signature(self, kind):
+        """
+        kind is the name of one of the methods that produce results,
+        i.e. daily_metrics, monitor_counts, material_usage or open_latencies
+        the signature changes whenever the result might change
+        """
+        if kind == 'monitor_counts':
+            return SourceSignature(
+                [self.monitor_counts_store().path, self.monitor_counts_path(),
+                 platform_counts_store().path],
+                self.results_layout, *self.known_counts)
+        if kind == 'open_latencies':
+            return SourceSignature([self.open_latencies_path()], self.results_layout)
         staffs = CourseDir.objects.get(coursename=self.coursename).staffs
+        return SourceSignature(
+            self.notebook_events_segments() or [self.notebook_events_path()],
+            self.results_layout, *sorted(staffs))
+
+    def cached_json(self, kind, signature, *args):
+        """
+        returns the JSON-encoded result of self.<kind>(*args) as bytes
+        from the cache if the sources have not changed
+        """
+        cache = self.results_cache()
+        encoded = cache.get(kind, signature, args)
+        if encoded is None:
+            encoded = json.dumps(getattr(self, kind)(*args)).encode()
+            cache.put(kind, signature, args, encoded)
+        return encoded
+
+    ####################
+    def _events_aggregator(self):
+        """
+        the EventsAggregator for that course, up to date with the events file
+
+        it comes from memory if possible, or else from the checkpoint file;
+        it gets rebuilt from scratch if the events file was truncated,
+        or compressed before it was read entirely, or if the staffs have changed
+
+        must be called with _aggregators_lock held
+        """
+        segments = self.notebook_events_segments()
+        staffs = CourseDir.objects.get(coursename=self.coursename).staffs
+        if not segments:
+            return EventsAggregator(staffs)
+        aggregator = _aggregators.get(self.coursename)
+        if aggregator is None:
+            aggregator = self._load_events_checkpoint()
+        if aggregator is None or not aggregator.can_resume(staffs, segments):
+            logger.info(f"{self.coursename}: (re)building events aggregator")
+            aggregator = EventsAggregator(staffs)
+        _aggregators[self.coursename] = aggregator
+        if aggregator.catch_up(segments):
+            self._store_events_checkpoint(aggregator)
+        return aggregator
+
+    def _load_events_checkpoint(self):
+        checkpoint_path = self.events_checkpoint_path()
         try:
-            with events_path.open() as f:
-                for lineno, line in enumerate(f, 1):
-                    try:
-                        timestamp, _coursename, student, notebook, action, _port = line.split()
-                        # if action is 'killing' then notebook is '-'
-                        # which should not be counted as a notebook of course
-                        # so let's ignore these lines altogether
-                        if action == 'killing':
-                            continue
-                        # ignore staff or other artefact users
-                        if student in staffs or artefact_user(student):
-                            continue
-                        day = timestamp.split('T')[0] + ' 23:59:59'
-                        if day in figures_by_day:
-                            current_figures = figures_by_day[day]
-                        else:
-                            current_figures.wrap()
-                            previous_figures = current_figures
-                            current_figures = DailyFigures(previous_figures)
-                            figures_by_day[day] = current_figures
-                        notebook = canonicalize(notebook)
-                        current_figures.add_notebook(notebook)
-                        current_figures.add_student(student)
-                        accumulator.insert(
-                            timestamp,
-                            current_figures.nb_total_students(),
-                            current_figures.nb_total_notebooks())
-                    except Exception as exc:
-                        logger.exception(f"{events_path}:{lineno}: "
-                                         f"skipped misformed events line {type(exc)}:{line}")
-                        continue
-        except Exception as _exc:
-            logger.exception("unexpected exception in daily_metrics")
-        finally:
-            current_figures.wrap()
-            accumulator.wrap()
-            daily_timestamps = []
-            unique_students = []
-            unique_notebooks = []
-            new_students = []
-            new_notebooks = []
-
-            for timestamp, figures in figures_by_day.items():
-                daily_timestamps.append(timestamp)
-                unique_students.append(figures.nb_unique_students)
-                unique_notebooks.append(figures.nb_unique_notebooks)
-                new_students.append(figures.nb_new_students)
-                new_notebooks.append(figures.nb_new_notebooks)
-
-            return { 'daily' : { 'timestamps' : daily_timestamps,
-                                 'unique_students' : unique_students,
-                                 'unique_notebooks' : unique_notebooks,
-                                 'new_students' : new_students,
-                                 'new_notebooks' : new_notebooks},
-                     'events' : { 'timestamps' : accumulator.timestamps,
-                                  'total_students' : accumulator.students,
-                                  'total_notebooks' : accumulator.notebooks}}
-
-    def monitor_counts(self):
+            with checkpoint_path.open('rb') as feed:
+                return pickle.load(feed)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logger.exception(f"ignoring broken checkpoint {checkpoint_path}")
+            return None
+
+    def _store_events_checkpoint(self, aggregator):
+        # write in a temporary file and rename
+        # so that readers never see a partial checkpoint
+        checkpoint_path = self.events_checkpoint_path()
+        try:
+            with tempfile.NamedTemporaryFile(
+                    'wb', dir=self.course_dir, prefix='.events.checkpoint.',
+                    delete=False) as feed:
+                pickle.dump(aggregator, feed, protocol=pickle.HIGHEST_PROTOCOL)
+            os.chmod(feed.name, 0o644)
+            os.replace(feed.name, checkpoint_path)
+        except Exception:
+            logger.exception(f"could not store checkpoint {checkpoint_path}")
+            try:
+                os.unlink(feed.name)
+            except Exception:
+                pass
+
+    def monitor_counts(self, start=None, end=None, max_points=None):
         """
         read the counts file for that course and produce
         data arrays suitable for plotly
@@ -321,7 +425,83 @@ class Stats:
         * plus, for each known count as listed in known_counts,
           a key made plural by adding a 's', so e.g.
          'running_jupyters': running containers
+
+        start and end (epochs) restrict the time range, and max_points
+        is the maximal number of points returned; see downsample.py
+        when downsampling occurs, the result has an extra 'envelopes' key
+
+        uses counts.bin if present, or the legacy counts.raw otherwise
+        """
+        store = self.monitor_counts_store()
+        if store.exists():
+            try:
+                return self._monitor_counts_from_store(store, start, end, max_points)
+            except Exception:
+                logger.exception(f"could not read {store.path}")
+        result = self._monitor_counts_from_text()
+        if start is None and end is None and max_points is None:
+            return result
+        timestamps = result.pop('timestamps')
+        timestamps, result, envelopes = downsample.series(
+            downsample.to_epochs(timestamps), result, start, end, max_points)
+        result['timestamps'] = timestamps
+        if envelopes:
+            result['envelopes'] = envelopes
+        return result
+
+    def _monitor_counts_from_store(self, store, start, end, max_points):
+        epochs, columns = self._monitor_counts_columns(store, start, end)
+        if max_points is None:
+            result = {f"{count}s": column_to_list(column)
+                      for count, column in columns.items()}
+            result['timestamps'] = format_timestamps(epochs)
+            return result
+        series = {}
+        for count, column in columns.items():
+            values = column.astype('float64')
+            values[column == MISSING] = float('nan')
+            series[f"{count}s"] = values
+        timestamps, result, envelopes = downsample.series(
+            epochs, series, max_points=max_points)
+        result['timestamps'] = timestamps
+        if envelopes:
+            result['envelopes'] = envelopes
+        return result
+
+    def _monitor_counts_columns(self, store, start=None, end=None):
+        """
+        returns epochs, and a dict count -> column for all known counts,
+        with MISSING where unknown
+
+        the system counts come from the platform store, unless the
+        course store still has them, i.e. has not been migrated yet
         """
+        columns, records = store.read()
+        epochs = records[:, columns.index(TIMESTAMP)]
+        # only convert the selected records
+        selected = downsample.select_range(epochs, start, end)
+        records, epochs = records[selected], epochs[selected]
+        result = {count: records[:, columns.index(count)]
+                  for count in self.known_counts if count in columns}
+        missing = [count for count in self.system_counts if count not in result]
+        platform = platform_counts_store()
+        if missing and platform.exists():
+            platform_columns, platform_records = platform.read()
+            index = align(epochs,
+                          platform_records[:, platform_columns.index(TIMESTAMP)],
+                          self.counts_tolerance)
+            found = index >= 0
+            for count in missing:
+                if count in platform_columns:
+                    column = np.full(len(epochs), MISSING, dtype=DTYPE)
+                    column[found] = platform_records[
+                        index[found], platform_columns.index(count)]
+                    result[count] = column
+        absent = np.full(len(epochs), MISSING, dtype=DTYPE)
+        return epochs, {count: result.get(count, absent)
+                        for count in self.known_counts}
+
+    def _monitor_counts_from_text(self):
         counts_path = self.monitor_counts_path()
         timestamps = []
         counts = { count: [] for count in self.known_counts}
@@ -371,89 +551,43 @@ class Stats:
         'nbstudents' : how many students are considered (test students are removed..)
         'nbstudents_per_notebook' : a sorted list of tuples (notebook, nb_students)
                                   how many students have read this notebook
-        'nbstudents_per_notebook_animated' : same but animated over time
+        'nbstudents_per_notebook_deltas' : same but over time; a dict
+                                  timestamp -> sorted list of tuples (notebook, nb_students)
+                                  for the notebooks that have changed during that period
         'nbstudents_per_nbnotebooks' : a sorted list of tuples (nb_notebooks, nb_students)
                                   how many students have read exactly that number of notebooks
-        'heatmap' : a complete matrix notebook x student ready to feed to plotly.heatmap
-                    comes with 'x', 'y' and 'z' keys
-        """
-
-        events_path = self.notebook_events_path()
-        # a dict notebook -> set of students
-        set_by_notebook = defaultdict(set)
-        nbstudents_per_notebook_buckets = TimeBuckets(grain=timedelta(hours=6),
-                                                      time_format=time_format)
-        # a dict student -> set of notebooks
-        set_by_student = defaultdict(set)
-        # a dict hashed on a tuple (notebook, student) -> number of visits
-        raw_counts = defaultdict(int)
-        #
-        staffs = CourseDir.objects.get(coursename=self.coursename).staffs
-        try:
-            with events_path.open() as f:
-                for _lineno, line in enumerate(f, 1):
-                    date, _, student, notebook, action, *_ = line.split()
-                    # action 'killing' needs to be ignored
-                    if action in ('killing',):
-                        continue
-                    # ignore staff or other artefact users
-                    if student in staffs or artefact_user(student):
-                        logger.debug(f"ignoring staff or artefact student {student}")
-                        continue
-                    # animated data must be taken care of before anything else
-                    previous, next, changed = nbstudents_per_notebook_buckets.prepare(date)
-                    if changed:
-                        nspn = [ (notebook, len(set_by_notebook[notebook]))
-                                for notebook in sorted(set_by_notebook)]
-                        nbstudents_per_notebook_buckets.record_data(nspn, previous, next)
-                    notebook = canonicalize(notebook)
-                    set_by_notebook[notebook].add(student)
-                    set_by_student[student].add(notebook)
-                    raw_counts[notebook, student] += 1
-        except Exception as _exc:
-            logger.exception(f"could not read {events_path} to count students per notebook")
+        'heatmap' : a sparse matrix student x notebook, to be expanded
+                    before it is fed to plotly.heatmap; comes with 'x', 'y'
+                    and 'rows', 'cols', 'values' keys (COO format)
+        """
 
-        finally:
-            nbstudents_per_notebook = [
-                (notebook, len(set_by_notebook[notebook]))
-                for notebook in sorted(set_by_notebook)
-            ]
-            nb_by_student = { student: len(s) for (student, s) in set_by_student.items() }
-
-            nbstudents_per_notebook_animated = nbstudents_per_notebook_buckets.wrap(nbstudents_per_notebook)
-
-            # counting in the other direction is surprisingly tedious
-            nbstudents_per_nbnotebooks = [
-                (number, iter_len(v))
-                for (number, v) in itertools.groupby(sorted(nb_by_student.values()))
-            ]
-            # the heatmap
-            heatmap_notebooks = sorted(set_by_notebook.keys())
-            heatmap_students = sorted(set_by_student.keys())
-            # a first attempt at showing the number of times a given notebook was open
-            # by a given student resulted in poor outcome
-            # problem being mostly with colorscale, we'd need to have '0' stick out
-            # as transparent or something, but OTOH sending None instead or 0
-            heatmap_z = [
-                [raw_counts.get( (notebook, student,), None) for notebook in heatmap_notebooks]
-                for student in heatmap_students
-            ]
-            # sort students on total number of opened notebooks
-            heatmap_z.sort(key = lambda student_line: sum(x for x in student_line if x))
-
-            zmax = max((max(x for x in line if x) for line in heatmap_z),
-                       default=0)
-            zmin = min((min(x for x in line if x) for line in heatmap_z),
-                       default=0)
-
-            return {
-                'nbnotebooks' : len(set_by_notebook),
-                'nbstudents' : len(set_by_student),
-                'nbstudents_per_notebook' : nbstudents_per_notebook,
-                'nbstudents_per_notebook_animated' : nbstudents_per_notebook_animated,
-                'nbstudents_per_nbnotebooks' : nbstudents_per_nbnotebooks,
-                'heatmap' : {'x' : heatmap_notebooks, 'y' : heatmap_students,
-                             'z' : heatmap_z,
-                             'zmin' : zmin, 'zmax' : zmax,
-                },
-            }
+        with _aggregators_lock:
+            return self._events_aggregator().material_usage()
+
+    def daily_activity(self, start=None, end=None):
+        """
+        the contribution of that course to the platform stats, see
+        PlatformConsumer.days(); start and end are days as YYYY-MM-DD
+        """
+        with _aggregators_lock:
+            return self._events_aggregator().platform.days(start, end)
+
+    def open_latencies(self, start=None, end=None):
+        """
+        read the latencies file and produce, for each day,
+        the percentiles of the time it took to open a notebook
+
+        returns a dict with keys 'cold' (a container was created)
+        and 'warm' (an existing container was used), each with
+        * 'timestamps' : one per day, time is always 23:59:59
+        * 'counts' : the number of notebooks opened
+        * 'p50', 'p95', 'p99' : the total duration, in ms
+        * 'phases' : a dict phase -> {'p50', 'p95', 'p99'}
+          see latencies.PHASES for the list of phases
+
+        start and end (epochs) restrict the time range
+        """
+        start, end = (None if epoch is None
+                      else time.strftime(time_format, time.gmtime(epoch))
+                      for epoch in (start, end))
+        return latencies.open_latencies(self.open_latencies_path(), start, end)
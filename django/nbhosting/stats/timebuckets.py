@@ -1,5 +1,8 @@
 from collections import OrderedDict
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date as Date
+
+# the format used in all raw files, that we can parse quickly
+FAST_FORMAT = "%Y-%m-%dT%H:%M:%S"
 
 class TimeBuckets:
     """
@@ -35,11 +38,34 @@ class TimeBuckets:
         self.hash = OrderedDict()
         # n-th grain from the epoch
         self.quotient = 0
+        # strptime is way too slow to be called on each event
+        # so with the usual format we use fixed offsets instead
+        self._fast = (time_format == FAST_FORMAT
+                      and grain.total_seconds() == int(grain.total_seconds()))
+        self._grain_seconds = int(grain.total_seconds())
+        # 'YYYY-mm-dd' -> number of days since epoch
+        self._days = {}
 
-    def prepare(self, date):
+    def _quotient(self, date):
+        if self._fast and len(date) == 19 and date[10] == 'T':
+            try:
+                day = date[:10]
+                days = self._days.get(day)
+                if days is None:
+                    days = (Date(int(date[0:4]), int(date[5:7]), int(date[8:10]))
+                            - self.epoch.date()).days
+                    self._days[day] = days
+                seconds = (days * 86400 + int(date[11:13]) * 3600
+                           + int(date[14:16]) * 60 + int(date[17:19]))
+                return seconds // self._grain_seconds
+            except ValueError:
+                pass
         dt = datetime.strptime(date, self.time_format)
+        return (dt-self.epoch) // self.grain
+
+    def prepare(self, date):
         # bucket indices are quotients
-        next = ((dt-self.epoch) // self.grain)
+        next = self._quotient(date)
         need_store = self.quotient and self.quotient != next
         retcod = self.quotient, next, need_store
         if not self.quotient:
@@ -53,22 +79,32 @@ class TimeBuckets:
         if next:
             self.quotient = next
 
+    def _reverse_date(self, quotient):
+        dt = self.epoch + (quotient+1) * self.grain
+        return dt.strftime(self.time_format)
+
     def _make_readable(self):
         """
         rewrite all keys into actual dates
         use END of period as the key
         """
-        def reverse_date(quotient):
-            dt = self.epoch + (quotient+1) * self.grain
-            return dt.strftime(self.time_format)
         self.readable = OrderedDict()
         for q, v in self.hash.items():
-            self.readable[reverse_date(q)] = v
+            self.readable[self._reverse_date(q)] = v
         return self.readable
 
     def wrap(self, data):
         self.record_data(data, self.quotient)
         return self._make_readable()
+
+    def snapshot(self, data):
+        """
+        same result as wrap(), but the object is left untouched
+        so it can be fed with more dates later on
+        """
+        hash = OrderedDict(self.hash)
+        hash[self.quotient] = data
+        return OrderedDict((self._reverse_date(q), v) for q, v in hash.items())
         
 
 if __name__ == '__main__':
@@ -1,10 +1,15 @@
-import json
+from datetime import datetime, timezone
 
 from django.shortcuts import render
-from django.http import HttpResponse, HttpResponseNotFound, HttpResponseRedirect
+from django.http import (
+    HttpResponse, HttpResponseNotFound, HttpResponseRedirect, HttpResponseBadRequest)
 from django.views.decorators.csrf import csrf_protect
+from django.views.decorators.http import condition
 from django.contrib.admin.views.decorators import staff_member_required
 from nbhosting.stats.stats import Stats
+from nbhosting.stats.platformstats import PlatformStats
+from nbhosting.stats.downsample import parse_query
+from nbhosting.stats.resultcache import ResultCache
 
 from nbhosting.version import __version__ as nbh_version
 from nbh_main.settings import sitesettings
@@ -63,6 +68,28 @@ def show_stats(request, course):
               'title' : 'Jupyter containers and kernels',
               'hide' : True,
             },
+            { 'div_id' : 'plotly-course-resources',
+              'title' : 'CPU and memory used by the course containers',
+              'hide' : True,
+            },
+        ]
+    ))
+    sections.append(dict(
+        title = 'Latency',
+        id = 'LATENCY',
+        subsections = [
+            { 'div_id' : 'plotly-cold-latencies',
+              'title' : 'Time to open a notebook in a new container (ms)',
+              'hide' : True,
+            },
+            { 'div_id' : 'plotly-warm-latencies',
+              'title' : 'Time to open a notebook in a running container (ms)',
+              'hide' : True,
+            },
+            { 'div_id' : 'plotly-cold-phases',
+              'title' : 'Where the time goes in a new container - 95th percentile (ms)',
+              'hide' : True,
+            },
         ]
     ))
     sections.append(dict(
@@ -88,6 +115,61 @@ def show_stats(request, course):
         ]
     ))
 
+    return _render_sections(request, "stats.html", sections, coursename=course)
+
+
+@staff_member_required
+@csrf_protect
+def show_platform_stats(request):
+
+    sections = []
+    sections.append(dict(
+        title = 'Containers',
+        id = 'CONTAINERS',
+        subsections = [
+            { 'div_id' : 'plotly-containers-by-course',
+              'title' : 'Running containers, by course',
+            },
+            { 'div_id' : 'plotly-system-containers-kernels',
+              'title' : 'Jupyter containers and kernels (all courses)',
+              'hide' : True,
+            },
+            { 'div_id' : 'plotly-course-shares',
+              'title' : 'Share of each course',
+              'hide' : True,
+            },
+        ]
+    ))
+    sections.append(dict(
+        title = 'Peak hours',
+        id = 'PEAK',
+        subsections = [
+            { 'div_id' : 'plotly-peak-hours',
+              'title' : 'Notebooks opened, by weekday and hour (UTC)',
+              'hide' : True,
+            },
+            { 'div_id' : 'plotly-hourly-containers',
+              'title' : 'Mean number of containers, by hour (UTC)',
+              'hide' : True,
+            },
+        ]
+    ))
+    sections.append(dict(
+        title = 'Students',
+        id = 'STUDENTS',
+        subsections = [
+            { 'div_id' : 'plotly-platform-students',
+              'title' : 'Students who showed up, all courses',
+              'hide' : True,
+            },
+        ]
+    ))
+
+    return _render_sections(request, "platform-stats.html", sections)
+
+
+def _render_sections(request, template, sections, **env):
+
     # set 'hide' to False by default
     for section in sections:
         for subsection in section['subsections']:
@@ -97,36 +179,115 @@ def show_stats(request, course):
     # propagate server_name to html template
     server_name = request.META['SERVER_NAME'].split('.')[0]
 
-    env = dict(
+    env.update(
       nbh_version=nbh_version,
       favicon_path=sitesettings.favicon_path,
-      coursename=course, sections=sections, server_name=server_name)
+      sections=sections, server_name=server_name)
 
-    return render(request, "stats.html", env)
+    return render(request, template, env)
 
 
-@csrf_protect
-def send_daily_metrics(request, course):
-    stats = Stats(course)
-    encoded = json.dumps(stats.daily_metrics())
+# the JSON views support conditional GET, based on
+# the signature of the result sources - see Stats.result_signature
+def _signature(request, course, kind):
+    # compute only once for both etag and last-modified
+    if not hasattr(request, 'stats_signature'):
+        request.stats_signature = Stats(course).result_signature(kind)
+    return request.stats_signature
+
+def stats_condition(kind):
+    def etag(request, course):
+        query = sorted(request.GET.items())
+        return (f"{_signature(request, course, kind).digest}"
+                f"-{ResultCache.params_digest(query)}")
+    def last_modified(request, course):
+        timestamp = _signature(request, course, kind).last_modified
+        if timestamp is None:
+            return None
+        return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+    return condition(etag_func=etag, last_modified_func=last_modified)
+
+# same for the whole platform - see PlatformStats.result_signature
+def _platform_signature(request):
+    if not hasattr(request, 'stats_signature'):
+        request.stats_signature = PlatformStats().result_signature()
+    return request.stats_signature
+
+def platform_condition():
+    def etag(request):
+        query = sorted(request.GET.items())
+        return (f"{_platform_signature(request).digest}"
+                f"-{ResultCache.params_digest(query)}")
+    def last_modified(request):
+        timestamp = _platform_signature(request).last_modified
+        if timestamp is None:
+            return None
+        return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+    return condition(etag_func=etag, last_modified_func=last_modified)
+
+def _json_response(encoded):
     response = HttpResponse(encoded, content_type="application/json")
     response['Access-Control-Allow-Origin'] = '*'
     return response
 
 
+# both accept optional query parameters
+# from= and to= (epochs or dates) and max_points=
 @csrf_protect
+@stats_condition('daily_metrics')
+def send_daily_metrics(request, course):
+    try:
+        start, end, max_points = parse_query(request.GET)
+    except ValueError as exc:
+        return HttpResponseBadRequest(str(exc))
+    stats = Stats(course)
+    return _json_response(stats.cached_json(
+        'daily_metrics', _signature(request, course, 'daily_metrics'),
+        start, end, max_points))
+
+
+@csrf_protect
+@stats_condition('monitor_counts')
 def send_monitor_counts(request, course):
+    try:
+        start, end, max_points = parse_query(request.GET)
+    except ValueError as exc:
+        return HttpResponseBadRequest(str(exc))
     stats = Stats(course)
-    encoded = json.dumps(stats.monitor_counts())
-    response = HttpResponse(encoded, content_type="application/json")
-    response['Access-Control-Allow-Origin'] = '*'
-    return response
+    return _json_response(stats.cached_json(
+        'monitor_counts', _signature(request, course, 'monitor_counts'),
+        start, end, max_points))
 
 
+# accepts optional from= and to=
 @csrf_protect
+@stats_condition('open_latencies')
+def send_open_latencies(request, course):
+    try:
+        start, end, _ = parse_query(request.GET)
+    except ValueError as exc:
+        return HttpResponseBadRequest(str(exc))
+    stats = Stats(course)
+    return _json_response(stats.cached_json(
+        'open_latencies', _signature(request, course, 'open_latencies'),
+        start, end))
+
+
+@csrf_protect
+@stats_condition('material_usage')
 def send_material_usage(request, course):
     stats = Stats(course)
-    encoded = json.dumps(stats.material_usage())
-    response = HttpResponse(encoded, content_type="application/json")
-    response['Access-Control-Allow-Origin'] = '*'
-    return response
+    return _json_response(stats.cached_json(
+        'material_usage', _signature(request, course, 'material_usage')))
+
+
+# accepts the same query parameters
+@csrf_protect
+@platform_condition()
+def send_platform_usage(request):
+    try:
+        start, end, max_points = parse_query(request.GET)
+    except ValueError as exc:
+        return HttpResponseBadRequest(str(exc))
+    return _json_response(PlatformStats().cached_json(
+        _platform_signature(request), start, end, max_points))
@@ -1,3 +1,4 @@
+import math
 import subprocess
 from nbh_main.settings import logger
 
@@ -9,4 +10,19 @@ def show_and_run(command, *, dry_run=False):
         return completed.returncode == 0
     else:
         logger.info(f"(DRY-RUN) # {command}")
-        return False
\ No newline at end of file
+        return False
+
+
+def percentiles(values, ratios):
+    """
+    nearest-rank percentiles of a collection of numbers
+
+    e.g. percentiles(latencies, (.5, .95, .99)) returns a list of 3 values
+    taken in latencies; all None if values is empty
+    """
+    if not values:
+        return [None for _ in ratios]
+    ordered = sorted(values)
+    size = len(ordered)
+    return [ordered[min(size - 1, max(0, math.ceil(ratio * size) - 1))]
+            for ratio in ratios]
@@ -42,6 +42,7 @@ setup(
         'redis',
         'nbstripout',  # for course-pull
         'pandas',      # for mass-register
+        'numpy',       # for the monitor counts store
     ],
     setup_requires=[],
     tests_require=[],
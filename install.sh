@@ -155,6 +155,8 @@ function enable-services() {
     rsync $rsopts systemd/nbh-django-over-gunicorn.service /etc/systemd/system/nbh-django.service
     rsync $rsopts systemd/nbh-autopull.service /etc/systemd/system/
     rsync $rsopts systemd/nbh-autopull.timer /etc/systemd/system/
+    rsync $rsopts systemd/nbh-prespawn.service /etc/systemd/system/
+    rsync $rsopts systemd/nbh-prespawn.timer /etc/systemd/system/
     sed -e "s,@monitor_period@,$monitor_period," \
         -e "s,@monitor_idle@,$monitor_idle," \
         -e "s,@monitor_lingering@,$monitor_lingering," \
@@ -164,7 +166,7 @@ function enable-services() {
     systemctl enable podman.socket
     systemctl enable nginx
     systemctl enable --now valkey
-    systemctl enable nbh-django nbh-monitor nbh-autopull.timer
+    systemctl enable nbh-django nbh-monitor nbh-autopull.timer nbh-prespawn.timer
 }
 
 function migrate-database() {
@@ -175,7 +177,7 @@ function migrate-database() {
 function restart-services() {
     systemctl restart podman.socket
     systemctl restart nginx
-    systemctl restart nbh-monitor nbh-django nbh-autopull.timer
+    systemctl restart nbh-monitor nbh-django nbh-autopull.timer nbh-prespawn.timer
 }
 
 # as of summer 2022, this becomes necessary for nbh-pull-student to work smoothly